@@ -0,0 +1,213 @@
+import json
+import logging
+import os
+import resource
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+
+log = logging.getLogger(__name__)
+
+GB = 1024 ** 3
+
+# Used until runs have been recorded: a worker process plus ~40 bytes per matrix
+# cell (object columns from postgres, pandas merges, the fillna and reindex copies)
+DEFAULT_BASE_BYTES = 0.5 * GB
+DEFAULT_BYTES_PER_CELL = 40
+MAX_OBSERVATIONS = 200
+
+
+def peak_rss():
+    """Peak resident set size of this process in bytes"""
+    usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on linux, bytes on mac
+    return usage if sys.platform == 'darwin' else usage * 1024
+
+
+def _proc_status_bytes(field):
+    with open('/proc/self/status', 'r') as f:
+        for line in f:
+            if line.startswith(field + ':'):
+                return int(line.split()[1]) * 1024
+    raise IOError('{} not in /proc/self/status'.format(field))
+
+
+def current_rss():
+    """Resident set size of this process in bytes, the peak where /proc is not available"""
+    try:
+        with open('/proc/self/statm', 'r') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (IOError, OSError):
+        return peak_rss()
+
+
+def reset_peak_rss():
+    """Resets the peak resident set size of this process to its current size (linux), False if it cannot"""
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except (IOError, OSError):
+        return False
+
+
+def physical_memory():
+    return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+
+
+class ResourceProfile():
+    """
+    Peak memory and duration of previous tasks per kind of task ('matrix', 'train'), stored
+    as json in the project path so that every run starts from what the previous ones learned.
+    Also keeps the size of the last experiment (officers, features per block set) for
+    estimating a config without touching the database
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.profile = {'memory': {}, 'seconds': {}, 'n_officers': None, 'n_features': {}}
+        if os.path.isfile(filename):
+            with open(filename, 'r') as f:
+                self.profile.update(json.load(f))
+
+    def _percentile_ratio(self, observations, offset=0):
+        ratios = sorted(max(value - offset, 0) / size for size, value in observations if size > 0)
+        if not ratios:
+            return None
+        # 90th percentile, better to admit one task too few than to get OOM killed
+        return ratios[int(0.9 * (len(ratios) - 1))]
+
+    def bytes_per_cell(self, kind):
+        ratio = self._percentile_ratio(self.profile['memory'].get(kind, []), DEFAULT_BASE_BYTES)
+        return DEFAULT_BYTES_PER_CELL if ratio is None else ratio
+
+    def estimate(self, kind, cells):
+        return DEFAULT_BASE_BYTES + self.bytes_per_cell(kind) * cells
+
+    def seconds_per_unit(self, kind):
+        """None when no task of this kind has been recorded yet"""
+        return self._percentile_ratio(self.profile['seconds'].get(kind, []))
+
+    def _append(self, section, kind, observation):
+        observations = self.profile[section].setdefault(kind, [])
+        observations.append(observation)
+        del observations[:-MAX_OBSERVATIONS]
+
+    def record(self, kind, cells, peak):
+        self._append('memory', kind, [cells, peak])
+
+    def record_seconds(self, kind, work, seconds):
+        self._append('seconds', kind, [work, seconds])
+
+    def record_experiment_size(self, n_officers, n_features):
+        '''
+        Args:
+            n_features (dict): number of features per block set, keyed by the comma joined sorted blocks
+        '''
+        self.profile['n_officers'] = n_officers
+        self.profile['n_features'].update(n_features)
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.filename), exist_ok=True)
+        tmp_filename = '{}.{}.tmp'.format(self.filename, os.getpid())
+        with open(tmp_filename, 'w') as f:
+            json.dump(self.profile, f)
+        os.rename(tmp_filename, self.filename)
+
+
+def _run_measured(func, item, kwargs):
+    '''
+    Runs the task in a worker and returns its result with its duration, the memory it added on top of
+    what the worker held before it (None when the peak of the task cannot be measured), the worker pid
+    and the memory the worker still holds after it. Workers are reused and keep memory they freed
+    '''
+    before = current_rss()
+    reset = reset_peak_rss()
+    previous_peak = peak_rss()
+    start = time.time()
+    result = func(item, **kwargs)
+    seconds = time.time() - start
+    after = current_rss()
+
+    if reset:
+        increase = _proc_status_bytes('VmHWM') - before
+    else:
+        # without a reset the peak of the task is only known when it raised the process maximum
+        peak = peak_rss()
+        increase = peak - before if peak > previous_peak else None
+    return result, seconds, increase, os.getpid(), after
+
+
+class MemoryAdmissionScheduler():
+    """
+    Runs tasks on n_jobs processes, admitting a task only while the estimated peak memory
+    of all the running tasks, plus the memory the workers kept from their previous tasks,
+    stays under the memory budget
+    """
+
+    def __init__(self, n_jobs, memory_budget, profile):
+        '''
+        Args:
+            n_jobs (int): maximum number of worker processes
+            memory_budget (int): bytes available to the workers
+            profile (ResourceProfile): learned memory consumption and duration of previous tasks
+        '''
+        self.n_jobs = n_jobs
+        self.memory_budget = memory_budget
+        self.profile = profile
+
+    def run(self, func, items, kind, cells, work=None, n_jobs=None, **kwargs):
+        '''
+        Calls func(item, **kwargs) for every item and returns the results in order
+        Args:
+            kind (str): kind of task, each kind learns its own memory consumption and duration
+            cells (list): number of matrix cells (rows x features) handled by each item
+            work (list): units of work of each item the duration is proportional to, defaults to cells
+            n_jobs (int): worker processes of this run when lower than the n_jobs of the scheduler,
+                          eg. for tasks starting processes of their own
+        '''
+        work = cells if work is None else work
+        n_jobs = self.n_jobs if n_jobs is None else min(max(n_jobs, 1), self.n_jobs)
+        estimates = [self.profile.estimate(kind, n_cells) for n_cells in cells]
+        results = [None] * len(items)
+        # largest first, the small ones fill the gaps
+        pending = sorted(range(len(items)), key=lambda i: estimates[i], reverse=True)
+        running = {}
+        in_use = 0
+        # memory held by each worker after its last task, above what a fresh worker holds
+        leftover = {}
+
+        log.info('Running {} {} tasks on {} workers with a memory budget of {:.1f}GB'
+                 .format(len(items), kind, n_jobs, self.memory_budget / GB))
+        try:
+            with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+                while pending or running:
+                    while pending and len(running) < n_jobs:
+                        held = in_use + sum(leftover.values())
+                        admitted = next((i for i in pending if held + estimates[i] <= self.memory_budget), None)
+                        if admitted is None and running:
+                            break
+                        if admitted is None:
+                            admitted = pending[0]
+                            log.warning('Task estimated at {:.1f}GB exceeds the memory budget, running it alone'
+                                        .format(estimates[admitted] / GB))
+                        pending.remove(admitted)
+                        future = executor.submit(_run_measured, func, items[admitted], kwargs)
+                        running[future] = admitted
+                        in_use += estimates[admitted]
+
+                    log.debug('{} tasks running ({:.1f}GB estimated, {:.1f}GB kept by the workers), {} waiting'
+                              .format(len(running), in_use / GB, sum(leftover.values()) / GB, len(pending)))
+                    done, _ = wait(running, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        i = running.pop(future)
+                        in_use -= estimates[i]
+                        results[i], seconds, increase, pid, after = future.result()
+                        leftover[pid] = max(after - DEFAULT_BASE_BYTES, 0)
+                        self.profile.record_seconds(kind, work[i], seconds)
+                        if increase is not None:
+                            # recorded as the peak of the task in a fresh worker
+                            self.profile.record(kind, cells[i], DEFAULT_BASE_BYTES + max(increase, 0))
+        finally:
+            self.profile.save()
+        return results
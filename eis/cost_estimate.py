@@ -0,0 +1,143 @@
+import json
+import logging
+import os
+from functools import reduce
+from operator import mul
+
+from sklearn.grid_search import ParameterGrid
+
+from . import utils
+
+log = logging.getLogger(__name__)
+
+# Above these a config is flagged before it is launched
+MAX_TEST_DATES_PER_SPLIT = 100
+MAX_TEMPORAL_COMBINATIONS = 100
+MAX_GROWTH_FROM_LAST_PLAN = 5
+
+
+def block_set_key(blocks):
+    return ','.join(sorted(blocks))
+
+
+def offline_features_list(config, blocks):
+    '''
+    Stand-in for the features list of a block set when the database can not be used: the active
+    features of the config, one per lookback duration. The matrix uuids computed with it are not
+    the real ones, but the number of unique matrices is the same
+    '''
+    return ['{}_{}_{}'.format(block, feature, duration)
+            for block in sorted(blocks)
+            for feature, active in config['feature_blocks'][block].items() if active
+            for duration in config['temporal_info']['timegated_feature_lookback_duration']]
+
+
+def grid_size(grid_config):
+    return sum(len(ParameterGrid(parameter_config)) for parameter_config in grid_config.values())
+
+
+def estimate_plan(config, plan, grid_config, profile):
+    '''
+    Returns the size of the experiment and its estimated runtime
+    Args:
+        plan (ExperimentPlan): plan of the experiment
+        grid_config (dict): model grid, output of utils.generate_model_config
+        profile (ResourceProfile): officers, features and timings recorded by previous runs
+    '''
+    n_models = grid_size(grid_config)
+    summary = plan.summary()
+    officer_dates = {kind: sum(len(node.as_of_dates) for node in plan.matrices.values() if node.kind == kind)
+                     for kind in ('train', 'test')}
+
+    n_block_sets = len(set(block_set_key(task.blocks) for task in plan.tasks))
+
+    report = {'feature_as_of_dates': len(utils.generate_feature_dates(config['temporal_info'])),
+              'temporal_sets': summary['tasks'] // max(n_block_sets, 1),
+              'block_sets': n_block_sets,
+              'tasks': summary['tasks'],
+              'train_matrices': summary['train_matrices'],
+              'test_matrices': summary['test_matrices'],
+              'grid_size': n_models,
+              'models_to_fit': summary['tasks'] * n_models,
+              'predictions': (summary['matrix_references'] - summary['tasks']) * n_models,
+              'train_officer_dates': officer_dates['train'],
+              'test_officer_dates': officer_dates['test']}
+
+    # rows, features and runtime need the size of the department recorded by a previous run
+    n_officers = profile.profile['n_officers']
+    if n_officers is None:
+        log.info('No previous run recorded, matrix rows and runtime are reported per officer')
+        return report
+
+    report['train_rows'] = officer_dates['train'] * n_officers
+    report['test_rows'] = officer_dates['test'] * n_officers
+
+    n_features = profile.profile['n_features']
+    matrix_cells = 0
+    train_work = 0
+    for node in plan.matrices.values():
+        features = n_features.get(block_set_key(node.blocks), len(node.features_list))
+        matrix_cells += len(node.as_of_dates) * n_officers * (features + 1)
+    for group in plan.task_groups():
+        train_work += group.train_matrix.cells(n_officers) * len(group.tasks) * n_models
+    report['matrix_cells'] = matrix_cells
+
+    seconds = {kind: profile.seconds_per_unit(kind) for kind in ('matrix', 'train')}
+    if None in seconds.values():
+        log.info('No timings recorded yet for {}, runtime not estimated'.format(
+            [kind for kind, value in seconds.items() if value is None]))
+        return report
+
+    n_cpus = config['n_cpus']
+    report['estimated_matrix_hours'] = seconds['matrix'] * matrix_cells / n_cpus / 3600
+    report['estimated_train_hours'] = seconds['train'] * train_work / n_cpus / 3600
+    report['estimated_hours'] = report['estimated_matrix_hours'] + report['estimated_train_hours']
+    return report
+
+
+def explosion_warnings(config, plan, report, last_report):
+    '''
+    Returns the reasons to double check a config before launching it
+    '''
+    warnings = []
+    temporal_info = config['temporal_info']
+    max_test_dates = max(len(task.temporal_set['test_as_of_dates']) for task in plan.tasks)
+    if max_test_dates > MAX_TEST_DATES_PER_SPLIT:
+        warnings.append('test_frequency {} with test_time_ahead {} gives up to {} test matrices per split'
+                        .format(temporal_info['test_frequency'], temporal_info['test_time_ahead'], max_test_dates))
+
+    options = {key: len(value) for key, value in temporal_info.items() if isinstance(value, list) and len(value) > 1}
+    if reduce(mul, options.values(), 1) > MAX_TEMPORAL_COMBINATIONS:
+        warnings.append('temporal options multiply the number of splits: {}'.format(
+            ' x '.join('{} {}'.format(n, key) for key, n in sorted(options.items()))))
+
+    if last_report:
+        for key in ('models_to_fit', 'predictions', 'train_officer_dates', 'test_officer_dates'):
+            if last_report.get(key) and report[key] > MAX_GROWTH_FROM_LAST_PLAN * last_report[key]:
+                warnings.append('{} grew {:.0f}x from the last planned config ({} -> {})'
+                                .format(key, report[key] / last_report[key], last_report[key], report[key]))
+    return warnings
+
+
+def report_plan(config, plan, grid_config, profile):
+    '''
+    Logs the estimate of the experiment and the warnings, and keeps it for comparing the next config
+    '''
+    report = estimate_plan(config, plan, grid_config, profile)
+
+    last_report_filename = os.path.join(config['project_path'], 'last_plan.json')
+    last_report = None
+    if os.path.isfile(last_report_filename):
+        with open(last_report_filename, 'r') as f:
+            last_report = json.load(f)
+
+    log.info('Plan of the experiment:')
+    for key, value in report.items():
+        log.info('    {}: {}'.format(key, round(value, 2) if isinstance(value, float) else value))
+    for warning in explosion_warnings(config, plan, report, last_report):
+        log.warning('CHECK CONFIG: {}'.format(warning))
+
+    os.makedirs(config['project_path'], exist_ok=True)
+    with open(last_report_filename, 'w') as f:
+        json.dump(report, f, sort_keys=True)
+    return report
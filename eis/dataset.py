@@ -192,42 +192,6 @@ def store_prediction_info( timestamp, unit_id_train, unit_id_test, unit_predicti
 
     return None
 
-def store_evaluation_metrics( model_id, evaluation, metric, test_date, db_conn, parameter=None, comment=None):
-    """ Write the model evaluation metrics into the results schema
-
-    :param int model_id: the model_id of the model.
-    :param dict evaluation_metrics: dictionary whose keys correspond to metric names in the features.evaluations columns.
-    :param test_date: date in string 'Y-m-d' for which the test was made
-    """
-
-    # round to 10 digits to avoid underflow errors
-    evaluation = round(float(evaluation), 10)
-
-    if parameter is None:
-        parameter = 'Null'
-
-    if comment is None:
-        comment= 'Null'
-
-    query = (   """   INSERT INTO results.evaluations( model_id, 
-                                                     metric, 
-                                                     parameter, 
-                                                     value, 
-                                                     comment, 
-                                                     evaluation_start_time,
-                                                     evaluation_end_time)
-                   VALUES( '{0}', '{1}', '{2}', '{3}', {4}, '{5}'::timestamp, '{5}'::timestamp) """
-                   .format( model_id,
-                            metric,
-                            parameter,
-                            evaluation,
-                            comment,
-                            test_date ))
- 
-    db_conn.cursor().execute(query)
-    db_conn.commit()
-    return None
-
 
 def format_officer_ids(ids):
     formatted = ["{}".format(each_id) for each_id in ids]
@@ -0,0 +1,148 @@
+import json
+import logging
+import os
+import re
+import socket
+
+log = logging.getLogger(__name__)
+
+# column names of the collate tables, same expression as public.get_active_block_features:
+#   <prefix>_<entity>_id_[<window>_]<Feature>_<metric>, where window is an interval like P1Y or all
+COLUMN_PATTERN = re.compile(r'_id_(P\d+\w|all)?[_]?([A-Z][A-Za-z0-9]+)_')
+
+# catalogs read by this process, keyed by schema: (catalog, version of the shared file it was read from)
+_catalogs = {}
+
+
+def catalog_filename(directory, schema_name):
+    return os.path.join(directory, 'feature_catalog_{}.json'.format(schema_name))
+
+
+def _file_version(filename):
+    '''
+    Returns the (inode, mtime) of the file, None when it does not exist. The file is replaced with a
+    rename, a new version has a new inode
+    '''
+    try:
+        stat = os.stat(filename)
+    except FileNotFoundError:
+        return None
+    return stat.st_ino, stat.st_mtime_ns
+
+
+class FeatureCatalog():
+    """
+    Feature columns of the block tables of a schema, read with one query on information_schema and
+    parsed into (column, feature, window, metric) entries. Answers the same question as the
+    public.get_active_block_features stored procedure without going back to the database
+    """
+
+    def __init__(self, schema_name, tables):
+        '''
+        Args:
+            tables (dict): column names of every table of the schema, keyed by table name
+        '''
+        self.schema_name = schema_name
+        self.tables = tables
+        self._entries = {}
+
+    @classmethod
+    def read(cls, db_engine, schema_name):
+        query = ("SELECT table_name, column_name FROM information_schema.columns "
+                 "WHERE table_schema = %s ORDER BY table_name, ordinal_position")
+        tables = {}
+        for table_name, column_name in db_engine.execute(query, (schema_name,)):
+            tables.setdefault(table_name, []).append(column_name)
+        log.debug('Read the feature catalog of {}: {} tables'.format(schema_name, len(tables)))
+        return cls(schema_name, tables)
+
+    def entries(self, table_name):
+        '''
+        Returns the (column, feature, window, metric) of the feature columns of a table,
+        window is None for the features without a time window
+        '''
+        if table_name not in self._entries:
+            entries = []
+            for column in self.tables.get(table_name, []):
+                match = COLUMN_PATTERN.search(column)
+                if match is not None:
+                    entries.append((column, match.group(2), match.group(1), column[match.end():]))
+            self._entries[table_name] = entries
+        return self._entries[table_name]
+
+    def active_block_features(self, table_name, features, lookback_durations):
+        '''
+        Port of public.get_active_block_features
+        Args:
+            features (list): active features of the block, eg: ArrestsCount
+            lookback_durations (list): time windows of the time gated features
+        Returns:
+            the columns of the table holding the features, and the features not found in the table
+        '''
+        columns = {}
+        no_window = set()
+        all_window = set()
+        for column, feature, window, metric in self.entries(table_name):
+            name = feature if window is None else '{}_{}'.format(window, feature)
+            columns.setdefault(name, []).append(column)
+            if window is None:
+                no_window.add(name)
+            elif window == 'all':
+                all_window.add(name.replace('all_', ''))
+
+        # (requested feature, name of its columns)
+        requested = {(feature, '{}_{}'.format(window, feature))
+                     for window in lookback_durations for feature in features}
+        requested -= {(feature, '{}_{}'.format(window, feature)) for window in lookback_durations
+                      for feature in no_window | all_window}
+        requested |= {(feature, feature) for feature in no_window & set(features)}
+        requested |= {('all_' + feature, 'all_' + feature) for feature in all_window & set(features)}
+
+        available = sorted(column for name in {name for _, name in requested} for column in columns.get(name, []))
+        missing = sorted({feature for feature, name in requested if name not in columns})
+        return available, missing
+
+    def save(self, directory):
+        filename = catalog_filename(directory, self.schema_name)
+        os.makedirs(directory, exist_ok=True)
+        tmp_filename = '{}.{}.{}.tmp'.format(filename, socket.gethostname(), os.getpid())
+        with open(tmp_filename, 'w') as f:
+            json.dump({'schema_name': self.schema_name, 'tables': self.tables}, f, sort_keys=True)
+        os.rename(tmp_filename, filename)
+
+    @classmethod
+    def load(cls, directory, schema_name):
+        with open(catalog_filename(directory, schema_name), 'r') as f:
+            return cls(schema_name, json.load(f)['tables'])
+
+
+def get_catalog(db_engine, schema_name, directory=None):
+    '''
+    Returns the catalog of the schema: from this process' memo while the file shared by the workers in
+    directory (the matrix directory) is the one it was read from, else from that file, else read from
+    the database and shared. Another process invalidating or saving the catalog changes the file
+    '''
+    version = None
+    if directory is not None:
+        version = _file_version(catalog_filename(directory, schema_name))
+    if schema_name in _catalogs and (directory is None or _catalogs[schema_name][1] == version):
+        return _catalogs[schema_name][0]
+
+    if version is not None:
+        catalog = FeatureCatalog.load(directory, schema_name)
+    else:
+        catalog = FeatureCatalog.read(db_engine, schema_name)
+        if directory is not None:
+            catalog.save(directory)
+            version = _file_version(catalog_filename(directory, schema_name))
+    _catalogs[schema_name] = (catalog, version)
+    return catalog
+
+
+def invalidate(schema_name, directory=None):
+    '''
+    Forgets the catalog of the schema, called when the tables of the schema are rebuilt
+    '''
+    _catalogs.pop(schema_name, None)
+    if directory is not None and os.path.isfile(catalog_filename(directory, schema_name)):
+        os.remove(catalog_filename(directory, schema_name))
@@ -1,11 +1,75 @@
+import io
+import numpy as np
 import pandas as pd
 import logging
 import pdb
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from . import feature_catalog
+from . import officer_spans
 from .features import class_map
 from .features import officers_collate
 
 log = logging.getLogger(__name__)
 
+# bytes of COPY output parsed at a time
+COPY_CHUNK_BYTES = 64 * 1024 * 1024
+MB = 1024 * 1024
+MATRIX_ASSEMBLIES = ('client', 'server')
+# target columns of a single server side join, postgres allows 1664
+SERVER_JOIN_COLUMNS = 1600
+DEFAULT_FETCH_THREADS = 4
+
+
+class _CopyStream():
+    '''
+    File object receiving the CSV output of a COPY ... TO STDOUT. Complete lines are parsed into
+    typed columns every COPY_CHUNK_BYTES and handed to on_chunk, so at most one chunk of text is held
+    '''
+
+    def __init__(self, dtypes, on_chunk):
+        '''
+        Args:
+            dtypes (list): numpy dtype of each column, datetime64 columns are parsed as timestamps
+            on_chunk (callable): called with the DataFrame of every parsed chunk
+        '''
+        self.dtypes = dtypes
+        self.on_chunk = on_chunk
+        self.pending = []
+        self.pending_bytes = 0
+        self.bytes = 0
+        self.rows = 0
+
+    def write(self, data):
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        self.pending.append(data)
+        self.pending_bytes += len(data)
+        self.bytes += len(data)
+        if self.pending_bytes >= COPY_CHUNK_BYTES:
+            data = b''.join(self.pending)
+            end = data.rfind(b'\n') + 1
+            self.pending = [data[end:]]
+            self.pending_bytes = len(data) - end
+            self._parse(data[:end])
+
+    def close(self):
+        self._parse(b''.join(self.pending))
+        self.pending = []
+
+    def _parse(self, data):
+        if not data:
+            return
+        dates = [i for i, dtype in enumerate(self.dtypes) if np.dtype(dtype).kind == 'M']
+        chunk = pd.read_csv(io.BytesIO(data), header=None, engine='c',
+                            dtype={i: dtype for i, dtype in enumerate(self.dtypes) if i not in dates})
+        for i in dates:
+            chunk[i] = pd.to_datetime(chunk[i].values).values.astype(self.dtypes[i])
+        self.rows += len(chunk)
+        self.on_chunk(chunk)
+
 
 class FeatureLoader():
 
@@ -18,7 +82,10 @@ class FeatureLoader():
                        prediction_window, 
                        officer_past_activity_window,
                        timegated_feature_lookback_duration,
-                       db_engine):
+                       db_engine,
+                       catalog_path=None,
+                       assembly='client',
+                       fetch_threads=DEFAULT_FETCH_THREADS):
         '''
         Args:
             feature_blocks (dict): dictionary of feature blocks and list of features to use for the matrix
@@ -28,6 +95,9 @@ class FeatureLoader():
             labels (dict): labels dictionary to use from the config file
             prediction_window (str) : prediction window to use for the label generation
             officer_past_activity_window (str): window for conditioning which officers to use given an as_of_date
+            catalog_path (str): directory where the feature catalog is shared between workers (the matrix directory)
+            assembly (str): 'client' joins the block tables in pandas, 'server' joins them in the database
+            fetch_threads (int): connections reading the labels master and the block tables concurrently
         '''
 
         self.features = features
@@ -40,10 +110,18 @@ class FeatureLoader():
         self.officer_past_activity_window = officer_past_activity_window
         self.timegated_feature_lookback_duration = timegated_feature_lookback_duration
         self.db_engine = db_engine
+        self.catalog_path = catalog_path
+        if assembly not in MATRIX_ASSEMBLIES:
+            raise ValueError('Unknown matrix assembly {}, use one of {}'.format(assembly, MATRIX_ASSEMBLIES))
+        self.assembly = assembly
+        self.fetch_threads = max(1, fetch_threads)
+        self._block_tables = {}
 
         self.flatten_label_keys = [item for sublist in self.labels for item in sublist]
 
     def _block_tables_name(self, block_name):
+        if block_name in self._block_tables:
+            return self._block_tables[block_name]
         block_class = class_map.lookup_block(block_name,
                                      module=officers_collate,
                                      lookback_durations=self.timegated_feature_lookback_duration,
@@ -55,45 +133,39 @@ class FeatureLoader():
                        block_class.prefix_space_time, 
                        block_class.prefix_post]
         
-        return ['{prefix}_aggregation'.format(prefix=prefix) for prefix in list_prefix if prefix]       
+        self._block_tables[block_name] = ['{prefix}_aggregation'.format(prefix=prefix)
+                                          for prefix in list_prefix if prefix]
+        return self._block_tables[block_name]
 
 
     def features_list(self):
         return [feature for list_features in self.features_in_blocks().values() for feature in list_features]
 
     def features_in_blocks(self):
-        
+        catalog = feature_catalog.get_catalog(self.db_engine, self.schema_name, self.catalog_path)
+
         features_in_blocks = {}
-        features_missing = [] 
+        features_missing = []
         for block in self.blocks:
             active_features = [key for key in self.features[block] if self.features[block][key] == True]
             block_tables = self._block_tables_name(block)
             for block_table in block_tables:
                 if active_features:
-                    query = (""" select * FROM public.get_active_block_features('{schema_name}',
-                                                                                '{block_table}',
-                                                                                 ARRAY{active_features},
-                                                                                 ARRAY{timegated_feature_lookback_duration});"""
-                             .format(schema_name=self.schema_name,
-                                     block_table=block_table,
-                                     active_features=active_features,
-                                     timegated_feature_lookback_duration=self.timegated_feature_lookback_duration))
-                    
-                    result = self.db_engine.connect().execute(query)
-                    result_dict = [dict(row) for row in result][0]
-                    features_in_blocks[block_table] = result_dict['col_avaliable']
+                    col_avaliable, col_missing = catalog.active_block_features(
+                        block_table, active_features, self.timegated_feature_lookback_duration)
+                    if col_avaliable:
+                        features_in_blocks[block_table] = col_avaliable
                     # keep going through the rest of features
-                    active_features = result_dict['col_missing']
+                    active_features = col_missing
 
-            if result_dict['col_missing']:
-                features_missing += result_dict['col_missing']
+            features_missing += active_features
         if not features_missing:
             log.debug('No features are missing')
         else:
             log.debug('These features are missing: {}'.format(features_missing))
 
         return features_in_blocks
-         
+
     def _tree_conditions(self, nested_dict, parent=[], conditions=[]):
         '''
         Function that returns a list of conditions from the labels config file
@@ -125,8 +197,10 @@ class FeatureLoader():
                         self._get_event_type_columns(val[key], list_events)
         return list_events
 
-    def get_query_labels(self, as_of_dates_to_use):
+    def get_query_labels(self, as_of_dates_to_use, as_of_dates_table=None):
         '''
+        Args:
+            as_of_dates_table (str): table holding the as_of_dates, instead of inlining them in the query
         '''
 
         # SUBQUERIES of arrays of conditions
@@ -165,6 +239,8 @@ class FeatureLoader():
         query_as_of_dates = (" as_of_dates as ( "
                             "select unnest(ARRAY{as_of_dates}::timestamp[]) as as_of_date) "
                             .format(as_of_dates=as_of_dates_to_use))
+        if as_of_dates_table is not None:
+            query_as_of_dates = " as_of_dates as (select as_of_date from {}) ".format(as_of_dates_table)
 
         # DATE FILTER
         query_filter = ("group_events as ( "
@@ -208,73 +284,237 @@ class FeatureLoader():
         return query_labels
 
     def get_dataset(self, as_of_dates_to_use):
+        '''
+        Returns the matrix of the as_of_dates: indexed by officer_id, the as_of_date column, the features as float32
+        and the outcome last, rows sorted by officer_id and as_of_date. The features are cast to float4 in the
+        queries and decoded chunk by chunk straight into one preallocated float32 array, the rows a table does
+        not have keep their zeros (zero imputation)
+        '''
         features_in_blocks = self.features_in_blocks()
-        # Read labels master 
-        complete_df = self.get_master_labels(as_of_dates_to_use)
-
-        #loop through every table in blocks
-        for table_name, features in features_in_blocks.items():
-            log.info('Joining table {}!'.format(table_name))
-            features_coalesce = ", ".join(['coalesce("{0}",0) as {0}'.format(feature) for feature in features])
-             
-            # table with no date
+        if self.assembly == 'server':
+            return self._get_dataset_server(as_of_dates_to_use, features_in_blocks)
+
+        # column major, the columns of a table are a contiguous block
+        starts = np.cumsum([0] + [len(features) for features in features_in_blocks.values()])
+        columns = [feature for features in features_in_blocks.values() for feature in features]
+
+        # the labels master and the block tables are read concurrently, each on its own connection.
+        # The rows of the tables are placed once the labels master is known
+        spine = {}
+        spine_lock = threading.Lock()
+
+        def get_spine():
+            with spine_lock:
+                if not spine:
+                    labels = labels_future.result()
+                    # sorted, the same row order as the server side assembly
+                    labels = labels.sort_values(['officer_id', 'as_of_date'], kind='mergesort')
+                    spine['labels'] = labels
+                    spine['officer_ids'] = labels['officer_id'].values.astype(np.int64)
+                    spine['as_of_dates'] = pd.to_datetime(labels['as_of_date']).values.astype('datetime64[ns]')
+                    spine['rows'] = pd.MultiIndex.from_arrays([spine['officer_ids'], spine['as_of_dates']])
+                    spine['values'] = np.zeros((len(labels), len(columns)), dtype=np.float32, order='F')
+            return spine
+
+        def place(chunk, table_name, start, end):
+            spine = get_spine()
+            values = spine['values']
             if 'ND' in table_name:
-                query = ("""SELECT officer_id,
-                                   {features_coalesce}
-                            FROM {schema}."{table_name}"
-                             WHERE officer_id is not null; """
-                                            .format(features_coalesce=features_coalesce,
-                                                                schema=self.schema_name,
-                                                                table_name=table_name))                                    
+                # one row per officer, copied to all of its as_of_dates
+                positions = pd.Index(chunk[0].values).get_indexer(spine['officer_ids'])
+                found = positions >= 0
+                values[found, start:end] = chunk.iloc[:, 1:].values[positions[found]]
             else:
-                query = ("""SELECT officer_id,
-                                   as_of_date::timestamp,
-                                  {features_coalesce}
-                            FROM {schema}."{table_name}"
-                            WHERE as_of_date in (
-                                SELECT unnest(ARRAY{as_of_dates}::DATE[]))
-                             AND officer_id is not null
-                                ;""".format(features_coalesce=features_coalesce,
-                                                 schema=self.schema_name,
-                                                 table_name=table_name,
-                                                 as_of_dates=as_of_dates_to_use))
-            # Get the data
-            db_conn = self.db_engine.raw_connection()
-            cur = db_conn.cursor(name='cursor_for_loading_matrix')
-            cur.execute(query)
-            table = cur.fetchall()
-
-            # Get column names
-            col_names = []
-            for desc in cur.description:
-                col_names.append(desc[0])  
-
-            # To pandas df
-            table = pd.DataFrame(table)
-            table.columns = col_names
-            db_conn.close()
-            
-            if 'ND' in table_name:
-                 complete_df = complete_df.merge(table, on='officer_id', how='left')
-            else:
-                 complete_df = complete_df.merge(table, on=['officer_id','as_of_date'], how='left')
+                positions = spine['rows'].get_indexer(pd.MultiIndex.from_arrays([chunk[0].values, chunk[1].values]))
+                found = positions >= 0
+                values[positions[found], start:end] = chunk.iloc[:, 2:].values[found]
+
+        with ThreadPoolExecutor(max_workers=self.fetch_threads) as executor:
+            # submitted first so that it is running before any table waits for it
+            labels_future = executor.submit(self.get_master_labels, as_of_dates_to_use)
+            futures = []
+            for (table_name, features), start, end in zip(features_in_blocks.items(), starts[:-1], starts[1:]):
+                log.info('Joining table {}!'.format(table_name))
+                futures.append(executor.submit(self._copy_table, table_name, features, as_of_dates_to_use,
+                                               partial(place, table_name=table_name, start=start, end=end)))
+            for future in futures:
+                future.result()
+
+        # tables without rows never asked for the labels master
+        spine = get_spine()
+        labels, officer_ids, as_of_dates, values = (spine['labels'], spine['officer_ids'], spine['as_of_dates'],
+                                                    spine['values'])
+
+        complete_df = pd.DataFrame(values, index=pd.Index(officer_ids, name='officer_id'), columns=columns,
+                                   copy=False)
+        complete_df.insert(0, 'as_of_date', as_of_dates)
+        # labels at last
+        complete_df['outcome'] = labels['outcome'].values
 
-        #Set index
-        complete_df = complete_df.set_index('officer_id')
+        log.info('length of data_set: {}'.format(len(complete_df)))
+        log.info('as of dates used: {}'.format(complete_df['as_of_date'].unique()))
+        log.info('number of officers with adverse incident: {}'.format(complete_df['outcome'].sum() ))
+        return complete_df
 
-        # Zero imputation
-        complete_df.fillna(0, inplace=True)
+    def _get_dataset_server(self, as_of_dates_to_use, features_in_blocks):
+        '''
+        get_dataset joining the block tables in the database: the as_of_dates and the officer/as_of_date
+        spine are loaded in indexed temporary tables, then the block tables are LEFT JOINed to the spine,
+        SERVER_JOIN_COLUMNS features per statement, and streamed back in spine order
+        '''
+        start = time.time()
+        db_conn = self.db_engine.raw_connection()
+        cur = db_conn.cursor()
+        try:
+            # dropped with the transaction
+            cur.execute("CREATE TEMP TABLE matrix_as_of_dates (as_of_date TIMESTAMP PRIMARY KEY) ON COMMIT DROP")
+            cur.copy_expert("COPY matrix_as_of_dates FROM STDIN",
+                            io.StringIO(''.join('{}\n'.format(as_of_date) for as_of_date in as_of_dates_to_use)))
+            cur.execute("CREATE TEMP TABLE matrix_spine ON COMMIT DROP AS {}"
+                        .format(self.get_query_master_labels(as_of_dates_to_use, 'matrix_as_of_dates')))
+            cur.execute("CREATE INDEX ON matrix_spine (officer_id, as_of_date)")
+            cur.execute("ANALYZE matrix_spine")
+
+            chunks = []
+            self._copy_query('labels', "SELECT officer_id, as_of_date, outcome FROM matrix_spine "
+                                       "ORDER BY officer_id, as_of_date",
+                             [np.int64, 'datetime64[ns]', np.int64], chunks.append, cur)
+            labels = (pd.concat(chunks, ignore_index=True) if chunks
+                      else pd.DataFrame({0: np.array([], dtype=np.int64),
+                                         1: np.array([], dtype='datetime64[ns]'),
+                                         2: np.array([], dtype=np.int64)}))
+
+            columns = [feature for features in features_in_blocks.values() for feature in features]
+            values = np.zeros((len(labels), len(columns)), dtype=np.float32, order='F')
+            offset = 0
+            for group in self._join_groups(features_in_blocks):
+                self._copy_join(group, values, offset, cur)
+                offset += sum(len(features) for _, features in group)
+            db_conn.commit()
+        finally:
+            cur.close()
+            db_conn.close()
 
+        complete_df = pd.DataFrame(values, index=pd.Index(labels[0].values, name='officer_id'), columns=columns,
+                                   copy=False)
+        complete_df.insert(0, 'as_of_date', labels[1].values)
         # labels at last
-        cols = complete_df.columns.tolist()
-        cols.insert(len(cols), cols.pop(cols.index('outcome')))
-        complete_df = complete_df.reindex(columns=cols)  
+        complete_df['outcome'] = labels[2].values
 
+        log.info('Assembled {} rows x {} features in the database in {:.1f}s'.format(len(complete_df), len(columns),
+                                                                                     time.time() - start))
         log.info('length of data_set: {}'.format(len(complete_df)))
-        log.info('as of dates used: {}'.format(complete_df['as_of_date'].unique()))
         log.info('number of officers with adverse incident: {}'.format(complete_df['outcome'].sum() ))
         return complete_df
 
+    @staticmethod
+    def _join_groups(features_in_blocks):
+        '''
+        Splits the block tables in groups of at most SERVER_JOIN_COLUMNS features, a table with more
+        features is a group by itself
+        '''
+        groups = [[]]
+        n_columns = 0
+        for table_name, features in features_in_blocks.items():
+            if groups[-1] and n_columns + len(features) > SERVER_JOIN_COLUMNS:
+                groups.append([])
+                n_columns = 0
+            groups[-1].append((table_name, features))
+            n_columns += len(features)
+        return [group for group in groups if group]
+
+    def _copy_join(self, group, values, start, cur):
+        '''
+        LEFT JOINs a group of block tables to the spine and streams their features, in spine order,
+        into the columns of values starting at start
+        '''
+        select = []
+        joins = []
+        for i, (table_name, features) in enumerate(group):
+            select += ['coalesce(t{0}."{1}",0)::float4'.format(i, feature) for feature in features]
+            # table with no date
+            condition = 't{0}.officer_id = s.officer_id'.format(i)
+            if 'ND' not in table_name:
+                condition += ' AND t{0}.as_of_date = s.as_of_date'.format(i)
+            joins.append('LEFT JOIN {schema}."{table_name}" t{i} ON {condition}'.format(
+                schema=self.schema_name, table_name=table_name, i=i, condition=condition))
+        query = ("SELECT {select} FROM matrix_spine s {joins} ORDER BY s.officer_id, s.as_of_date"
+                 .format(select=', '.join(select), joins=' '.join(joins)))
+
+        n_features = len(select)
+        offset = [0]
+
+        def place(chunk):
+            end = offset[0] + len(chunk)
+            if end > len(values):
+                raise ValueError('Block tables {} have several rows per officer and as_of_date'
+                                 .format([table_name for table_name, _ in group]))
+            values[offset[0]:end, start:start + n_features] = chunk.values
+            offset[0] = end
+
+        self._copy_query(', '.join(table_name for table_name, _ in group), query, [np.float32] * n_features,
+                         place, cur)
+
+    def _copy_table(self, table_name, features, as_of_dates_to_use, on_chunk):
+        '''
+        Streams the features of a block table, cast to float4
+        Args:
+            on_chunk (callable): called with every parsed chunk: officer_id, as_of_date for the tables
+                with a date, then the float32 features
+        '''
+        features_cast = ", ".join(['coalesce("{0}",0)::float4 as "{0}"'.format(feature) for feature in features])
+
+        # table with no date
+        if 'ND' in table_name:
+            query = ("""SELECT officer_id,
+                               {features_cast}
+                        FROM {schema}."{table_name}"
+                         WHERE officer_id is not null """
+                                        .format(features_cast=features_cast,
+                                                            schema=self.schema_name,
+                                                            table_name=table_name))
+            dtypes = [np.int64]
+        else:
+            query = ("""SELECT officer_id,
+                               as_of_date::timestamp,
+                              {features_cast}
+                        FROM {schema}."{table_name}"
+                        WHERE as_of_date in (
+                            SELECT unnest(ARRAY{as_of_dates}::DATE[]))
+                         AND officer_id is not null
+                            """.format(features_cast=features_cast,
+                                             schema=self.schema_name,
+                                             table_name=table_name,
+                                             as_of_dates=as_of_dates_to_use))
+            dtypes = [np.int64, 'datetime64[ns]']
+        self._copy_query(table_name, query, dtypes + [np.float32] * len(features), on_chunk)
+
+    def _copy_query(self, name, query, dtypes, on_chunk, cur=None):
+        '''
+        Runs the query with COPY ... TO STDOUT and parses its CSV output chunk by chunk into typed columns
+        Args:
+            dtypes (list): numpy dtype of each column of the query
+            cur: cursor to run the query with, a new connection by default
+        '''
+        start = time.time()
+        stream = _CopyStream(dtypes, on_chunk)
+        if cur is not None:
+            cur.copy_expert("COPY ({}) TO STDOUT WITH CSV".format(query), stream)
+            stream.close()
+        else:
+            db_conn = self.db_engine.raw_connection()
+            cur = db_conn.cursor()
+            try:
+                cur.copy_expert("COPY ({}) TO STDOUT WITH CSV".format(query), stream)
+                stream.close()
+            finally:
+                cur.close()
+                db_conn.close()
+
+        seconds = max(time.time() - start, 1e-9)
+        log.info('Loaded {}: {} rows, {:.1f} MB in {:.1f}s ({:.0f} rows/s, {:.1f} MB/s)'.format(
+            name, stream.rows, stream.bytes / MB, seconds, stream.rows / seconds, stream.bytes / MB / seconds))
+
     def get_query_features(self):
         table_names = [x for block in self.blocks for x in  self._block_tables_name(block)]  
 
@@ -325,58 +565,40 @@ class FeatureLoader():
         '''
         Returns master list of labels for specific as of dates
         '''
+        chunks = []
+        self._copy_query('labels', self.get_query_master_labels(as_of_dates_to_use),
+                         [np.int64, 'datetime64[ns]', np.int64], chunks.append)
+        if not chunks:
+            return pd.DataFrame({'officer_id': np.array([], dtype=np.int64),
+                                 'as_of_date': np.array([], dtype='datetime64[ns]'),
+                                 'outcome': np.array([], dtype=np.int64)})
+        labels = pd.concat(chunks, ignore_index=True)
+        labels.columns = ['officer_id', 'as_of_date', 'outcome']
+        return labels
 
-        # We only want to train and test on officers that have been active (any logged activity in events_hub)
-        # NOTE: it uses the feature_labels created in query_labels         
-        active_subquery = ( " officers AS (  "
-                         "       SELECT officer_id "
-                         "       FROM staging.officers_hub "
-                         " ), active AS ( "
-                         "       SELECT officer_id, as_of_date "
-                         "       FROM as_of_dates as d "
-                         "       CROSS JOIN officers as off, "
-                         "           LATERAL "
-                         "                (SELECT 1 "
-                         "                 FROM staging.events_hub e "
-                         "                 WHERE off.officer_id = e.officer_id "
-                         "                 AND e.event_datetime + INTERVAL '{window}' > d.as_of_date "
-                         "                 AND e.event_datetime <= d.as_of_date "
-                         "                    LIMIT 1 ) sub_activity, "
-                         "            LATERAL "
-                         "                (SELECT 1 "
-                         "                 FROM staging.officer_roles r "
-                         "                 WHERE off.officer_id = r.officer_id "
-                         "                 AND r.job_start_date <= d.as_of_date "
-                         "                 AND sworn_flag = 1 "
-                         "                 LIMIT 1) sub_sworn )"
-                         .format(window=self.officer_past_activity_window))
+    def get_query_master_labels(self, as_of_dates_to_use, as_of_dates_table=None):
+        '''
+        Returns the query of the master list of labels: officer_id, as_of_date and outcome
+        '''
+
+        # We only want to train and test on sworn officers that have been active (any logged activity in events_hub),
+        # read from the spans materialized by officer_spans.refresh
+        # NOTE: it uses the as_of_dates created in query_labels
+        active_subquery = (" active AS ({}) "
+                           .format(officer_spans.query_active_officers(self.officer_past_activity_window)))
 
         query_master_labels = (" {labels_subquery}, "
                                " {active_subquery} "
                                " SELECT officer_id, "
                                "        as_of_date, "
-                               "        coalesce(outcome,0) as outcome "
+                               "        coalesce(outcome,0)::int as outcome "
                                " FROM active "
                                " LEFT JOIN labels "
                                " USING (as_of_date, officer_id) "
-                               .format(labels_subquery=self.get_query_labels(as_of_dates_to_use),
+                               .format(labels_subquery=self.get_query_labels(as_of_dates_to_use,
+                                                                             as_of_dates_table),
                                        active_subquery=active_subquery))
-        
-        db_conn = self.db_engine.raw_connection()
-        cur = db_conn.cursor(name='cursor_for_loading_matrix')
-        cur.execute(query_master_labels)
-        labels = cur.fetchall()
-
-        # Get column names
-        col_names = []
-        for desc in cur.description:
-            col_names.append(desc[0])
-
-        # To pandas df
-        labels = pd.DataFrame(labels)
-        labels.columns = col_names
-        db_conn.close()
-        return labels
+        return query_master_labels
 
     def get_dataset_old(self, as_of_dates_to_use):
         '''
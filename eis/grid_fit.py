@@ -0,0 +1,100 @@
+import importlib
+import logging
+import os
+import socket
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from sklearn.grid_search import ParameterGrid
+
+from triage.model_trainers import ModelTrainer
+from . import matrix_store
+from .ledger import CheckpointLedger
+
+log = logging.getLogger(__name__)
+
+
+def shared_train_matrix(train_df, metadata, matrices_path, uuid):
+    '''
+    Returns the directory of a memmap of the train matrix that the fitting processes map without copying it.
+    A train matrix stored as memmap with the columns of train_df is used as is, otherwise a memmap copy is
+    stored in a directory of this process under matrices_path/shared, to be removed with
+    remove_shared_train_matrix once the grid is fitted
+    Args:
+        train_df (DataFrame): train matrix without its index columns, label last
+    '''
+    if matrix_store.stored_format(matrices_path, uuid) == 'memmap':
+        stored_columns = [column for column in matrix_store.load_memmap(matrices_path, uuid).columns
+                          if column != 'as_of_date']
+        if stored_columns == [column for column in train_df.columns if column != 'as_of_date']:
+            return matrices_path
+
+    directory = os.path.join(matrices_path, 'shared', '{}.{}'.format(socket.gethostname(), os.getpid()))
+    if matrix_store.stored_format(directory, uuid) != 'memmap':
+        matrix_store.store_memmap(train_df, metadata, directory, uuid)
+    return directory
+
+
+def remove_shared_train_matrix(directory, matrices_path, uuid):
+    '''
+    Removes the copy stored by shared_train_matrix, a train matrix stored as memmap is kept
+    '''
+    if directory == matrices_path:
+        return
+    for filename in matrix_store.memmap_filenames(directory, uuid):
+        if os.path.isfile(filename):
+            os.remove(filename)
+    if not os.listdir(directory):
+        os.rmdir(directory)
+
+
+def fit_model(directory, uuid, class_path, parameters):
+    '''
+    Fits one model of the grid on the memmapped train matrix, as triage's ModelTrainer does
+    '''
+    train_df = matrix_store.load_memmap(directory, uuid)
+    if 'as_of_date' in train_df.columns:
+        del train_df['as_of_date']
+
+    module_name, class_name = class_path.rsplit('.', 1)
+    model = getattr(importlib.import_module(module_name), class_name)(**parameters)
+    return model.fit(train_df.iloc[:, :-1], train_df.iloc[:, -1].values.astype(np.int64))
+
+
+def fit_grid(grid_config, directory, uuid, n_processes):
+    '''
+    Fits every model of the grid in a pool of n_processes reading the same memmapped train matrix
+    Returns:
+        dict of the fitted models keyed by CheckpointLedger.model_group_key
+    '''
+    start = time.time()
+    fitted_models = {}
+    with ProcessPoolExecutor(max_workers=n_processes) as executor:
+        futures = {}
+        for class_path, parameter_config in grid_config.items():
+            for parameters in ParameterGrid(parameter_config):
+                key = CheckpointLedger.model_group_key(class_path, parameters)
+                futures[key] = executor.submit(fit_model, directory, uuid, class_path, parameters)
+        for key, future in futures.items():
+            fitted_models[key] = future.result()
+
+    log.info('Fitted {} models with {} processes in {:.1f}s'.format(len(fitted_models), n_processes,
+                                                                   time.time() - start))
+    return fitted_models
+
+
+class PrefitModelTrainer(ModelTrainer):
+    """
+    triage ModelTrainer storing the models fitted by fit_grid instead of fitting them again
+    """
+
+    def __init__(self, fitted_models, **kwargs):
+        super().__init__(**kwargs)
+        self.fitted_models = fitted_models
+
+    def _train(self, class_path, parameters):
+        key = CheckpointLedger.model_group_key(class_path, parameters)
+        if key not in self.fitted_models:
+            return super()._train(class_path, parameters)
+        return self.fitted_models.pop(key), self.matrix_store.matrix.columns
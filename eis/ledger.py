@@ -0,0 +1,79 @@
+import hashlib
+import json
+import logging
+import os
+import socket
+
+from sklearn.grid_search import ParameterGrid
+
+log = logging.getLogger(__name__)
+
+
+class CheckpointLedger():
+    """
+    File based ledger of the completed units of an experiment. A unit is the testing of one
+    model group trained on one train matrix for one test date, stored as
+        project_path/checkpoints/<experiment_hash>/<train_matrix_uuid>/<model_group_key>/<test_date>.json
+    One file per unit keeps concurrent workers (and hosts sharing project_path) from
+    stepping on each other.
+    """
+
+    def __init__(self, project_path, experiment_hash):
+        self.experiment_hash = experiment_hash
+        self.path = os.path.join(project_path, 'checkpoints', experiment_hash)
+
+    @staticmethod
+    def model_group_key(class_path, parameters):
+        '''
+        Stable key of a model group of a given train matrix (the blocks are fixed by the matrix),
+        the database model_group_id is only known after the model has been fitted
+        '''
+        key = json.dumps([class_path, parameters], sort_keys=True)
+        return hashlib.md5(key.encode('utf-8')).hexdigest()
+
+    def _unit_path(self, train_matrix_uuid, model_group_key, test_date):
+        return os.path.join(self.path, train_matrix_uuid, model_group_key, '{}.json'.format(test_date))
+
+    def _write(self, filename, info):
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        tmp_filename = '{}.{}.{}.tmp'.format(filename, socket.gethostname(), os.getpid())
+        with open(tmp_filename, 'w') as f:
+            json.dump(info, f, sort_keys=True)
+        os.rename(tmp_filename, filename)
+
+    def is_done(self, train_matrix_uuid, model_group_key, test_date):
+        return os.path.isfile(self._unit_path(train_matrix_uuid, model_group_key, test_date))
+
+    def mark_done(self, train_matrix_uuid, model_group_key, test_date, **info):
+        info.update({'train_matrix_uuid': train_matrix_uuid,
+                     'model_group_key': model_group_key,
+                     'test_date': test_date})
+        self._write(self._unit_path(train_matrix_uuid, model_group_key, test_date), info)
+
+    def pending_grid(self, train_matrix_uuid, grid_config, test_dates):
+        '''
+        Returns the part of the grid that still has test dates to run on this train matrix,
+        in the format taken by triage's ModelTrainer (a list of single point grids per model type)
+        '''
+        pending = {}
+        n_done = 0
+        for class_path, parameter_config in grid_config.items():
+            for parameters in ParameterGrid(parameter_config):
+                key = self.model_group_key(class_path, parameters)
+                if all(self.is_done(train_matrix_uuid, key, test_date) for test_date in test_dates):
+                    n_done += 1
+                    continue
+                pending.setdefault(class_path, []).append({k: [v] for k, v in parameters.items()})
+
+        if n_done:
+            log.info('Train matrix {}: skipping {} model groups already completed'.format(train_matrix_uuid, n_done))
+        return pending
+
+    def mark_failed(self, task_id, error):
+        self._write(os.path.join(self.path, 'failed', '{}.json'.format(task_id)),
+                    {'task_id': task_id, 'error': str(error), 'host': socket.gethostname()})
+
+    def clear_failed(self, task_id):
+        filename = os.path.join(self.path, 'failed', '{}.json'.format(task_id))
+        if os.path.isfile(filename):
+            os.remove(filename)
@@ -0,0 +1,394 @@
+import hashlib
+import json
+import logging
+import os
+import shutil
+import socket
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+
+import metta.metta_io
+
+log = logging.getLogger(__name__)
+
+MATRIX_FORMATS = ('hd5', 'memmap')
+GB = 1024 ** 3
+MEMMAP_DTYPE = np.float32
+
+# the builder of a matrix touches its marker every MARKER_HEARTBEAT_SECONDS, a marker
+# left untouched for MARKER_STALE_SECONDS belongs to a dead worker
+MARKER_HEARTBEAT_SECONDS = 60
+MARKER_STALE_SECONDS = 10 * 60
+
+
+class MatrixInProgress(Exception):
+    """The matrix is being built by another worker"""
+
+
+def _dt_handler(x):
+    if hasattr(x, 'isoformat'):
+        return x.isoformat()
+    raise TypeError("Unknown type")
+
+
+def memmap_filenames(directory, uuid):
+    '''
+    Returns the (data, index, sidecar) files of a memmap matrix. The sidecar is written last
+    and marks the matrix as complete
+    '''
+    base = os.path.join(directory, uuid)
+    return base + '.f32', base + '.index.npz', base + '.memmap.json'
+
+
+def stored_format(directory, uuid):
+    '''
+    Returns the format a matrix is stored in, None if it is not stored yet
+    '''
+    if os.path.isfile(memmap_filenames(directory, uuid)[2]):
+        return 'memmap'
+    if os.path.isfile(os.path.join(directory, uuid + '.h5')):
+        return 'hd5'
+    return None
+
+
+def store_matrix(df, metadata, directory, uuid, matrix_format='hd5'):
+    if matrix_format == 'memmap':
+        store_memmap(df, metadata, directory, uuid)
+    elif matrix_format == 'hd5':
+        # archived aside and moved in place, the .h5 last since it marks the matrix as stored
+        tmp_directory = os.path.join(directory, '.{}.{}.tmp'.format(socket.gethostname(), os.getpid()))
+        os.makedirs(tmp_directory, exist_ok=True)
+        metta.metta_io.archive_matrix(matrix_config=metadata,
+                                      df_matrix=df,
+                                      directory=tmp_directory,
+                                      format='hd5')
+        for filename in sorted(os.listdir(tmp_directory), key=lambda filename: filename.endswith('.h5')):
+            os.rename(os.path.join(tmp_directory, filename), os.path.join(directory, filename))
+        shutil.rmtree(tmp_directory, ignore_errors=True)
+    else:
+        raise ValueError('Unknown matrix format {}, use one of {}'.format(matrix_format, MATRIX_FORMATS))
+
+
+def load_matrix(metadata, directory, uuid):
+    '''
+    Reads a stored matrix in whatever format it was stored
+    '''
+    if stored_format(directory, uuid) == 'memmap':
+        return load_memmap(directory, uuid)
+    return metta.metta_io.recover_matrix(metadata, directory)
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class BuildMarker():
+    """
+    In-progress marker of a matrix, <uuid>.building, holding the host and pid of its builder.
+    It is created exclusively, so only one worker builds a matrix, and kept fresh by a heartbeat
+    thread while the matrix is built. Markers of dead workers are detected by pid on the same
+    host and by their age on other hosts
+    """
+
+    def __init__(self, directory, uuid):
+        self.filename = os.path.join(directory, uuid + '.building')
+        self.info = {'host': socket.gethostname(), 'pid': os.getpid()}
+        self._stop = None
+
+    def acquire(self):
+        '''
+        Returns True if this process now builds the matrix
+        '''
+        os.makedirs(os.path.dirname(self.filename), exist_ok=True)
+        try:
+            fd = os.open(self.filename, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            return False
+        with os.fdopen(fd, 'w') as f:
+            json.dump(dict(self.info, started=time.time()), f)
+
+        self._stop = threading.Event()
+        threading.Thread(target=self._heartbeat, args=(self._stop,), daemon=True).start()
+        return True
+
+    def _heartbeat(self, stop):
+        while not stop.wait(MARKER_HEARTBEAT_SECONDS):
+            try:
+                os.utime(self.filename)
+            except FileNotFoundError:
+                return
+
+    def release(self):
+        if self._stop is not None:
+            self._stop.set()
+            self._stop = None
+            try:
+                os.remove(self.filename)
+            except FileNotFoundError:
+                pass
+
+    def _read(self, filename):
+        try:
+            with open(filename, 'r') as f:
+                return json.load(f), os.stat(filename).st_mtime
+        except (FileNotFoundError, ValueError):
+            # gone, or being written right now
+            return None, None
+
+    def holder(self):
+        return self._read(self.filename)[0]
+
+    def _is_stale(self, info, mtime):
+        if info is None:
+            return False
+        if info['host'] == self.info['host'] and not _pid_alive(info['pid']):
+            return True
+        return time.time() - mtime > MARKER_STALE_SECONDS
+
+    def break_if_stale(self):
+        '''
+        Removes the marker of a dead builder. Returns True if it was removed
+        '''
+        info, mtime = self._read(self.filename)
+        if not self._is_stale(info, mtime):
+            return False
+
+        # moved aside first, so that a fresh marker created meanwhile by another worker is put back
+        aside = '{}.stale.{}.{}'.format(self.filename, self.info['host'], self.info['pid'])
+        try:
+            os.rename(self.filename, aside)
+        except FileNotFoundError:
+            return False
+        if self._read(aside)[0] != info:
+            os.rename(aside, self.filename)
+            return False
+        os.remove(aside)
+        log.warning('Removed the marker of matrix build by dead worker {}:{}'.format(info['host'], info['pid']))
+        return True
+
+
+def store_memmap(df, metadata, directory, uuid):
+    '''
+    Stores the matrix as one float32 array in column major order, so every column is a contiguous
+    block, with the officer_id and as_of_date of the rows in a sidecar index
+    Args:
+        df (DataFrame): matrix indexed by officer_id with an as_of_date column, as built by FeatureLoader
+        metadata (dict): metadata of the matrix, kept in the json sidecar
+    '''
+    data_filename, index_filename, sidecar_filename = memmap_filenames(directory, uuid)
+    os.makedirs(directory, exist_ok=True)
+    suffix = '.{}.{}.tmp'.format(socket.gethostname(), os.getpid())
+
+    columns = [column for column in df.columns if column != 'as_of_date']
+    n_rows = len(df)
+    data = np.memmap(data_filename + suffix, dtype=MEMMAP_DTYPE, mode='w+',
+                     shape=(n_rows, max(len(columns), 1)), order='F')
+    for i, column in enumerate(columns):
+        # matrices built before float32 loading hold Decimal objects
+        data[:, i] = np.asarray(df[column].values, dtype=np.float64)
+    data.flush()
+    del data
+    os.rename(data_filename + suffix, data_filename)
+
+    as_of_dates = (pd.to_datetime(df['as_of_date']).values.astype('datetime64[s]')
+                   if 'as_of_date' in df.columns else np.array([], dtype='datetime64[s]'))
+    with open(index_filename + suffix, 'wb') as f:
+        np.savez(f, officer_id=np.asarray(df.index.values, dtype=np.int64), as_of_date=as_of_dates)
+    os.rename(index_filename + suffix, index_filename)
+
+    sidecar = {'columns': columns,
+               'n_rows': n_rows,
+               'dtype': np.dtype(MEMMAP_DTYPE).name,
+               'as_of_date_position': int(df.columns.get_loc('as_of_date')) if 'as_of_date' in df.columns else None,
+               'metadata': metadata}
+    with open(sidecar_filename + suffix, 'w') as f:
+        json.dump(sidecar, f, default=_dt_handler, sort_keys=True)
+    os.rename(sidecar_filename + suffix, sidecar_filename)
+    log.debug('Stored memmap matrix {}: {} rows x {} columns'.format(uuid, n_rows, len(columns)))
+
+
+def load_memmap(directory, uuid, columns=None):
+    '''
+    Maps a memmap matrix without reading it. Workers loading the same matrix share the
+    OS page cache, and only the pages of the columns that are used are ever read
+    Args:
+        columns (list): subset of the columns to load, all of them by default
+    Returns:
+        DataFrame laid out as the one that was stored: indexed by officer_id, as_of_date column,
+        label last. Values are float32
+    '''
+    data_filename, index_filename, sidecar_filename = memmap_filenames(directory, uuid)
+    with open(sidecar_filename, 'r') as f:
+        sidecar = json.load(f)
+
+    stored_columns = sidecar['columns']
+    data = np.memmap(data_filename, dtype=sidecar['dtype'], mode='r',
+                     shape=(sidecar['n_rows'], max(len(stored_columns), 1)), order='F')
+    with np.load(index_filename) as index:
+        officer_id = index['officer_id']
+        as_of_date = index['as_of_date'].astype('datetime64[ns]')
+
+    if columns is None:
+        df = pd.DataFrame(data[:, :len(stored_columns)], index=pd.Index(officer_id, name='officer_id'),
+                          columns=stored_columns, copy=False)
+        if sidecar['as_of_date_position'] is not None:
+            df.insert(sidecar['as_of_date_position'], 'as_of_date', as_of_date)
+        return df
+
+    # only the requested columns are touched, each one is a contiguous block of the file
+    positions = {column: i for i, column in enumerate(stored_columns)}
+    value_columns = [column for column in columns if column != 'as_of_date']
+    df = pd.DataFrame(data[:, [positions[column] for column in value_columns]],
+                      index=pd.Index(officer_id, name='officer_id'), columns=value_columns, copy=False)
+    if 'as_of_date' in columns:
+        df.insert(columns.index('as_of_date'), 'as_of_date', as_of_date)
+    return df
+
+
+class MatrixCache():
+    """
+    Decoded matrices kept in memory up to max_bytes. Every model reads the test matrices in the same
+    order, where evicting the least recently used would always evict the matrix needed next, so the
+    cache keeps the first matrices that fit and nothing is evicted: the others are decoded every time
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.matrices = OrderedDict()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        if key not in self.matrices:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return self.matrices[key][0]
+
+    def put(self, key, value, df):
+        '''
+        Args:
+            value: what get returns for the key
+            df (DataFrame): matrix in value, for measuring its size
+        '''
+        size = int(df.memory_usage(index=True, deep=True).sum())
+        if key in self.matrices:
+            self.bytes -= self.matrices.pop(key)[1]
+        if self.bytes + size > self.max_bytes:
+            return
+        self.matrices[key] = (value, size)
+        self.bytes += size
+
+    def stats(self):
+        return '{} hits, {} misses, {} matrices in {:.2f}GB'.format(self.hits, self.misses, len(self.matrices),
+                                                                     self.bytes / GB)
+
+
+class FragmentStore():
+    """
+    Rows of the matrices of one feature and label definition, stored per as_of_date next to the definition:
+        matrices_path/fragments/<definition hash>/<as_of_date>.pkl
+        matrices_path/fragments/<definition hash>/definition.json
+    Overlapping train windows, nested train sizes and features frequencies share their as_of_dates,
+    so a matrix is assembled from the fragments already built and only the missing dates are queried
+    """
+
+    def __init__(self, directory, definition):
+        '''
+        Args:
+            directory (str): matrices directory
+            definition (dict): everything but the as_of_dates that determines the rows of a matrix
+                               (blocks, features, labels, windows)
+        '''
+        self.definition = definition
+        self.key = hashlib.md5(json.dumps(definition, sort_keys=True, default=str).encode()).hexdigest()
+        self.path = os.path.join(directory, 'fragments', self.key)
+
+    def _filename(self, as_of_date):
+        return os.path.join(self.path, '{}.pkl'.format(as_of_date))
+
+    def missing(self, as_of_dates):
+        return [as_of_date for as_of_date in as_of_dates if not os.path.isfile(self._filename(as_of_date))]
+
+    def store(self, df, as_of_dates):
+        '''
+        Splits a matrix by as_of_date and stores a fragment for each date, dates without rows included
+        '''
+        os.makedirs(self.path, exist_ok=True)
+        suffix = '.{}.{}.tmp'.format(socket.gethostname(), os.getpid())
+        definition_filename = os.path.join(self.path, 'definition.json')
+        if not os.path.isfile(definition_filename):
+            # read by clear_fragments to find the fragments of a rebuilt table
+            with open(definition_filename + suffix, 'w') as f:
+                json.dump(self.definition, f, sort_keys=True, default=str)
+            os.rename(definition_filename + suffix, definition_filename)
+        row_dates = pd.to_datetime(df['as_of_date'])
+        for as_of_date in as_of_dates:
+            filename = self._filename(as_of_date)
+            df[(row_dates == pd.Timestamp(as_of_date)).values].to_pickle(filename + suffix)
+            os.rename(filename + suffix, filename)
+
+    def get_dataset(self, as_of_dates, build):
+        '''
+        Returns the matrix of the as_of_dates, calling build(missing_as_of_dates) once for the dates
+        that have no fragment yet. The rows are ordered by as_of_date, in the order of as_of_dates
+        '''
+        missing = self.missing(as_of_dates)
+        # the built matrix is not kept as fragments in memory, only written out
+        parts = []
+        for as_of_date in as_of_dates:
+            if as_of_date in missing:
+                continue
+            try:
+                parts.append(pd.read_pickle(self._filename(as_of_date)))
+            except (IOError, OSError):
+                # removed by clear_fragments since it was listed
+                log.warning('Fragment {} of {} vanished, building it again'.format(as_of_date, self.key))
+                missing.append(as_of_date)
+        log.info('Matrix assembled from {} stored fragments and {} queried as_of_dates'
+                 .format(len(as_of_dates) - len(missing), len(missing)))
+        if missing:
+            built = build(missing)
+            self.store(built, missing)
+            parts.append(built)
+        dataset = parts[0] if len(parts) == 1 else pd.concat(parts)
+        positions = pd.Index(pd.to_datetime(as_of_dates)).get_indexer(pd.to_datetime(dataset['as_of_date']))
+        order = np.argsort(positions, kind='mergesort')
+        if (order != np.arange(len(order))).any():
+            dataset = dataset.iloc[order]
+        return dataset
+
+
+def clear_fragments(directory, schema_name=None, labels_table_name=None):
+    '''
+    Removes the fragments of the definitions that read a rebuilt feature schema or labels table, their rows are
+    stale. Fragments without a definition are removed too
+    Args:
+        directory (str): matrices directory
+        schema_name (str): rebuilt schema of the feature blocks
+        labels_table_name (str): rebuilt labels table
+    '''
+    path = os.path.join(directory, 'fragments')
+    if not os.path.isdir(path):
+        return
+    for key in os.listdir(path):
+        definition_filename = os.path.join(path, key, 'definition.json')
+        if os.path.isfile(definition_filename):
+            with open(definition_filename, 'r') as f:
+                definition = json.load(f)
+            if ((schema_name is None or definition.get('schema_name') != schema_name) and
+                    (labels_table_name is None or definition.get('labels_table_name') != labels_table_name)):
+                continue
+        shutil.rmtree(os.path.join(path, key), ignore_errors=True)
+        log.info('Removed the matrix fragments of {}'.format(key))
@@ -0,0 +1,101 @@
+import json
+import logging
+import os
+import socket
+from datetime import datetime
+
+import joblib
+from dateutil.relativedelta import relativedelta
+
+from . import utils
+
+log = logging.getLogger(__name__)
+
+
+class ModelArtifactStore():
+    """
+    Disk backed store of fitted models keyed by (model_group_id, train_matrix_uuid).
+    Each model is a compressed joblib pickle with a json sidecar describing it:
+        project_path/model_artifacts/<schema>/<model_group_id>/<train_matrix_uuid>.pkl.z
+        project_path/model_artifacts/<schema>/<model_group_id>/<train_matrix_uuid>.json
+    The model_id and model_hash of a sidecar refer to the models table of schema, so the experiments
+    (results) and production never share their models
+    """
+
+    def __init__(self, project_path, schema='results', compress=3):
+        '''
+        Args:
+            schema (str): schema of the models table the stored models are registered in
+        '''
+        self.schema = schema
+        self.path = os.path.join(project_path, 'model_artifacts', schema)
+        self.compress = compress
+
+    def _filename(self, model_group_id, train_matrix_uuid, extension):
+        return os.path.join(self.path, str(model_group_id), '{}.{}'.format(train_matrix_uuid, extension))
+
+    def exists(self, model_group_id, train_matrix_uuid):
+        return os.path.isfile(self._filename(model_group_id, train_matrix_uuid, 'json'))
+
+    def save(self, model_group_id, train_matrix_uuid, model, **info):
+        '''
+        Stores the fitted model, the sidecar is written last so a half written
+        model is never picked up by another process
+        Args:
+            info: json serializable description of the model (model_id, model_hash, train_end_date, ...)
+        '''
+        model_filename = self._filename(model_group_id, train_matrix_uuid, 'pkl.z')
+        os.makedirs(os.path.dirname(model_filename), exist_ok=True)
+        suffix = '.{}.{}.tmp'.format(socket.gethostname(), os.getpid())
+
+        joblib.dump(model, model_filename + suffix, compress=self.compress)
+        os.rename(model_filename + suffix, model_filename)
+
+        info.update({'model_group_id': model_group_id,
+                     'train_matrix_uuid': train_matrix_uuid,
+                     'schema': self.schema})
+        info_filename = self._filename(model_group_id, train_matrix_uuid, 'json')
+        with open(info_filename + suffix, 'w') as f:
+            json.dump(info, f, sort_keys=True)
+        os.rename(info_filename + suffix, info_filename)
+        log.info('Stored model {} of model group {} trained on matrix {}'.format(info.get('model_id'),
+                                                                                 model_group_id,
+                                                                                 train_matrix_uuid))
+
+    def load(self, model_group_id, train_matrix_uuid):
+        return joblib.load(self._filename(model_group_id, train_matrix_uuid, 'pkl.z'))
+
+    def artifacts(self, model_group_id):
+        '''
+        Returns the sidecar info of all the stored models of a model group
+        '''
+        group_path = os.path.join(self.path, str(model_group_id))
+        if not os.path.isdir(group_path):
+            return []
+
+        artifacts = []
+        for filename in os.listdir(group_path):
+            if filename.endswith('.json'):
+                with open(os.path.join(group_path, filename), 'r') as f:
+                    artifacts.append(json.load(f))
+        return artifacts
+
+    def find_fresh(self, model_group_id, train_end_date, update_window):
+        '''
+        Returns the info of the most recent model of the group whose train matrix is still
+        valid, ie. it ends less than update_window before train_end_date. None if the
+        model has to be retrained
+        Args:
+            train_end_date (str): end date of the train matrix required for scoring, 'Y-m-d'
+            update_window (str): how often the model is retrained eg: '1m'
+        '''
+        window_delta = relativedelta(**utils.relative_deltas_conditions([update_window])[update_window])
+        oldest_valid = datetime.strptime(train_end_date, "%Y-%m-%d") - window_delta
+
+        fresh = [artifact for artifact in self.artifacts(model_group_id)
+                 if artifact.get('schema') == self.schema
+                 and oldest_valid < datetime.strptime(artifact['train_end_date'], "%Y-%m-%d")
+                 <= datetime.strptime(train_end_date, "%Y-%m-%d")]
+        if not fresh:
+            return None
+        return max(fresh, key=lambda artifact: artifact['train_end_date'])
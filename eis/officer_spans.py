@@ -0,0 +1,166 @@
+import logging
+import time
+
+log = logging.getLogger(__name__)
+
+# An officer is active at as_of_date when an event of staging.events_hub falls in
+# (as_of_date - activity_window, as_of_date], and sworn once a sworn role of staging.officer_roles started.
+# Both are stored as [span_start, span_end) intervals so the active officers of any list of as_of_dates
+# is a range join instead of two index probes per (officer, as_of_date)
+ACTIVITY_TABLE = 'features.officer_activity_spans'
+SWORN_TABLE = 'features.officer_sworn_spans'
+STATE_TABLE = 'features.officer_spans_state'
+
+CREATE_QUERIES = [
+    "CREATE TABLE IF NOT EXISTS {} ( "
+    "   activity_window      text, "
+    "   officer_id           int, "
+    "   span_start           timestamp, "
+    "   span_end             timestamp)".format(ACTIVITY_TABLE),
+    "CREATE INDEX IF NOT EXISTS officer_activity_spans_window_idx ON {} (activity_window, span_start)"
+    .format(ACTIVITY_TABLE),
+    "CREATE INDEX IF NOT EXISTS officer_activity_spans_officer_idx ON {} (activity_window, officer_id)"
+    .format(ACTIVITY_TABLE),
+    "CREATE TABLE IF NOT EXISTS {} ( "
+    "   officer_id           int PRIMARY KEY, "
+    "   span_start           timestamp, "
+    "   span_end             timestamp)".format(SWORN_TABLE),
+    # last_moddate and number of rows of staging.events_hub when the spans of the window were built
+    "CREATE TABLE IF NOT EXISTS {} ( "
+    "   activity_window      text PRIMARY KEY, "
+    "   last_moddate         timestamp, "
+    "   n_events             bigint, "
+    "   refreshed            timestamp)".format(STATE_TABLE)]
+
+
+def query_activity_spans(window, officer_filter=''):
+    '''
+    Returns the query inserting the activity spans of the window: the events of an officer are sorted and a
+    new span starts at every event later than the previous event + window, a span ends at its last event + window
+    Args:
+        officer_filter (str): condition restricting the officers whose spans are built
+    '''
+    return ("INSERT INTO {table} (activity_window, officer_id, span_start, span_end) "
+            " SELECT '{window}', officer_id, min(event_datetime), max(event_datetime) + INTERVAL '{window}' "
+            " FROM ( "
+            "     SELECT officer_id, event_datetime, "
+            "            sum(new_span) OVER (PARTITION BY officer_id ORDER BY event_datetime "
+            "                                ROWS UNBOUNDED PRECEDING) as span "
+            "     FROM ( "
+            "         SELECT officer_id, event_datetime, "
+            "                CASE WHEN lag(event_datetime) OVER (PARTITION BY officer_id ORDER BY event_datetime) "
+            "                          + INTERVAL '{window}' >= event_datetime THEN 0 ELSE 1 END as new_span "
+            "         FROM staging.events_hub "
+            "         WHERE officer_id IS NOT NULL "
+            "         AND event_datetime IS NOT NULL {officer_filter}) events "
+            "     ) spans "
+            " GROUP BY officer_id, span"
+            .format(table=ACTIVITY_TABLE, window=window, officer_filter=officer_filter))
+
+
+def query_sworn_spans():
+    return ("INSERT INTO {} (officer_id, span_start, span_end) "
+            " SELECT officer_id, min(job_start_date), 'infinity'::timestamp "
+            " FROM staging.officer_roles "
+            " WHERE sworn_flag = 1 "
+            " AND job_start_date IS NOT NULL "
+            " GROUP BY officer_id".format(SWORN_TABLE))
+
+
+def query_active_officers(window, as_of_dates='as_of_dates'):
+    '''
+    Returns the query of the active, sworn officers of staging.officers_hub at each as_of_date of the
+    as_of_dates relation
+    '''
+    return (" SELECT a.officer_id, d.as_of_date "
+            " FROM {as_of_dates} as d "
+            " JOIN {activity} as a "
+            "   ON a.activity_window = '{window}' "
+            "   AND d.as_of_date >= a.span_start "
+            "   AND d.as_of_date < a.span_end "
+            " JOIN {sworn} as s "
+            "   ON s.officer_id = a.officer_id "
+            "   AND d.as_of_date >= s.span_start "
+            "   AND d.as_of_date < s.span_end "
+            " JOIN staging.officers_hub as off "
+            "   ON off.officer_id = a.officer_id "
+            .format(as_of_dates=as_of_dates, activity=ACTIVITY_TABLE, sworn=SWORN_TABLE, window=window))
+
+
+def refresh(db_engine, activity_windows, full=False):
+    '''
+    Brings the span tables up to date with staging, to be run after each staging load and before building
+    matrices. The activity spans are rebuilt only for the officers with events modified since the last
+    refresh of the window (last_moddate of staging.events_hub), the sworn spans are a small aggregate and
+    are rebuilt every time. The activity spans are rebuilt for every officer when events_hub went back in
+    time or lost rows (a reloaded staging schema, deleted events), gained rows without a later last_moddate,
+    or when full is set, eg. for events moved to another officer
+    Args:
+        activity_windows (list): officer_past_activity_window values of the config, eg: ['1y']
+        full (bool): rebuild the spans of every officer
+    '''
+    start = time.time()
+    db_conn = db_engine.raw_connection()
+    cur = db_conn.cursor()
+    try:
+        for query in CREATE_QUERIES:
+            cur.execute(query)
+        # concurrent runs refresh one after the other
+        cur.execute("LOCK TABLE {} IN SHARE ROW EXCLUSIVE MODE".format(STATE_TABLE))
+
+        cur.execute("SELECT max(last_moddate), count(*) FROM staging.events_hub")
+        last_moddate, n_events = cur.fetchone()
+        for window in sorted(set(activity_windows)):
+            _refresh_activity_spans(cur, window, last_moddate, n_events, full)
+
+        cur.execute("DELETE FROM {}".format(SWORN_TABLE))
+        cur.execute(query_sworn_spans())
+
+        cur.execute("ANALYZE {}".format(ACTIVITY_TABLE))
+        cur.execute("ANALYZE {}".format(SWORN_TABLE))
+        db_conn.commit()
+    except Exception:
+        db_conn.rollback()
+        raise
+    finally:
+        cur.close()
+        db_conn.close()
+    log.info('Refreshed the officer spans of windows {} in {:.1f}s'.format(sorted(set(activity_windows)),
+                                                                          time.time() - start))
+
+
+def _refresh_activity_spans(cur, window, last_moddate, n_events, full):
+    cur.execute("SELECT last_moddate, n_events FROM {} WHERE activity_window = %s".format(STATE_TABLE), (window,))
+    state = cur.fetchone()
+    built_until = None if full or state is None else state[0]
+
+    if built_until is not None and (last_moddate is None or last_moddate < built_until
+                                    or state[1] is None or n_events < state[1]):
+        log.warning('staging.events_hub went back in time or lost rows since the officer activity spans of {} '
+                    'were built, rebuilding them'.format(window))
+        built_until = None
+
+    if built_until is not None and built_until == last_moddate:
+        if n_events == state[1]:
+            log.debug('Officer activity spans of {} are up to date'.format(window))
+            return
+        # events were added without a later last_moddate, the officers they belong to are not known
+        log.warning('staging.events_hub gained rows without a later last_moddate since the officer activity '
+                    'spans of {} were built, rebuilding them'.format(window))
+        built_until = None
+
+    if built_until is None:
+        log.info('Building the officer activity spans of {}'.format(window))
+        cur.execute("DELETE FROM {} WHERE activity_window = %s".format(ACTIVITY_TABLE), (window,))
+        cur.execute(query_activity_spans(window))
+    else:
+        changed_officers = "SELECT DISTINCT officer_id FROM staging.events_hub WHERE last_moddate > %s"
+        cur.execute("DELETE FROM {} WHERE activity_window = %s AND officer_id IN ({})"
+                    .format(ACTIVITY_TABLE, changed_officers), (window, built_until))
+        cur.execute(query_activity_spans(window, 'AND officer_id IN ({})'.format(changed_officers)), (built_until,))
+        log.info('Rebuilt {} officer activity spans of {} from the events modified after {}'
+                 .format(cur.rowcount, window, built_until))
+
+    cur.execute("DELETE FROM {} WHERE activity_window = %s".format(STATE_TABLE), (window,))
+    cur.execute("INSERT INTO {} (activity_window, last_moddate, n_events, refreshed) VALUES (%s, %s, %s, now())"
+                .format(STATE_TABLE), (window, last_moddate, n_events))
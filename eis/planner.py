@@ -0,0 +1,144 @@
+import logging
+from collections import OrderedDict
+
+import metta.metta_io
+
+log = logging.getLogger(__name__)
+
+
+class MatrixNode():
+    """A unique matrix of the experiment, addressed by its metta uuid"""
+
+    def __init__(self, uuid, kind, metadata, as_of_dates, temporal_set, blocks, features_list):
+        '''
+        Args:
+            uuid (str): metta uuid of the matrix
+            kind (str): 'train' or 'test'
+            metadata (dict): metadata used for archiving the matrix
+            as_of_dates (list): as_of_dates of the rows in the matrix
+            temporal_set (dict): temporal set of the first task that uses the matrix
+            blocks (list): feature blocks of the matrix
+            features_list (list): features of the blocks, computed once per block set
+        '''
+        self.uuid = uuid
+        self.kind = kind
+        self.metadata = metadata
+        self.as_of_dates = as_of_dates
+        self.temporal_set = temporal_set
+        self.blocks = blocks
+        self.features_list = features_list
+        self.consumers = []
+
+    def cells(self, n_officers):
+        '''
+        Upper bound of the number of values in the matrix, (officers x as_of_dates) x (features + label)
+        '''
+        return n_officers * len(self.as_of_dates) * (len(self.features_list) + 1)
+
+
+class TrainTask():
+    """Training and testing of the grid for one (temporal_set, blocks) pair"""
+
+    def __init__(self, task_id, temporal_set, blocks, features_list, train_uuid, test_uuids):
+        self.task_id = task_id
+        self.temporal_set = temporal_set
+        self.blocks = blocks
+        self.features_list = features_list
+        self.train_uuid = train_uuid
+        self.test_uuids = test_uuids
+
+
+class TaskGroup():
+    """All the tasks that consume the same train matrix, to be run on the same worker"""
+
+    def __init__(self, train_matrix, tasks):
+        self.train_matrix = train_matrix
+        self.tasks = tasks
+
+    @property
+    def train_uuid(self):
+        return self.train_matrix.uuid
+
+
+class ExperimentPlan():
+    """
+    DAG of the unique matrices of an experiment and the training tasks that consume them.
+    Every matrix appears once, no matter how many (temporal_set, blocks) pairs need it.
+    """
+
+    def __init__(self):
+        self.matrices = OrderedDict()
+        self.tasks = []
+
+    def _add_matrix(self, kind, metadata, as_of_dates, task):
+        uuid = metta.metta_io.generate_uuid(metadata)
+        if uuid not in self.matrices:
+            self.matrices[uuid] = MatrixNode(uuid, kind, metadata, as_of_dates,
+                                             task.temporal_set, task.blocks, task.features_list)
+        self.matrices[uuid].consumers.append(task.task_id)
+        return uuid
+
+    def add_task(self, run_model):
+        '''
+        Adds the task described by an (offline) RunModels instance and registers its matrices
+        '''
+        temporal_set = run_model.temporal_split
+        task = TrainTask(len(self.tasks), temporal_set, run_model.blocks, run_model.features_list, None, [])
+
+        task.train_uuid = self._add_matrix('train', run_model.train_metadata(),
+                                           temporal_set['train_as_of_dates'], task)
+        for test_date in temporal_set['test_as_of_dates']:
+            task.test_uuids.append(self._add_matrix('test', run_model.test_metadata(test_date),
+                                                    [test_date], task))
+        self.tasks.append(task)
+        return task
+
+    def train_matrices(self):
+        return [node for node in self.matrices.values() if node.kind == 'train']
+
+    def test_matrices(self):
+        return [node for node in self.matrices.values() if node.kind == 'test']
+
+    def task_groups(self):
+        '''
+        Returns the tasks grouped by train matrix, largest groups first so that
+        the longest running workers start as early as possible
+        '''
+        groups = OrderedDict()
+        for task in self.tasks:
+            groups.setdefault(task.train_uuid, []).append(task)
+
+        task_groups = [TaskGroup(self.matrices[uuid], tasks) for uuid, tasks in groups.items()]
+        return sorted(task_groups, key=lambda group: len(group.tasks), reverse=True)
+
+    def summary(self):
+        n_tasks = len(self.tasks)
+        n_test_references = sum(len(task.test_uuids) for task in self.tasks)
+        return {'tasks': n_tasks,
+                'train_matrices': len(self.train_matrices()),
+                'test_matrices': len(self.test_matrices()),
+                'matrix_references': n_tasks + n_test_references}
+
+
+def build_plan(temporal_sets, block_sets, make_run_model):
+    '''
+    Expands all temporal sets and block sets and computes the uuid of every matrix
+    Args:
+        temporal_sets (list): output of utils.generate_temporal_info
+        block_sets (list): output of utils.feature_blocks_sets
+        make_run_model (callable): make_run_model(temporal_set, blocks, features_list) returns a
+                                   RunModels; the features list is None for the first call of a block set
+    Returns:
+        ExperimentPlan
+    '''
+    plan = ExperimentPlan()
+    features_lists = {}
+    for blocks in block_sets:
+        block_key = tuple(sorted(blocks))
+        for temporal_set in temporal_sets:
+            run_model = make_run_model(temporal_set, blocks, features_lists.get(block_key))
+            features_lists[block_key] = run_model.features_list
+            plan.add_task(run_model)
+
+    log.info('Experiment plan: {}'.format(plan.summary()))
+    return plan
@@ -4,7 +4,10 @@ import threading
 from itertools import product
 import datetime
 import logging
+import os
 
+from . import feature_catalog
+from . import matrix_store
 from . import setup_environment
 from . import utils
 from .features import class_map
@@ -13,13 +16,14 @@ from .features import officers_collate
 log = logging.getLogger(__name__)
 
 
-def populate_features_table(config, schema):
+def populate_features_table(config, schema, as_of_dates=None):
     """Calculate values for all features which are set to True (in the config file) 
     for the appropriate run type (officer/dispatch)
     """
     engine = setup_environment.get_database()
+    matrix_store.clear_fragments(os.path.join(config['project_path'], 'matrices'), schema_name=schema)
     if config['unit'] == 'officer':
-        populate_officer_features_table(config, schema, engine)
+        populate_officer_features_table(config, schema, engine, as_of_dates)
 
 
 def populate_dispatch_features_table(config, table_name, engine):
@@ -156,7 +160,7 @@ def add_feature_indexes(engine, list_prefixes, schema):
         engine.execute(create_officer_index)
 
 
-def populate_officer_features_table(config, schema, engine):
+def populate_officer_features_table(config, schema, engine, as_of_dates=None):
     """
      Calculate all the feature values and store them in the features table in the database
      using collate method that creates a table of feature for each block and stores them in a 
@@ -166,10 +170,12 @@ def populate_officer_features_table(config, schema, engine):
         config: Python dict read in from YAML config file containing
                 user-supplied details of the experiments to be run
         schema: schama name for storing collate tables
+        as_of_dates: as_of_dates to build, by default all the dates required by the temporal config
      """
     temporal_info = config['temporal_info'].copy()
     # get the list of fake todays specified by the config file
-    as_of_dates = utils.generate_feature_dates(temporal_info)
+    if as_of_dates is None:
+        as_of_dates = utils.generate_feature_dates(temporal_info)
     log.debug(as_of_dates)
 
     list_prefixes = []
@@ -188,6 +194,8 @@ def populate_officer_features_table(config, schema, engine):
         # Build collate tables and returns table name
         block_class.build_collate(engine, as_of_dates, feature_list, schema)
         block_class.build_post_features(engine, feature_list, schema)
+        # the columns of the schema changed
+        feature_catalog.invalidate(schema, os.path.join(config['project_path'], 'matrices'))
         list_prefixes.extend(block_class.prefix)
 
     # Join all tables into one
@@ -4,7 +4,9 @@ import threading
 from itertools import product
 import datetime
 import logging
+import os
 
+from . import matrix_store
 from . import setup_environment
 
 log = logging.getLogger(__name__)
@@ -26,6 +28,7 @@ def populate_labels_table(config, labels_config, table_name):
     for the appropriate run type (officer/dispatch)
     """
     engine = setup_environment.get_database()
+    matrix_store.clear_fragments(os.path.join(config['project_path'], 'matrices'), labels_table_name=table_name)
     if config['unit'] == 'officer':
         populate_officer_labels_table(config, labels_config, table_name, engine)
 
@@ -0,0 +1,211 @@
+import io
+import logging
+import queue
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+
+log = logging.getLogger(__name__)
+
+# seconds between two throughput logs of the background writer
+STATS_LOG_SECONDS = 60
+
+# columns written to each results table and the column holding the test date
+TABLES = {'evaluations': (['model_id', 'metric', 'parameter', 'value', 'comment',
+                           'evaluation_start_time', 'evaluation_end_time'], 'evaluation_start_time'),
+          'predictions': (['model_id', 'as_of_date', 'entity_id', 'score', 'label_value',
+                           'rank_abs', 'rank_pct', 'matrix_uuid'], 'as_of_date'),
+          'individual_importances': (['model_id', 'as_of_date', 'entity_id',
+                                      'risk_1', 'risk_2', 'risk_3', 'risk_4', 'risk_5'], 'as_of_date')}
+
+
+def evaluation_rows(model_id, test_date, all_metrics):
+    '''
+    Rows of the evaluations table for the output of scoring.calculate_all_evaluation_metrics
+    Args:
+        all_metrics (dict): values keyed by "metric|parameter|comment", parameter and comment optional
+    '''
+    rows = []
+    for key, evaluation in all_metrics.items():
+        parts = key.split('|')
+        # a missing parameter has always been stored as the text 'Null'
+        parameter = parts[1] if len(parts) > 1 and parts[1] != '' else 'Null'
+        comment = parts[2] if len(parts) > 2 else None
+        # round to 10 digits to avoid underflow errors
+        rows.append((model_id, parts[0], parameter, round(float(evaluation), 10), comment, test_date, test_date))
+    return pd.DataFrame(rows, columns=TABLES['evaluations'][0])
+
+
+def prediction_rows(model_id, as_of_date, entity_ids, scores, labels, matrix_uuid):
+    '''
+    Rows of the predictions table for the scores of one as_of_date
+    Args:
+        entity_ids (list): officer ids of the scored matrix
+        scores (list): risk scores
+        labels (list): labels of the scored matrix
+        matrix_uuid (str): uuid of the scored matrix
+    '''
+    rows = pd.DataFrame({'model_id': model_id,
+                         'as_of_date': as_of_date,
+                         'entity_id': np.asarray(entity_ids, dtype=np.int64),
+                         'score': np.asarray(scores, dtype=float),
+                         'label_value': pd.Series([int(label) if label == label else None for label in labels],
+                                                  dtype=object).values,
+                         'matrix_uuid': matrix_uuid})
+
+    # ranked within the as_of_date
+    rows['rank_abs'] = rows['score'].rank(method='dense', ascending=False).astype(int)
+    rows['rank_pct'] = rows['score'].rank(method='dense', ascending=False, pct=True)
+    return rows
+
+
+class ResultsWriter():
+    """
+    Buffers the rows of the results tables (evaluations, predictions, individual_importances) and
+    writes them with COPY. A flush replaces the rows of every (model, test date) in the buffer, the
+    DELETE and the COPY of all the tables in a single transaction.
+
+    With max_pending > 0 the writes are done behind the caller by a background thread: flush hands the
+    buffer over and returns, and only blocks while max_pending flushes are already waiting. A failed
+    write is raised by the next flush or by close, the flushes queued after it are dropped
+    """
+
+    def __init__(self, db_engine, schema='results', max_pending=0):
+        '''
+        Args:
+            schema (str): 'results', or 'production' when scoring
+            max_pending (int): flushes waiting for the background thread, 0 writes synchronously
+        '''
+        self.db_engine = db_engine
+        self.schema = schema
+        self.max_pending = max_pending
+        self.buffer = OrderedDict()
+        self.rows_written = 0
+        self.seconds_writing = 0.
+        self.seconds_blocked = 0.
+        self._pending = None
+        self._thread = None
+        self._error = None
+        self._last_stats = time.time()
+
+    def add(self, table, rows):
+        '''
+        Args:
+            table (str): one of TABLES
+            rows (DataFrame): rows with at least the columns of the table
+        '''
+        if table not in TABLES:
+            raise ValueError('Unknown results table {}'.format(table))
+        self.buffer.setdefault(table, []).append(rows)
+
+    def __len__(self):
+        return sum(len(rows) for frames in self.buffer.values() for rows in frames)
+
+    def flush(self, on_written=None):
+        '''
+        Writes the buffered rows
+        Args:
+            on_written (callable): called once the rows are committed, e.g. to mark the test date as done
+        '''
+        buffer, self.buffer = self.buffer, OrderedDict()
+        if not self.max_pending:
+            self._write(buffer)
+            if on_written is not None:
+                on_written()
+            return
+
+        self._raise_error()
+        if self._thread is None:
+            self._pending = queue.Queue(maxsize=self.max_pending)
+            self._thread = threading.Thread(target=self._write_behind, name='results-writer', daemon=True)
+            self._thread.start()
+        start = time.time()
+        self._pending.put((buffer, on_written))
+        self.seconds_blocked += time.time() - start
+
+    def close(self, raise_error=True):
+        '''
+        Waits for the queued flushes and stops the background thread. Rows added since the last flush
+        are dropped, they belong to a (model, test date) that did not finish
+        Args:
+            raise_error (bool): False when closing while an error of the caller propagates, a failed write
+                                is then only logged and does not replace that error
+        '''
+        self.buffer = OrderedDict()
+        if self._thread is not None:
+            self._pending.put(None)
+            self._thread.join()
+            self._thread = None
+            self._log_stats()
+        if raise_error:
+            self._raise_error()
+        self._error = None
+
+    def _raise_error(self):
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise error
+
+    def _write_behind(self):
+        while True:
+            pending = self._pending.get()
+            if pending is None:
+                return
+            if self._error is not None:
+                # results after a failed write are dropped, their dates are not marked as done
+                continue
+            buffer, on_written = pending
+            try:
+                self._write(buffer)
+                if on_written is not None:
+                    on_written()
+            except Exception as e:
+                log.exception('Results writer failed')
+                self._error = e
+            if time.time() - self._last_stats > STATS_LOG_SECONDS:
+                self._log_stats()
+
+    def _log_stats(self):
+        self._last_stats = time.time()
+        log.info('Results writer: {} rows in {:.1f}s ({:.0f} rows/s), {} flushes queued, callers blocked {:.1f}s'
+                 .format(self.rows_written, self.seconds_writing,
+                         self.rows_written / max(self.seconds_writing, 1e-9),
+                         self._pending.qsize() if self._pending is not None else 0, self.seconds_blocked))
+
+    def _write(self, buffer):
+        if not buffer:
+            return
+        start = time.time()
+        n_rows = sum(len(rows) for frames in buffer.values() for rows in frames)
+
+        db_conn = self.db_engine.raw_connection()
+        cursor = db_conn.cursor()
+        try:
+            for table, frames in buffer.items():
+                columns, date_column = TABLES[table]
+                rows = pd.concat(frames, ignore_index=True)
+                for model_id, dates in rows.groupby('model_id')[date_column].unique().items():
+                    cursor.execute("DELETE FROM {}.{} WHERE model_id = %s AND {} = ANY(%s::TIMESTAMP[])"
+                                   .format(self.schema, table, date_column),
+                                   (int(model_id), [str(date) for date in dates]))
+
+                csv = io.StringIO()
+                rows[columns].to_csv(csv, index=False, header=False, na_rep='')
+                csv.seek(0)
+                cursor.copy_expert("COPY {}.{} ({}) FROM STDIN WITH CSV NULL ''"
+                                   .format(self.schema, table, ', '.join(columns)), csv)
+            db_conn.commit()
+        except Exception:
+            db_conn.rollback()
+            raise
+        finally:
+            cursor.close()
+            db_conn.close()
+
+        seconds = time.time() - start
+        self.rows_written += n_rows
+        self.seconds_writing += seconds
+        log.debug('Wrote {} result rows to {} in {:.3f}s'.format(n_rows, self.schema, seconds))
@@ -10,6 +10,7 @@ import datetime
 import time
 import os
 import pdb
+from functools import partial
 from itertools import product
 from joblib import Parallel, delayed
 import json
@@ -17,7 +18,16 @@ import json
 from triage.storage import InMemoryModelStorageEngine
 from . import setup_environment
 from . import populate_features, populate_labels
+from . import officer_spans
 from . import utils
+from . import planner
+from .admission import MemoryAdmissionScheduler, ResourceProfile, physical_memory, GB
+from . import cost_estimate
+from .ledger import CheckpointLedger
+from .model_store import ModelArtifactStore
+from .matrix_store import MatrixInProgress
+from .work_queue import WorkQueue, work
+from . import run_models
 from .run_models import RunModels
 from triage.utils import save_experiment_and_get_hash
 from dateutil.relativedelta import relativedelta
@@ -37,6 +47,13 @@ def main(config_file_name, labels_config_file, args):
     config = utils.read_yaml(config_file_name)
     labels_config = utils.read_yaml(labels_config_file)
 
+    # Worker: run the items enqueued by a coordinator until the queue is drained
+    if args.worker:
+        work(work_queue(config), WORK_FUNCTIONS, poll_interval=config.get('worker_poll_seconds', 10),
+             retry_later=(MatrixInProgress,))
+        setup_environment.dispose_databases()
+        sys.exit()
+
     # If you specify production in the args
     if args.production:
         # print(args.modelgroup)
@@ -84,18 +101,24 @@ def main(config_file_name, labels_config_file, args):
         train_size_dict = utils.relative_deltas_conditions(train_size)
         train_size_delta = relativedelta(**train_size_dict[train_size[0]])
 
-        start_date = pd.to_datetime(args.date) - pred_wind_delta - train_size_delta
+        # Dates to score: a single --date or every day of --date-range. One model, trained on the
+        # window before the first date, scores all of them
+        first_date, last_date = args.date_range if args.date_range else (args.date, args.date)
+        scoring_days = (pd.to_datetime(last_date) - pd.to_datetime(first_date)).days
+        start_date = pd.to_datetime(first_date) - pred_wind_delta - train_size_delta
 
         prod_config['temporal_info']['start_date'] = start_date.strftime("%Y-%m-%d")
-        prod_config['temporal_info']['end_date'] = args.date
+        prod_config['temporal_info']['end_date'] = last_date
         prod_config['temporal_info']['update_window'] = [model_config['train_size']] 
-        prod_config['temporal_info']['test_time_ahead'] = ['0d']
+        prod_config['temporal_info']['test_time_ahead'] = ['{}d'.format(scoring_days)]
         prod_config['temporal_info']['test_frequency'] = ['1d']
         prod_config['temporal_info']['officer_past_activity_window'] = ['1y']
 
         # Specify number of cpus for feature building
         cpu = {'n_cpus': config['n_cpus']}
         prod_config.update(cpu)
+        # the feature catalog shared in the matrix directory is invalidated when the features are rebuilt
+        prod_config['project_path'] = config['project_path']
 
         # To generate matrices need this info
         temporal_sets = utils.generate_temporal_info(prod_config['temporal_info'])
@@ -121,31 +144,69 @@ def main(config_file_name, labels_config_file, args):
                        # config['officer_label_table_name'],
                        'grid_config': grid_config,
                        'project_path': config['project_path'],
+                       'matrix_format': config.get('matrix_format', 'hd5'),
+                       'matrix_assembly': config.get('matrix_assembly', 'client'),
+                       'matrix_fetch_threads': config.get('matrix_fetch_threads', 4),
+                       'test_matrix_cache_bytes': config.get('test_matrix_cache_gb', 2) * GB,
+                       # production tables are rebuilt daily and recent labels still change
+                       'matrix_fragments': False,
                        'misc_db_parameters': misc_db_parameters}
 
-        populate_features.populate_features_table(prod_config, config['production_schema_feature_blocks'])
+        # Reuse the stored model of the group if it was trained within the update window,
+        # then only the features of the scoring date are needed
+        train_end_date = (pd.to_datetime(first_date) - pred_wind_delta).strftime("%Y-%m-%d")
+        model_update_window = config.get('production_update_window', config['temporal_info']['update_window'][0])
+        artifact = ModelArtifactStore(config['project_path'], schema='production').find_fresh(args.modelgroup,
+                                                                                              train_end_date,
+                                                                                              model_update_window)
+        feature_dates = None
+        if artifact is not None:
+            log.info('Using stored model {} trained until {}'.format(artifact['model_id'], artifact['train_end_date']))
+            feature_dates = utils.as_of_dates_in_window(pd.to_datetime(first_date), pd.to_datetime(last_date), '1d')
+
+        # features and labels are built once for the union of the as_of_dates of all the scoring dates
+        populate_features.populate_features_table(prod_config, config['production_schema_feature_blocks'],
+                                                  as_of_dates=feature_dates)
 
         # Create labels table-> Right now the labels configuration is read from the command line and not from the database
         populate_labels.create_labels_table(config,  config['production_officer_label_table_name'])
         populate_labels.populate_labels_table(config, labels_config, config['production_officer_label_table_name'])
+        officer_spans.refresh(setup_environment.get_database(),
+                              prod_config['temporal_info']['officer_past_activity_window'],
+                              full=args.rebuild_officer_spans)
 
         log.info("Done building the features required for production use")
 
-        # build the matrices
-        Parallel(n_jobs=1, verbose=51)(delayed(generate_all_matrices)(temporal_set, blocks, **models_args)
-                                       for temporal_set, blocks in product(temporal_sets, block_sets))
-
-        log.info("Done building the matrices required for production use")
+        if args.enqueue:
+            # workers do not wait for a matrix built by another worker, they run other items meanwhile
+            models_args['wait_for_matrices'] = False
+            items = []
+            if artifact is None:
+                items += [(0, 'generate_all_matrices', (temporal_set, blocks), models_args)
+                          for temporal_set, blocks in product(temporal_sets, block_sets)]
+            items += [(1, 'apply_score_day', (temporal_set, blocks, args.modelgroup, last_date, artifact), models_args)
+                      for temporal_set, blocks in product(temporal_sets, block_sets)]
+            work_queue(config).enqueue(items)
+            setup_environment.dispose_databases()
+            sys.exit()
+
+        # build the matrices, with a stored model only the test matrix is built while scoring
+        if artifact is None:
+            Parallel(n_jobs=1, verbose=51)(delayed(generate_all_matrices)(temporal_set, blocks, **models_args)
+                                           for temporal_set, blocks in product(temporal_sets, block_sets))
+
+            log.info("Done building the matrices required for production use")
 
         # run the model
         # Run models
         db_engine = setup_environment.get_database()
 
         Parallel(n_jobs=1, verbose=51)(
-            delayed(apply_score_day)(temporal_set, blocks, args.modelgroup, args.date, **models_args)
+            delayed(apply_score_day)(temporal_set, blocks, args.modelgroup, last_date, artifact, **models_args)
             for temporal_set, blocks in product(temporal_sets, block_sets))
 
         log.info('Done running the model and storing the output')
+        setup_environment.dispose_databases()
         sys.exit()
 
     # If asked to generate features, then do that and stop.
@@ -158,6 +219,8 @@ def main(config_file_name, labels_config_file, args):
         # Populate the featuress  and labels table
         populate_features.populate_features_table(config, config["schema_feature_blocks"])
         populate_labels.populate_labels_table(config, labels_config, config['officer_label_table_name'])
+        officer_spans.refresh(setup_environment.get_database(), config['temporal_info']['officer_past_activity_window'],
+                              full=args.rebuild_officer_spans)
 
         log.info('Done creating features table')
         sys.exit()
@@ -185,31 +248,199 @@ def main(config_file_name, labels_config_file, args):
                    'labels_table_name': config['officer_label_table_name'],
                    'grid_config': grid_config,
                    'project_path': config['project_path'],
+                   'matrix_format': config.get('matrix_format', 'hd5'),
+                   'matrix_assembly': config.get('matrix_assembly', 'client'),
+                   'matrix_fetch_threads': config.get('matrix_fetch_threads', 4),
+                   'test_matrix_cache_bytes': config.get('test_matrix_cache_gb', 2) * GB,
+                   'matrix_fragments': config.get('matrix_fragments', False),
+                   'batch_predictions': config.get('batch_predictions', True),
+                   'results_write_behind': config.get('results_write_behind', 4),
+                   'grid_fit_processes': config.get('grid_fit_processes', 1),
+                   'store_models': config.get('store_models', True),
+                   'retrain_models': config.get('retrain_models', False),
                    'misc_db_parameters': misc_db_parameters}
 
     n_cups = config['n_cpus']
+    profile = ResourceProfile(os.path.join(config['project_path'], 'resource_profile.json'))
+
+    # Dry run: expand the config and estimate its cost without touching the database
+    if args.plan:
+        def offline_run_model(temporal_set, blocks, features_list):
+            return build_run_model(temporal_set, blocks,
+                                   features_list or cost_estimate.offline_features_list(config, blocks),
+                                   **models_args)
+
+        plan = planner.build_plan(temporal_sets, block_sets, offline_run_model)
+        cost_estimate.report_plan(config, plan, grid_config, profile)
+        sys.exit()
+
+    # Expand the whole grid up front so every matrix is built exactly once
+    db_engine = setup_environment.get_database()
+    # active officers of the matrices, brought up to date with staging
+    officer_spans.refresh(db_engine, config['temporal_info']['officer_past_activity_window'],
+                          full=args.rebuild_officer_spans)
+    plan = planner.build_plan(temporal_sets, block_sets,
+                              partial(build_run_model, db_engine=db_engine, **models_args))
+
+    # Coordinator: leave the plan to --worker processes, on this host or any host sharing project_path
+    if args.enqueue:
+        # test matrices first, the priority makes the workers wait for them before training
+        models_args['wait_for_matrices'] = False
+        items = [(0, 'generate_matrix', (node,), models_args) for node in plan.test_matrices()]
+        if args.generatematrices:
+            items += [(1, 'generate_matrix', (node,), models_args) for node in plan.train_matrices()]
+        else:
+            setup_experiment(config, db_engine, models_args)
+            items += [(1, 'apply_task_group', (group,), models_args) for group in plan.task_groups()]
+        work_queue(config).enqueue(items)
+        setup_environment.dispose_databases()
+        sys.exit()
+
+    # Admit tasks while their estimated peak memory fits in the budget,
+    # the rows of a matrix are bounded by the number of officers per as_of_date
+    n_officers = db_engine.execute("SELECT count(*) FROM staging.officers_hub").scalar()
+    profile.record_experiment_size(n_officers, {cost_estimate.block_set_key(task.blocks): len(task.features_list)
+                                                for task in plan.tasks})
+    memory_budget = config.get('memory_budget_gb', 0.8 * physical_memory() / GB) * GB
+    scheduler = MemoryAdmissionScheduler(n_cups, memory_budget, profile)
+
+    # test matrices are shared between many train matrices, build them first
+    test_matrices = plan.test_matrices()
+    scheduler.run(generate_matrix, test_matrices, 'matrix',
+                  [node.cells(n_officers) for node in test_matrices], **models_args)
 
     if args.generatematrices:
-        # Parallelization
-        Parallel(n_jobs=n_cups, verbose=51)(delayed(generate_all_matrices)(temporal_set, blocks, **models_args)
-                                            for temporal_set, blocks in product(temporal_sets, block_sets))
+        train_matrices = plan.train_matrices()
+        scheduler.run(generate_matrix, train_matrices, 'matrix',
+                      [node.cells(n_officers) for node in train_matrices], **models_args)
 
         log.info('Done creating all matrices')
         sys.exit()
 
+    # Run models
+    setup_experiment(config, db_engine, models_args)
+
+    # each worker builds one train matrix and runs all the tasks that use it, fitting its grid with
+    # grid_fit_processes processes of its own: n_cpus processes in all
+    task_groups = plan.task_groups()
+    n_models = cost_estimate.grid_size(grid_config)
+    failed_tasks = scheduler.run(apply_task_group, task_groups, 'train',
+                                 [group.train_matrix.cells(n_officers) for group in task_groups],
+                                 work=[group.train_matrix.cells(n_officers) * len(group.tasks) * n_models
+                                       for group in task_groups],
+                                 n_jobs=n_cups // models_args['grid_fit_processes'],
+                                 **models_args)
+    failed_tasks = [task_id for group_failed in failed_tasks for task_id in group_failed]
+    setup_environment.dispose_databases()
+    if failed_tasks:
+        log.warning('{} tasks failed: {}. Re-run the same config to resume them'.format(len(failed_tasks),
+                                                                                       failed_tasks))
+        return None
 
-        # Run models
-    db_engine = setup_environment.get_database()
-    experiment_hash = save_experiment_and_get_hash(config, db_engine)
-    models_args['experiment_hash'] = experiment_hash
+    log.info("Done!")
+    return None
 
-    Parallel(n_jobs=n_cups, verbose=5)(delayed(apply_train_test)(temporal_set, blocks, **models_args)
-                                       for temporal_set, blocks in product(temporal_sets, block_sets))
 
-    log.info("Done!")
+def setup_experiment(config, db_engine, models_args):
+    models_args['experiment_hash'] = save_experiment_and_get_hash(config, db_engine)
+
+    # skip the (train matrix, model group, test date) units completed by a previous run
+    if config.get('resume_experiment', True):
+        models_args['ledger'] = CheckpointLedger(config['project_path'], models_args['experiment_hash'])
+
+
+def work_queue(config):
+    return WorkQueue(config.get('work_queue', os.path.join(config['project_path'], 'work_queue.sqlite')),
+                     lease_seconds=config.get('work_lease_seconds', 600))
+
+
+def build_run_model(temporal_set, blocks, features_list=None, db_engine=None, **kwargs):
+    return RunModels(labels=kwargs['labels'],
+                     features=kwargs['features'],
+                     schema_name=kwargs['schema_name'],
+                     blocks=blocks,
+                     feature_lookback_duration=kwargs['feature_lookback_duration'],
+                     labels_config=kwargs['labels_config'],
+                     labels_table_name=kwargs['labels_table_name'],
+                     temporal_split=temporal_set,
+                     grid_config=kwargs['grid_config'],
+                     project_path=kwargs['project_path'],
+                     misc_db_parameters=kwargs['misc_db_parameters'],
+                     experiment_hash=kwargs.get('experiment_hash'),
+                     db_engine=db_engine,
+                     features_list=features_list,
+                     ledger=kwargs.get('ledger'),
+                     matrix_format=kwargs.get('matrix_format', 'hd5'),
+                     test_matrix_cache_bytes=kwargs.get('test_matrix_cache_bytes',
+                                                        run_models.DEFAULT_TEST_MATRIX_CACHE_BYTES),
+                     matrix_fragments=kwargs.get('matrix_fragments', False),
+                     wait_for_matrices=kwargs.get('wait_for_matrices', True),
+                     batch_predictions=kwargs.get('batch_predictions', True),
+                     results_write_behind=kwargs.get('results_write_behind', 0),
+                     grid_fit_processes=kwargs.get('grid_fit_processes', 1),
+                     model_artifacts=(ModelArtifactStore(kwargs['project_path'], schema='results')
+                                      if kwargs.get('store_models', False) else None),
+                     retrain_models=kwargs.get('retrain_models', False),
+                     matrix_assembly=kwargs.get('matrix_assembly', 'client'),
+                     matrix_fetch_threads=kwargs.get('matrix_fetch_threads', 4),
+                     results_schema=kwargs.get('results_schema', 'results'))
+
+
+def generate_matrix(node, **kwargs):
+    """
+    Builds and stores a single matrix of the experiment plan
+    """
+    try:
+        db_engine = setup_environment.get_database()
+    except:
+        log.warning('Could not connect to the database')
+        raise
+
+    run_model = build_run_model(node.temporal_set, node.blocks, node.features_list, db_engine, **kwargs)
+
+    log.info('Build {} matrix {} for as of dates: {}'.format(node.kind, node.uuid, node.as_of_dates))
+    run_model.load_store_matrix(node.metadata, node.as_of_dates, return_matrix=False)
     return None
 
 
+def apply_task_group(group, **kwargs):
+    """
+    Builds the train matrix of the group and runs all the tasks that use it.
+    A failing task is logged and recorded in the ledger without stopping the others,
+    returns the ids of the failed tasks
+    """
+    ledger = kwargs.get('ledger')
+    try:
+        generate_matrix(group.train_matrix, **kwargs)
+    except MatrixInProgress:
+        raise
+    except Exception as e:
+        log.exception('Could not build train matrix {}'.format(group.train_uuid))
+        failed = [task.task_id for task in group.tasks]
+        if ledger is not None:
+            for task_id in failed:
+                ledger.mark_failed(task_id, e)
+        return failed
+
+    log.info('Run {} tasks on train matrix {}'.format(len(group.tasks), group.train_uuid))
+    failed = []
+    for task in group.tasks:
+        try:
+            apply_train_test(task.temporal_set, task.blocks, features_list=task.features_list, **kwargs)
+        except MatrixInProgress:
+            # deferred by the work queue, completed units are skipped when it runs again
+            raise
+        except Exception as e:
+            log.exception('Task {} failed for temporal set: {}'.format(task.task_id, task.temporal_set))
+            failed.append(task.task_id)
+            if ledger is not None:
+                ledger.mark_failed(task.task_id, e)
+        else:
+            if ledger is not None:
+                ledger.clear_failed(task.task_id)
+    return failed
+
+
 def generate_all_matrices(temporal_set, blocks, **kwargs):
     # Connect to db
     try:
@@ -218,23 +449,11 @@ def generate_all_matrices(temporal_set, blocks, **kwargs):
         log.warning('Could not connect to the database')
         raise
 
-    run_model = RunModels(labels=kwargs['labels'],
-                          features=kwargs['features'],
-                          schema_name=kwargs['schema_name'],
-                          blocks=blocks,
-                          feature_lookback_duration=kwargs['feature_lookback_duration'],
-                          labels_config=kwargs['labels_config'],
-                          labels_table_name=kwargs['labels_table_name'],
-                          temporal_split=temporal_set,
-                          grid_config=kwargs['grid_config'],
-                          project_path=kwargs['project_path'],
-                          misc_db_parameters=kwargs['misc_db_parameters'],
-                          db_engine=db_engine)
+    run_model = build_run_model(temporal_set, blocks, db_engine=db_engine, **kwargs)
 
     log.info('Run models for temporal set: {}'.format(temporal_set))
     log.info('Run models for feature blocks: {}'.format(blocks))
     run_model.generate_matrices()
-    db_engine.dispose()
     return None
 
 
@@ -246,19 +465,7 @@ def apply_train_test(temporal_set, blocks, **kwargs):
         log.warning('Could not connect to the database')
         raise
 
-    run_model = RunModels(labels=kwargs['labels'],
-                          features=kwargs['features'],
-                          schema_name=kwargs['schema_name'],
-                          blocks=blocks,
-                          feature_lookback_duration=kwargs['feature_lookback_duration'],
-                          labels_config=kwargs['labels_config'],
-                          labels_table_name=kwargs['labels_table_name'],
-                          temporal_split=temporal_set,
-                          grid_config=kwargs['grid_config'],
-                          project_path=kwargs['project_path'],
-                          misc_db_parameters=kwargs['misc_db_parameters'],
-                          experiment_hash=kwargs['experiment_hash'],
-                          db_engine=db_engine)
+    run_model = build_run_model(temporal_set, blocks, db_engine=db_engine, **kwargs)
 
     log.info('Run models for temporal set: {}'.format(temporal_set))
     log.info('Run models for feature blocks: {}'.format(blocks))
@@ -270,11 +477,10 @@ def apply_train_test(temporal_set, blocks, **kwargs):
 
     log.info('Run tests')
     run_model.train_test_models(train_matrix_uuid, model_ids_generator, model_storage)
-    db_engine.dispose()
     return None
 
 
-def apply_score_day(temporal_set, blocks, chosen_model_group_id, date, **kwargs):
+def apply_score_day(temporal_set, blocks, chosen_model_group_id, date, artifact=None, **kwargs):
     # Connect to db
     try:
         db_engine = setup_environment.get_database(production=True)
@@ -282,26 +488,27 @@ def apply_score_day(temporal_set, blocks, chosen_model_group_id, date, **kwargs)
         log.warning('Could not connect to the database')
         raise
 
-    run_model = RunModels(labels=kwargs['labels'],
-                          features=kwargs['features'],
-                          schema_name=kwargs['schema_name'],
-                          blocks=blocks,
-                          feature_lookback_duration=kwargs['feature_lookback_duration'],
-                          labels_config=kwargs['labels_config'],
-                          labels_table_name=kwargs['labels_table_name'],
-                          temporal_split=temporal_set,
-                          grid_config=kwargs['grid_config'],
-                          project_path=kwargs['project_path'],
-                          misc_db_parameters=kwargs['misc_db_parameters'],
-                          db_engine=db_engine)
+    run_model = build_run_model(temporal_set, blocks, db_engine=db_engine, results_schema='production', **kwargs)
 
     log.info('Run models for temporal set: {}'.format(temporal_set))
     log.info('Run models for feature blocks: {}'.format(blocks))
 
     model_storage = InMemoryModelStorageEngine('empty')
-    train_matrix_uuid, model_ids_generator = run_model.setup_train_models(model_storage)
-    if train_matrix_uuid is None:
-        return None
+    artifact_store = ModelArtifactStore(kwargs['project_path'], schema='production')
+    if artifact is not None:
+        # no retraining, the fitted model goes straight into the storage used by the predictor
+        log.info('Load stored model {} trained on matrix {}'.format(artifact['model_id'],
+                                                                    artifact['train_matrix_uuid']))
+        model = artifact_store.load(chosen_model_group_id, artifact['train_matrix_uuid'])
+        model_storage.get_store(artifact['model_hash']).write(model)
+        model_ids_generator = [artifact['model_id']]
+    else:
+        train_matrix_uuid, model_ids_generator = run_model.setup_train_models(model_storage)
+        if train_matrix_uuid is None:
+            return None
+        model_ids_generator = store_trained_models(model_ids_generator, model_storage, artifact_store,
+                                                   chosen_model_group_id, train_matrix_uuid,
+                                                   temporal_set['train_end_date'], db_engine)
 
     log.info('Score model')
     run_model.train_score_models(model_ids_generator, model_storage)
@@ -312,20 +519,54 @@ def apply_score_day(temporal_set, blocks, chosen_model_group_id, date, **kwargs)
     conn = db_engine.raw_connection()
     conn.cursor().execute(query)
     conn.commit()
+    conn.close()
 
-    db_engine.dispose()
     return None
 
 
+def store_trained_models(model_ids_generator, model_storage, artifact_store, model_group_id, train_matrix_uuid,
+                         train_end_date, db_engine):
+    """
+    Passes the trained model ids through, storing each fitted model in the artifact store
+    before it is scored (and removed from memory)
+    """
+    for model_id in model_ids_generator:
+        query = "SELECT model_hash FROM production.models WHERE model_id = {}".format(model_id)
+        model_hash = db_engine.execute(query).fetchone()[0]
+        artifact_store.save(model_group_id, train_matrix_uuid, model_storage.get_store(model_hash).load(),
+                            model_id=model_id,
+                            model_hash=model_hash,
+                            train_end_date=train_end_date)
+        yield model_id
+
+
+# functions that enqueued work items may call
+WORK_FUNCTIONS = {'generate_matrix': generate_matrix,
+                  'apply_task_group': apply_task_group,
+                  'generate_all_matrices': generate_all_matrices,
+                  'apply_train_test': apply_train_test,
+                  'apply_score_day': apply_score_day}
+
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("--config", type=str, help="pass your config", default="default.yaml")
     parser.add_argument("--labels", type=str, help="pass your labels config", default="labels.yaml")
     parser.add_argument("--date", type=str, help="pass date")
+    parser.add_argument("--date-range", type=str, nargs=2, metavar=('START', 'END'),
+                        help="score every day from START to END with one model (production)")
     parser.add_argument("--modelgroup", type=str, help="specify model group id")
     parser.add_argument("-p", "--production", help="populate the production schemas", action='store_true')
     parser.add_argument("-b", "--buildfeatures", help="build the features and stop", action='store_true')
     parser.add_argument("-m", "--generatematrices", help="build all matrices used for running models",
                         action='store_true')
+    parser.add_argument("--plan", help="estimate the size and runtime of the config without running it",
+                        action='store_true')
+    parser.add_argument("--enqueue", help="put the work of the run in the work queue instead of running it",
+                        action='store_true')
+    parser.add_argument("--worker", help="run work items from the work queue until it is drained",
+                        action='store_true')
+    parser.add_argument("--rebuild-officer-spans", help="rebuild the active officer spans of every officer, "
+                        "eg. after events were moved to another officer in staging", action='store_true')
     args = parser.parse_args()
     main(args.config, args.labels, args)
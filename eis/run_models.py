@@ -1,26 +1,36 @@
 import datetime
+import functools
+import itertools
 import json
 import logging
-import os
+import time
 
 import numpy as np
 import pandas as pd
-from flufl.lock import Lock
 from sklearn.ensemble import ExtraTreesClassifier
 from sklearn.ensemble import RandomForestClassifier
+from sklearn.grid_search import ParameterGrid
 
 import metta.metta_io
 from triage.model_trainers import ModelTrainer
 from triage.predictors import Predictor
 from triage.storage import InMemoryMatrixStore
-from . import dataset
+from . import grid_fit
+from . import matrix_store
+from . import results_writer
 from . import scoring
 from . import setup_environment
 from . import utils
 from .feature_loader import FeatureLoader
+from .ledger import CheckpointLedger
 
 log = logging.getLogger(__name__)
 
+DEFAULT_TEST_MATRIX_CACHE_BYTES = 2 * matrix_store.GB
+MATRIX_POLL_SECONDS = 10
+# values (rows x columns) of the test matrices stacked into one prediction call
+PREDICTION_BATCH_CELLS = 50 * 1000 * 1000
+
 
 class RunModels():
     def __init__(
@@ -37,7 +47,21 @@ class RunModels():
             project_path,
             misc_db_parameters,
             experiment_hash=None,
-            db_engine=None
+            db_engine=None,
+            features_list=None,
+            ledger=None,
+            matrix_format='hd5',
+            test_matrix_cache_bytes=DEFAULT_TEST_MATRIX_CACHE_BYTES,
+            matrix_fragments=False,
+            wait_for_matrices=True,
+            batch_predictions=True,
+            results_write_behind=0,
+            grid_fit_processes=1,
+            model_artifacts=None,
+            retrain_models=False,
+            matrix_assembly='client',
+            matrix_fetch_threads=4,
+            results_schema='results'
     ):
 
         self.labels = labels
@@ -53,6 +77,25 @@ class RunModels():
         self.misc_db_parameters = misc_db_parameters
         self.experiment_hash = experiment_hash
         self.db_engine = db_engine
+        self.ledger = ledger
+        self.matrix_format = matrix_format
+        self.wait_for_matrices = wait_for_matrices
+        self.batch_predictions = batch_predictions
+        self.grid_fit_processes = grid_fit_processes
+        # fitted models are kept in the artifact store and reused by later runs on the same train matrix
+        self.model_artifacts = model_artifacts
+        self.retrain_models = retrain_models
+        # 'production' when scoring with the production engine
+        self.results_schema = results_schema
+        # results of a (model, test date) are buffered and replaced in one transaction,
+        # behind the training when results_write_behind flushes may wait for the writer thread
+        self.results_writer = results_writer.ResultsWriter(self.db_engine, self.results_schema,
+                                                           max_pending=results_write_behind)
+        if self.model_artifacts is not None and self.model_artifacts.schema != self.results_schema:
+            raise ValueError('Model artifacts of {} cannot be used with the models of {}'.format(
+                self.model_artifacts.schema, self.results_schema))
+        # every trained model is tested on the same test matrices
+        self.test_matrix_cache = matrix_store.MatrixCache(test_matrix_cache_bytes)
         self.matrices_path = self.project_path + '/matrices'
 
         # Save only used labels in labels_config
@@ -71,9 +114,33 @@ class RunModels():
                                             self.temporal_split['prediction_window'],
                                             self.temporal_split['officer_past_activity_window'],
                                             self.feature_lookback_duration,
-                                            self.db_engine
+                                            self.db_engine,
+                                            catalog_path=self.matrices_path,
+                                            assembly=matrix_assembly,
+                                            fetch_threads=matrix_fetch_threads
                                             )
-        self.features_list = self.feature_loader.features_list()
+        # the planner computes the features list once per block set and hands it over
+        if features_list is None:
+            features_list = self.feature_loader.features_list()
+        self.features_list = features_list
+
+        # metadata and uuids of the matrices are computed once per instance
+        self._metadata = {}
+        self._matrix_uuids = {}
+
+        # rows per as_of_date shared by all the matrices with the same features and labels
+        self.fragment_store = None
+        if matrix_fragments:
+            self.fragment_store = matrix_store.FragmentStore(self.matrices_path, {
+                'schema_name': self.schema_name,
+                'blocks': sorted(self.blocks),
+                'features_list': self.features_list,
+                'feature_lookback_duration': self.feature_lookback_duration,
+                'labels': self.labels,
+                'labels_config': self.labels_config,
+                'labels_table_name': self.labels_table_name,
+                'prediction_window': self.temporal_split['prediction_window'],
+                'officer_past_activity_window': self.temporal_split['officer_past_activity_window']})
 
     def dt_handler(self, x):
         if isinstance(x, datetime.datetime) or isinstance(x, datetime.date):
@@ -82,35 +149,70 @@ class RunModels():
 
     def load_store_matrix(self, metadata, as_of_dates, return_matrix=True):
         """
-        Calls get_dataset to return a pandas DataFrame for the as_of_dates selected
+        Calls get_dataset to return a pandas DataFrame for the as_of_dates selected.
+        Matrices are published atomically: the worker holding the in-progress marker builds it,
+        the others wait for it or, when wait_for_matrices is False, raise MatrixInProgress
         Args:
            list as_of_dates: as_of_dates to use
         Returns:
            matrix: dataframe with the features and the last column as the label (called: outcome)
         """
-        uuid = metta.metta_io.generate_uuid(metadata)
-        matrix_filename = self.matrices_path + '/' + uuid
+        uuid = self.matrix_uuid(metadata)
+        marker = matrix_store.BuildMarker(self.matrices_path, uuid)
 
-        with Lock(matrix_filename + '.lock', lifetime=datetime.timedelta(minutes=20)):
-            if os.path.isfile(matrix_filename + '.h5'):
+        while True:
+            # a matrix is read in whatever format it was stored
+            if matrix_store.stored_format(self.matrices_path, uuid) is not None:
                 log.debug(' Matrix {} already stored'.format(uuid))
                 if return_matrix:
-                    df = metta.metta_io.recover_matrix(metadata, self.matrices_path)
-                    return df, uuid
-
+                    df = matrix_store.load_matrix(metadata, self.matrices_path, uuid)
+                    return self._align_features(df, uuid), uuid
+                return None
+
+            if marker.acquire():
+                break
+            if marker.break_if_stale():
+                continue
+            if not self.wait_for_matrices:
+                raise matrix_store.MatrixInProgress(uuid)
+            log.debug('Matrix {} is being built by {}, waiting'.format(uuid, marker.holder()))
+            time.sleep(MATRIX_POLL_SECONDS)
+
+        try:
+            # stored by another worker between the check and the marker
+            if matrix_store.stored_format(self.matrices_path, uuid) is not None:
+                marker.release()
+                return self.load_store_matrix(metadata, as_of_dates, return_matrix)
+
+            if self.fragment_store is not None:
+                df = self.fragment_store.get_dataset(as_of_dates, self.feature_loader.get_dataset)
             else:
-
                 df = self.feature_loader.get_dataset(as_of_dates)
-                log.debug(
-                    'Start storing matrix {}, memory consumption: {}'.format(uuid, df.memory_usage(index=True).sum()))
-                metta.metta_io.archive_matrix(matrix_config=metadata,
-                                              df_matrix=df,
-                                              directory=self.matrices_path,
-                                              format='hd5')
-                log.debug('Done storing matrix {}'.format(uuid))
-
-                if return_matrix:
-                    return df, uuid
+            log.debug(
+                'Start storing matrix {}, memory consumption: {}'.format(uuid, df.memory_usage(index=True).sum()))
+            matrix_store.store_matrix(df, metadata, self.matrices_path, uuid, self.matrix_format)
+            log.debug('Done storing matrix {}'.format(uuid))
+        finally:
+            marker.release()
+
+        if return_matrix:
+            return df, uuid
+
+    def _align_features(self, df, uuid):
+        '''
+        Orders the feature columns of a stored matrix as features_list. The uuid does not depend on the order
+        of the features, and matrices stored before the features of a block were sorted hold them in another
+        order, which models would score against without any error
+        '''
+        features = [column for column in df.columns[:-1] if column != 'as_of_date']
+        if features == list(self.features_list):
+            return df
+        if sorted(features) != sorted(self.features_list):
+            raise ValueError('Matrix {} does not hold the features of its metadata'.format(uuid))
+
+        log.warning('Matrix {} is stored with another order of its features, reordered'.format(uuid))
+        index_columns = [column for column in df.columns[:1] if column == 'as_of_date']
+        return df[index_columns + list(self.features_list) + [df.columns[-1]]]
 
     def _make_metadata(self, start_time, end_time, matrix_id, as_of_dates):
 
@@ -161,6 +263,20 @@ class RunModels():
 
         return list_to_sort
 
+    def _sort_hashable_list(self, l):
+        '''
+        Same order as __sorting_multiple_types, so matrix uuids do not change, in O(n log n) when all the
+        elements have the same plain type (feature names, as_of_dates, labels). Elements that compare equal
+        are identical there, so the instability of the selection sort does not show
+        '''
+        types = set(type(e) for e in l)
+        if len(types) == 1 and types.pop() in (str, list, datetime.datetime, datetime.date):
+            try:
+                return sorted(l)
+            except TypeError:
+                pass
+        return self.__sorting_multiple_types(l)
+
     def _make_hashable(self, o):
         if isinstance(o, (tuple, list)):
             l = []
@@ -175,7 +291,7 @@ class RunModels():
                 else:
                     l.append(e)
 
-            return self.__sorting_multiple_types(l)
+            return self._sort_hashable_list(l)
 
         if isinstance(o, dict):
             return {k: self._make_hashable(o[k]) for k in sorted(o)}
@@ -185,50 +301,78 @@ class RunModels():
 
         return o
 
-    def generate_matrices(self):
-
-        train_matrix_id = str([sorted(self.temporal_split['train_as_of_dates']),
-                               self.labels,
-                               self.temporal_split['prediction_window']])
-
-        # Train matrix
-        train_metadata = self._make_metadata(
-            datetime.datetime.strptime(self.temporal_split['train_start_date'], "%Y-%m-%d"),
-            datetime.datetime.strptime(self.temporal_split['train_end_date'], "%Y-%m-%d"),
-            train_matrix_id,
-            self.temporal_split['train_as_of_dates']
-        )
+    def matrix_uuid(self, metadata):
+        '''
+        metta uuid of a matrix of this instance, memoized by matrix_id
+        '''
+        if metadata['matrix_id'] not in self._matrix_uuids:
+            self._matrix_uuids[metadata['matrix_id']] = metta.metta_io.generate_uuid(metadata)
+        return self._matrix_uuids[metadata['matrix_id']]
+
+    def train_metadata(self):
+        if 'train' not in self._metadata:
+            train_matrix_id = str([sorted(self.temporal_split['train_as_of_dates']),
+                                   self.labels,
+                                   self.temporal_split['prediction_window']])
+
+            self._metadata['train'] = self._make_metadata(
+                datetime.datetime.strptime(self.temporal_split['train_start_date'], "%Y-%m-%d"),
+                datetime.datetime.strptime(self.temporal_split['train_end_date'], "%Y-%m-%d"),
+                train_matrix_id,
+                self.temporal_split['train_as_of_dates']
+            )
+        return self._metadata['train']
 
-        self.load_store_matrix(train_metadata, self.temporal_split['train_as_of_dates'], return_matrix=False)
-        # Loop over testing as of dates
-        for test_date in self.temporal_split['test_as_of_dates']:
-            # Load and store matrixes
-            log.info('Load test matrix for as of date: {}'.format(test_date))
+    def test_metadata(self, test_date):
+        if test_date not in self._metadata:
             test_matrix_id = str([test_date,
                                   self.labels,
                                   self.temporal_split['prediction_window']])
 
-            test_metadata = self._make_metadata(
+            self._metadata[test_date] = self._make_metadata(
                 datetime.datetime.strptime(test_date, "%Y-%m-%d"),
                 datetime.datetime.strptime(test_date, "%Y-%m-%d"),
                 test_matrix_id,
                 [test_date]
             )
+        return self._metadata[test_date]
+
+    def load_test_matrix(self, test_date):
+        '''
+        Returns the metadata, the matrix without its index columns and the uuid of the test matrix of
+        test_date, decoded once and then served from the test matrix cache. The matrix must not be modified
+        '''
+        cached = self.test_matrix_cache.get(test_date)
+        if cached is not None:
+            return cached
+
+        test_metadata = self.test_metadata(test_date)
+        test_df, test_uuid = self.load_store_matrix(test_metadata, [test_date])
+
+        # remove the index from the data-frame
+        for column in test_metadata['indices']:
+            if column in test_df.columns:
+                del test_df[column]
+
+        self.test_matrix_cache.put(test_date, (test_metadata, test_df, test_uuid), test_df)
+        return test_metadata, test_df, test_uuid
+
+    def generate_matrices(self):
+        # Train matrix
+        train_metadata = self.train_metadata()
+
+        self.load_store_matrix(train_metadata, self.temporal_split['train_as_of_dates'], return_matrix=False)
+        # Loop over testing as of dates
+        for test_date in self.temporal_split['test_as_of_dates']:
+            # Load and store matrixes
+            log.info('Load test matrix for as of date: {}'.format(test_date))
+            test_metadata = self.test_metadata(test_date)
 
             self.load_store_matrix(test_metadata, [test_date], return_matrix=False)
 
     def setup_train_models(self, model_storage):
-        train_matrix_id = str([sorted(self.temporal_split['train_as_of_dates']),
-                               self.labels,
-                               self.temporal_split['prediction_window']])
-
         # Train matrix
-        train_metadata = self._make_metadata(
-            datetime.datetime.strptime(self.temporal_split['train_start_date'], "%Y-%m-%d"),
-            datetime.datetime.strptime(self.temporal_split['train_end_date'], "%Y-%m-%d"),
-            train_matrix_id,
-            self.temporal_split['train_as_of_dates']
-        )
+        train_metadata = self.train_metadata()
 
         # Inlcude metadata in config for db
         self.misc_db_parameters['config']['train_metadata'] = json.dumps(train_metadata, default=self.dt_handler,
@@ -236,6 +380,24 @@ class RunModels():
         self.misc_db_parameters['config']['labels_config'] = self.labels_config
         # self.misc_db_parameters['config'] = json.dump(self.misc_db_parameters['config'],default=self.dt_handler, sort_keys=True)
 
+        # Only train the model groups that have test dates left to run
+        grid_config = self.grid_config
+        if self.ledger is not None:
+            grid_config = self.ledger.pending_grid(self.matrix_uuid(train_metadata),
+                                                   self.grid_config,
+                                                   self.temporal_split['test_as_of_dates'])
+            if not grid_config:
+                log.info('All model groups already completed for this train matrix. Skipping')
+                return None, None
+
+        reused_model_ids = []
+        if self.model_artifacts is not None and not self.retrain_models:
+            grid_config, reused_model_ids = self.reuse_trained_models(self.matrix_uuid(train_metadata), grid_config,
+                                                                      model_storage)
+            if not grid_config:
+                log.info('All models already trained on this train matrix. Reusing them')
+                return self.matrix_uuid(train_metadata), reused_model_ids
+
         # Load train matrix
         log.info('Load train matrix using as of dates: {}'.format(self.temporal_split['train_as_of_dates']))
         train_df, train_matrix_uuid = self.load_store_matrix(train_metadata, self.temporal_split['train_as_of_dates'])
@@ -256,19 +418,84 @@ class RunModels():
         # add to parameters to store in db
         self.misc_db_parameters['train_matrix_uuid'] = train_matrix_uuid
         train_matrix_store = InMemoryMatrixStore(train_df.iloc[:, :-1], train_metadata, train_df.iloc[:, -1])
-
-        trainer = ModelTrainer(project_path=self.project_path,
-                               experiment_hash=self.experiment_hash,
-                               model_storage_engine=model_storage,
-                               matrix_store=train_matrix_store,
-                               db_engine=self.db_engine
-                               )
+        trainer_args = dict(project_path=self.project_path,
+                            experiment_hash=self.experiment_hash,
+                            model_storage_engine=model_storage,
+                            matrix_store=train_matrix_store,
+                            db_engine=self.db_engine)
+
+        if self.grid_fit_processes > 1:
+            # the grid is fitted in parallel on one memmap of the train matrix, triage only stores the models
+            log.info('Fit the grid with {} processes'.format(self.grid_fit_processes))
+            directory = grid_fit.shared_train_matrix(train_df, train_metadata, self.matrices_path, train_matrix_uuid)
+            try:
+                fitted_models = grid_fit.fit_grid(grid_config, directory, train_matrix_uuid, self.grid_fit_processes)
+            finally:
+                grid_fit.remove_shared_train_matrix(directory, self.matrices_path, train_matrix_uuid)
+            trainer = grid_fit.PrefitModelTrainer(fitted_models, **trainer_args)
+        else:
+            trainer = ModelTrainer(**trainer_args)
         log.info('Train Models')
-        model_ids_generator = trainer.generate_trained_models(grid_config=self.grid_config,
+        model_ids_generator = trainer.generate_trained_models(grid_config=grid_config,
                                                               misc_db_parameters=self.misc_db_parameters,
                                                               replace=True)
+        if self.model_artifacts is not None:
+            model_ids_generator = self.store_trained_models(model_ids_generator, model_storage, train_matrix_uuid)
 
-        return train_matrix_uuid, model_ids_generator
+        return train_matrix_uuid, itertools.chain(reused_model_ids, model_ids_generator)
+
+    @staticmethod
+    def _reuse_key(class_path, parameters):
+        # n_jobs does not change the fitted model
+        return CheckpointLedger.model_group_key(class_path, {key: value for key, value in parameters.items()
+                                                            if key != 'n_jobs'})
+
+    def reuse_trained_models(self, train_matrix_uuid, grid_config, model_storage):
+        '''
+        Looks up the models of the grid already trained on this train matrix (same model type and parameters)
+        and puts their stored fitted model in model_storage, under the model_hash of the existing model_id
+        Returns:
+            the part of the grid left to train, in the format taken by triage's ModelTrainer,
+            and the model_ids of the reused models
+        '''
+        query = ("SELECT model_id, model_group_id, model_hash, model_type, model_parameters "
+                 "FROM results.models WHERE train_matrix_uuid = %s ORDER BY model_id")
+        trained = {}
+        for model_id, model_group_id, model_hash, model_type, model_parameters in self.db_engine.execute(
+                query, (train_matrix_uuid,)):
+            # the last model trained wins
+            trained[self._reuse_key(model_type, model_parameters)] = (model_id, model_group_id, model_hash)
+
+        pending = {}
+        reused_model_ids = []
+        for class_path, parameter_config in grid_config.items():
+            for parameters in ParameterGrid(parameter_config):
+                model = trained.get(self._reuse_key(class_path, parameters))
+                if model is None or not self.model_artifacts.exists(model[1], train_matrix_uuid):
+                    pending.setdefault(class_path, []).append({k: [v] for k, v in parameters.items()})
+                    continue
+                model_id, model_group_id, model_hash = model
+                model_storage.get_store(model_hash).write(self.model_artifacts.load(model_group_id,
+                                                                                    train_matrix_uuid))
+                reused_model_ids.append(model_id)
+
+        if reused_model_ids:
+            log.info('Train matrix {}: reusing {} trained models'.format(train_matrix_uuid, len(reused_model_ids)))
+        return pending, reused_model_ids
+
+    def store_trained_models(self, model_ids_generator, model_storage, train_matrix_uuid):
+        '''
+        Passes the trained model ids through, storing each fitted model in the artifact store
+        before it is tested (and removed from memory)
+        '''
+        for model_id in model_ids_generator:
+            query = "SELECT model_group_id, model_hash FROM results.models WHERE model_id = %s"
+            model_group_id, model_hash = self.db_engine.execute(query, (model_id,)).fetchone()
+            self.model_artifacts.save(model_group_id, train_matrix_uuid, model_storage.get_store(model_hash).load(),
+                                      model_id=model_id,
+                                      model_hash=model_hash,
+                                      train_end_date=self.temporal_split['train_end_date'])
+            yield model_id
 
     def train_test_models(self, train_matrix_uuid, model_ids_generator, model_storage):
 
@@ -276,150 +503,194 @@ class RunModels():
                               model_storage_engine=model_storage,
                               db_engine=self.db_engine)
 
-        for trained_model_id in model_ids_generator:
-            ## Prediction
-            log.info('Predict for model_id: {}'.format(trained_model_id))
-
-            # Loop over testing as of dates
-            for test_date in self.temporal_split['test_as_of_dates']:
-                # Load matrixes
-                log.info('Load test matrix for as of date: {}'.format(test_date))
-                test_matrix_id = str([test_date,
-                                      self.labels,
-                                      self.temporal_split['prediction_window']])
-
-                test_metadata = self._make_metadata(
-                    datetime.datetime.strptime(test_date, "%Y-%m-%d"),
-                    datetime.datetime.strptime(test_date, "%Y-%m-%d"),
-                    test_matrix_id,
-                    [test_date]
-                )
-
-                test_df, test_uuid = self.load_store_matrix(test_metadata, [test_date])
-                misc_db_parameters = {'matrix_uuid': test_uuid}
-
-                # remove the index from the data-frame
-                for column in test_metadata['indices']:
-                    if column in test_df.columns:
-                        del test_df[column]
-
-                # Store matrix
-                test_matrix_store = InMemoryMatrixStore(test_df.iloc[:, :-1], test_metadata, test_df.iloc[:, -1])
-
-                predictions_binary, predictions_proba = predictor.predict(trained_model_id, test_matrix_store,
-                                                                          misc_db_parameters)
-                ## Evaluation
-
-                if len(test_df.iloc[:, -1].unique()) == 1:
-                    log.warning('''Test Matrix %s had only one
-                                unique value, no point in testing this matrix. Skipping
-                                ''', test_uuid)
-                    self.individual_feature_ranking(
-                        fitted_model=predictor.load_model(trained_model_id),
-                        test_matrix=test_df.iloc[:, :-1],
-                        model_id=trained_model_id,
-                        test_date=test_date,
-                        n_ranks=200)
+        try:
+            for trained_model_id in model_ids_generator:
+                ## Prediction
+                log.info('Predict for model_id: {}'.format(trained_model_id))
+                model_group_id, model_group_key = None, None
+                if self.ledger is not None:
+                    model_group_id, model_group_key = self._model_group(trained_model_id)
+
+                test_dates = []
+                for test_date in self.temporal_split['test_as_of_dates']:
+                    if self.ledger is not None and self.ledger.is_done(train_matrix_uuid, model_group_key, test_date):
+                        log.debug('Test date {} already completed for model_id: {}'.format(test_date,
+                                                                                           trained_model_id))
+                        continue
+                    test_dates.append(test_date)
+
+                if self.batch_predictions:
+                    self._test_model_batched(predictor, trained_model_id, test_dates, train_matrix_uuid,
+                                             model_group_id, model_group_key)
                 else:
-                    log.info('Generate Evaluations for model_id: {}'.format(trained_model_id))
-                    self.evaluations(predictions_proba, predictions_binary, test_df.iloc[:, -1], trained_model_id,
-                                     test_date)
-                    self.individual_feature_ranking(
-                        fitted_model=predictor.load_model(trained_model_id),
-                        test_matrix=test_df.iloc[:, :-1],
-                        model_id=trained_model_id,
-                        test_date=test_date,
-                        n_ranks=200)
-
-            # remove trained model from memory
-            predictor.delete_model(trained_model_id)
-
+                    self._test_model(predictor, trained_model_id, test_dates, train_matrix_uuid,
+                                     model_group_id, model_group_key)
+
+                # remove trained model from memory
+                predictor.delete_model(trained_model_id)
+        except Exception:
+            # a failed write of the queued results is logged, the error of the loop is raised
+            self.results_writer.close(raise_error=False)
+            raise
+        # the results still queued are written before returning
+        self.results_writer.close()
+
+        log.info('Test matrix cache: {}'.format(self.test_matrix_cache.stats()))
         return None
 
-    # this function is used for training and scoring a day
+    def _test_model(self, predictor, trained_model_id, test_dates, train_matrix_uuid, model_group_id, model_group_key):
+        '''
+        Predicts and stores the results of one test date at a time, the predictions are written by the
+        results writer with the evaluations of the date
+        '''
+        fitted_model = predictor.load_model(trained_model_id)
+        for test_date in test_dates:
+            # Load matrixes
+            log.info('Load test matrix for as of date: {}'.format(test_date))
+            test_metadata, test_df, test_uuid = self.load_test_matrix(test_date)
+
+            test_matrix = test_df.iloc[:, :-1]
+            predictions_proba = fitted_model.predict_proba(test_matrix)[:, 1]
+            predictions_binary = fitted_model.predict(test_matrix)
+            self.results_writer.add('predictions', results_writer.prediction_rows(
+                trained_model_id, test_date, test_matrix.index, predictions_proba, test_df.iloc[:, -1], test_uuid))
+            self._evaluate_test_date(fitted_model, trained_model_id, test_date, test_df, test_uuid,
+                                     predictions_proba, predictions_binary)
+            self.results_writer.flush(on_written=functools.partial(
+                self._mark_done, train_matrix_uuid, model_group_id, model_group_key, test_date, trained_model_id,
+                test_uuid))
+
+    def _test_model_batched(self, predictor, trained_model_id, test_dates, train_matrix_uuid, model_group_id,
+                            model_group_key):
+        '''
+        Stacks the test matrices of several test dates and scores them with one predict_proba call, then splits
+        the scores back per date. Batches hold up to PREDICTION_BATCH_CELLS values, their results are written
+        with one flush
+        '''
+        fitted_model = predictor.load_model(trained_model_id)
+        batch = []
+        batch_cells = 0
+        for i, test_date in enumerate(test_dates):
+            log.info('Load test matrix for as of date: {}'.format(test_date))
+            test_metadata, test_df, test_uuid = self.load_test_matrix(test_date)
+            batch.append((test_date, test_df, test_uuid))
+            batch_cells += test_df.shape[0] * test_df.shape[1]
+            if batch_cells < PREDICTION_BATCH_CELLS and i < len(test_dates) - 1:
+                continue
+
+            log.info('Score {} test dates ({} rows) with model_id: {}'.format(
+                len(batch), sum(len(test_df) for _, test_df, _ in batch), trained_model_id))
+            stacked = pd.concat([test_df.iloc[:, :-1] for _, test_df, _ in batch])
+            stacked_proba = fitted_model.predict_proba(stacked)[:, 1]
+            stacked_binary = fitted_model.predict(stacked)
+            del stacked
+
+            # the results of the batch are written with one flush and only then are its dates marked as done
+            offsets = np.cumsum([0] + [len(test_df) for _, test_df, _ in batch])
+            done = []
+            for (test_date, test_df, test_uuid), start, end in zip(batch, offsets[:-1], offsets[1:]):
+                self.results_writer.add('predictions', results_writer.prediction_rows(
+                    trained_model_id, test_date, test_df.index, stacked_proba[start:end], test_df.iloc[:, -1],
+                    test_uuid))
+                self._evaluate_test_date(fitted_model, trained_model_id, test_date, test_df, test_uuid,
+                                         stacked_proba[start:end], stacked_binary[start:end])
+                done.append(functools.partial(self._mark_done, train_matrix_uuid, model_group_id, model_group_key,
+                                              test_date, trained_model_id, test_uuid))
+
+            def mark_batch_done(done=done):
+                for mark_done in done:
+                    mark_done()
+            self.results_writer.flush(on_written=mark_batch_done)
+            batch = []
+            batch_cells = 0
+
+    def _evaluate_test_date(self, fitted_model, trained_model_id, test_date, test_df, test_uuid, predictions_proba,
+                            predictions_binary):
+        ## Evaluation
+        if len(test_df.iloc[:, -1].unique()) == 1:
+            log.warning('''Test Matrix %s had only one
+                        unique value, no point in testing this matrix. Skipping
+                        ''', test_uuid)
+        else:
+            log.info('Generate Evaluations for model_id: {}'.format(trained_model_id))
+            self.evaluations(predictions_proba, predictions_binary, test_df.iloc[:, -1], trained_model_id,
+                             test_date)
+        self.individual_feature_ranking(
+            fitted_model=fitted_model,
+            test_matrix=test_df.iloc[:, :-1],
+            model_id=trained_model_id,
+            test_date=test_date,
+            n_ranks=200)
+
+    def _mark_done(self, train_matrix_uuid, model_group_id, model_group_key, test_date, trained_model_id, test_uuid):
+        if self.ledger is not None:
+            self.ledger.mark_done(train_matrix_uuid, model_group_key, test_date,
+                                  model_id=trained_model_id,
+                                  model_group_id=model_group_id,
+                                  test_matrix_uuid=test_uuid)
+
+    def _model_group(self, model_id):
+        '''
+        Returns the model_group_id and the ledger key of the model group of a trained model
+        '''
+        query = ("SELECT model_group_id, model_type, model_parameters "
+                 "FROM results.models WHERE model_id = {}".format(model_id))
+        model_group_id, model_type, model_parameters = self.db_engine.execute(query).fetchone()
+        return model_group_id, self.ledger.model_group_key(model_type, model_parameters)
+
+    # this function is used for training and scoring the production dates
     def train_score_models(self, model_ids_generator, model_storage):
-
+        """
+        Scores every test_as_of_date with each model, loading the model once, and writes
+        the results of all the dates in a single transaction per model
+        """
         predictor = Predictor(project_path=self.project_path,
                               model_storage_engine=model_storage,
                               db_engine=self.db_engine)
 
-        for trained_model_id in model_ids_generator:
-            ## Prediction
-            log.info('Predict for model_id: {}'.format(trained_model_id))
-
-            # Loop over testing as of dates
-            for test_date in self.temporal_split['test_as_of_dates']:
-                # Load matrixes
-                log.info('Load production matrix for as of date: {}'.format(test_date))
-                test_matrix_id = str([test_date,
-                                      self.labels,
-                                      self.temporal_split['prediction_window']])
-
-                test_metadata = self._make_metadata(
-                    datetime.datetime.strptime(test_date, "%Y-%m-%d"),
-                    datetime.datetime.strptime(test_date, "%Y-%m-%d"),
-                    test_matrix_id,
-                    [test_date]
-                )
-
-                test_df, test_uuid = self.load_store_matrix(test_metadata, [test_date])
-                misc_db_parameters = {'matrix_uuid': test_uuid}
-
-                # remove the index from the data-frame
-                for column in test_metadata['indices']:
-                    if column in test_df.columns:
-                        del test_df[column]
-
-                # Store matrix
-                test_matrix_store = InMemoryMatrixStore(test_df.iloc[:, :-1], test_metadata, test_df.iloc[:, -1])
-
-                predictions_binary, predictions_proba = predictor.predict(trained_model_id, test_matrix_store,
-                                                                          misc_db_parameters)
-
-                self.individual_feature_ranking(
-                    fitted_model=predictor.load_model(trained_model_id),
-                    test_matrix=test_df.iloc[:, :-1],
-                    model_id=trained_model_id,
-                    test_date=test_date,
-                    n_ranks=200)
-
-            # remove trained model from memory
-            predictor.delete_model(trained_model_id)
+        try:
+            for trained_model_id in model_ids_generator:
+                ## Prediction
+                log.info('Score {} dates with model_id: {}'.format(len(self.temporal_split['test_as_of_dates']),
+                                                                   trained_model_id))
+                fitted_model = predictor.load_model(trained_model_id)
+
+                # Loop over testing as of dates
+                for test_date in self.temporal_split['test_as_of_dates']:
+                    # Load matrixes
+                    log.info('Load production matrix for as of date: {}'.format(test_date))
+                    test_metadata, test_df, test_uuid = self.load_test_matrix(test_date)
+
+                    test_matrix = test_df.iloc[:, :-1]
+                    predictions_proba = fitted_model.predict_proba(test_matrix)[:, 1]
+                    self.results_writer.add('predictions', results_writer.prediction_rows(
+                        trained_model_id, test_date, test_matrix.index, predictions_proba, test_df.iloc[:, -1],
+                        test_uuid))
+
+                    self.individual_feature_ranking(
+                        fitted_model=fitted_model,
+                        test_matrix=test_matrix,
+                        model_id=trained_model_id,
+                        test_date=test_date,
+                        n_ranks=200)
+
+                self.results_writer.flush()
 
+                # remove trained model from memory
+                predictor.delete_model(trained_model_id)
+        except Exception:
+            self.results_writer.close(raise_error=False)
+            raise
+        self.results_writer.close()
+
+        log.info('Test matrix cache: {}'.format(self.test_matrix_cache.stats()))
         return None
 
     def evaluations(self, predictions_proba, predictions_binary, test_y, model_id, test_date):
         all_metrics = scoring.calculate_all_evaluation_metrics(test_y.tolist(),
                                                                predictions_proba.tolist(),
                                                                predictions_binary.tolist())
-        db_conn = self.db_engine.raw_connection()
-
-        # remove all existing evaluations before re-writing
-        query = "DELETE FROM results.evaluations where model_id = {} and evaluation_start_time = '{}'::TIMESTAMP ".format(
-            model_id, test_date)
-        db_conn.cursor().execute(query)
-        db_conn.commit()
-
-        for key in all_metrics:
-            evaluation = all_metrics[key]
-            metric = key.split('|')[0]
-            try:
-                metric_parameter = key.split('|')[1]
-                if metric_parameter == '':
-                    metric_parameter.replace('', None)
-                else:
-                    pass
-            except:
-                metric_parameter = None
-
-            try:
-                comment = str(key.split('|')[2])
-            except:
-                comment = None
-
-            dataset.store_evaluation_metrics(model_id, evaluation, metric, test_date, db_conn, metric_parameter,
-                                             comment)
-        db_conn.close()
+        self.results_writer.add('evaluations', results_writer.evaluation_rows(model_id, test_date, all_metrics))
         return None
 
     def individual_feature_ranking(self, fitted_model, test_matrix, model_id, test_date, n_ranks):
@@ -433,67 +704,51 @@ class RunModels():
                     model_id))
             return None
 
-        # get the list of all features in the test matrix
-        feature_list = test_matrix.columns
-
-        # extract all global feature importance values from the tree
-        importance_dict = {}
-        for j, value in enumerate(fitted_model.feature_importances_):
-            if value > 0:
-                importance_dict[feature_list[j]] = value
-
-        # filter out dummies
-        importance_dict_filtered = {k: v for k, v in importance_dict.items() if not 'dummy' in k}
-
-        rftree_feature_list = sorted(importance_dict_filtered, key=importance_dict_filtered.get, reverse=True)
-
-        # create a new text matrix with float conversion (panda stores some columns from postgres as decimal object)
-        tmp_test = test_matrix.applymap(lambda x: float(x))
-        test_matrix_reduced = pd.DataFrame()
-
-        # add the top n_ranks features from the RandomForest used without dummies
-        for feature in rftree_feature_list[:n_ranks]:
-            test_matrix_reduced[feature] = tmp_test[feature]
-
-        test_matrix_rank_distance = pd.DataFrame()
-
-        for feature in test_matrix_reduced.columns:
-            feature_median = test_matrix_reduced[feature].median()
-            test_matrix_reduced[feature + '_rank'] = test_matrix_reduced[feature].rank()
-            # the index of the median value
-            idx = np.nanargmin(np.abs(test_matrix_reduced[feature] - feature_median))
-            median_rank = test_matrix_reduced[feature + '_rank'].iloc[idx]
-            test_matrix_rank_distance[feature] = np.abs(test_matrix_reduced[feature + '_rank'] - median_rank)
-
-        test_matrix_rank_distance = test_matrix_rank_distance.reset_index(drop=True)
-
-        # find the top 5 features where the distance to the median rank value (for standardisation) is the highest
-        # across the top 30 features
-        matrix_transposed = test_matrix_rank_distance.T
-        result = pd.DataFrame(np.zeros((0, 5)), columns=['risk_1', 'risk_2', 'risk_3', 'risk_4', 'risk_5'])
-        for i in matrix_transposed.columns:
-            df1row = pd.DataFrame(matrix_transposed.nlargest(5, i).index.tolist(),
-                                  index=['risk_1', 'risk_2', 'risk_3', 'risk_4', 'risk_5']).T
-            result = pd.concat([result, df1row], axis=0)
-        result = result.reset_index(drop=True)
+        result = individual_risk_factors(test_matrix, fitted_model.feature_importances_, n_ranks)
 
         # prepare table insert
-        result['entity_id'] = test_matrix_reduced.index.values
+        result['entity_id'] = test_matrix.index.values
         result['model_id'] = model_id
         result['as_of_date'] = test_date
 
-        db_conn = self.db_engine.raw_connection()
+        self.results_writer.add('individual_importances', result)
 
-        # remove all existing evaluations before re-writing
-        query = "DELETE FROM results.individual_importances where model_id = {} and as_of_date = '{}'::TIMESTAMP ".format(
-            model_id, test_date)
-        db_conn.cursor().execute(query)
-        db_conn.commit()
+        return None
 
-        # write new entries
-        result.to_sql("individual_importances", self.db_engine, if_exists="append", schema="results", index=False)
 
-        return None
+def individual_risk_factors(test_matrix, feature_importances, n_ranks, n_risks=5):
+    """
+    Returns the n_risks features of every officer whose rank is the furthest from the rank of the median
+    value, among the n_ranks most important features of the model (dummies excluded)
+    Args:
+        test_matrix (DataFrame): features of the officers, without label
+        feature_importances (array): importance of each column of test_matrix
+    Returns:
+        DataFrame with a risk_1 ... risk_<n_risks> column and a row per officer
+    """
+    risk_columns = ['risk_{}'.format(i + 1) for i in range(n_risks)]
+
+    # features with importance, most important first (ties in column order), dummies filtered out
+    feature_list = test_matrix.columns
+    importances = [(feature_list[j], value) for j, value in enumerate(feature_importances)
+                   if value > 0 and 'dummy' not in feature_list[j]]
+    rftree_feature_list = [feature for feature, _ in sorted(importances, key=lambda item: item[1], reverse=True)]
+    features = rftree_feature_list[:n_ranks]
+
+    # ranked in float64, only the used columns (matrices stored before float32 loading hold Decimal objects)
+    values = np.asarray(test_matrix[features].values, dtype=np.float64)
+
+    # distance of every value's rank to the rank of the value closest to the median, per feature
+    ranks = pd.DataFrame(values).rank().values
+    medians = pd.DataFrame(values).median().values
+    median_idx = np.nanargmin(np.abs(values - medians), axis=0)
+    median_ranks = ranks[median_idx, np.arange(len(features))]
+    distances = np.abs(ranks - median_ranks)
+
+    # the n_risks largest distances per officer, ties go to the more important feature
+    top = np.argsort(-distances, axis=1, kind='mergesort')[:, :n_risks]
+    names = np.asarray(features, dtype=object)[top]
+    return pd.DataFrame(names, columns=risk_columns[:top.shape[1]]).reindex(columns=risk_columns)
 
 
 def main_test(config_file_name, db_engine):
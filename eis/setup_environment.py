@@ -2,11 +2,23 @@
 import os
 import yaml
 from sqlalchemy import create_engine
-from sqlalchemy.pool import NullPool
+from sqlalchemy.pool import QueuePool
 import logging
 
 log = logging.getLogger(__name__)
 
+# Engines of this process, keyed by (pid, production). A forked worker (joblib/loky,
+# multiprocessing, collate's execute_par) has a different pid and therefore never
+# uses the connections it inherited from its parent, it creates its own pool instead.
+_engines = {}
+_profiles = {}
+
+# Bounded pool per process: parallelism comes from the number of processes,
+# each of them only needs a handful of connections
+POOL_SIZE = 5
+MAX_OVERFLOW = 5
+POOL_RECYCLE = 3600
+
 
 def get_experiment_config(exp_config_file_name='experiment.yaml'):
     """Get the experiment configuration variables from the config file
@@ -26,6 +38,14 @@ def get_experiment_config(exp_config_file_name='experiment.yaml'):
 
 
 def get_database(production=None):
+    """
+    Returns the pooled engine of this process, creating it on the first call.
+    Callers should not dispose the engine, it is shared by all the tasks run by the process.
+    """
+    key = (os.getpid(), bool(production))
+    if key in _engines:
+        return _engines[key]
+
     try:
         engine = get_connection_from_profile(production=production)
         log.info("Connected to PostgreSQL database!")
@@ -33,9 +53,20 @@ def get_database(production=None):
         log.exception("Failed to get database connection!")
         return None, 'fail'
 
+    _engines[key] = engine
     return engine
 
 
+def dispose_databases():
+    """
+    Closes the pooled connections of the engines created by this process
+    """
+    for (pid, production), engine in list(_engines.items()):
+        if pid == os.getpid():
+            engine.dispose()
+            del _engines[(pid, production)]
+
+
 def get_connection_from_profile(config_file_name="default_profile.yaml", production=None):
     """
     Sets up database connection from config file.
@@ -46,8 +77,10 @@ def get_connection_from_profile(config_file_name="default_profile.yaml", product
                       credentials for the PostgreSQL database
     """
 
-    with open(config_file_name, 'r') as f:
-        vals = yaml.load(f)
+    if config_file_name not in _profiles:
+        with open(config_file_name, 'r') as f:
+            _profiles[config_file_name] = yaml.load(f)
+    vals = _profiles[config_file_name]
 
     if not ('PGHOST' in vals.keys() and
             'PGUSER' in vals.keys() and
@@ -75,15 +108,19 @@ def get_engine(db, user, host, port, passwd, production=None):
 
     url = 'postgresql://{user}:{passwd}@{host}:{port}/{db}'.format(
         user=user, passwd=passwd, host=host, port=port, db=db)
+    pool_options = {'poolclass': QueuePool,
+                    'pool_size': POOL_SIZE,
+                    'max_overflow': MAX_OVERFLOW,
+                    'pool_recycle': POOL_RECYCLE}
     if not production:
-        engine = create_engine(url, poolclass=NullPool)
+        engine = create_engine(url, **pool_options)
     else:
         engine = create_engine(
                 url,
                 execution_options={'schema_translate_map': {
                     'results': 'production'
                 }},
-                poolclass=NullPool
+                **pool_options
         )
 
     return engine
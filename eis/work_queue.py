@@ -0,0 +1,221 @@
+import logging
+import os
+import pickle
+import socket
+import sqlite3
+import threading
+import time
+import uuid
+
+log = logging.getLogger(__name__)
+
+PENDING = 'pending'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+
+
+class WorkItem():
+    def __init__(self, item_id, batch, func, payload, attempts):
+        self.item_id = item_id
+        self.batch = batch
+        self.func = func
+        self.args, self.kwargs = pickle.loads(payload)
+        self.attempts = attempts
+
+
+class WorkQueue():
+    """
+    Durable work queue in a SQLite file, shared by worker processes on one host or on several
+    hosts mounting the same project_path.
+
+    Items are claimed with a lease that the worker extends with heartbeats while it runs the
+    item. The item of a worker that dies is claimed again when its lease expires, until
+    max_attempts is reached. Within a batch, items are only claimed once all the items of a
+    lower priority are finished, so priorities work as stages (eg. matrices before training).
+    """
+
+    def __init__(self, filename, lease_seconds=600, max_attempts=3):
+        self.filename = filename
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        os.makedirs(os.path.dirname(os.path.abspath(filename)), exist_ok=True)
+        with self._connect() as conn:
+            conn.execute("""CREATE TABLE IF NOT EXISTS work_items (
+                                item_id       INTEGER PRIMARY KEY AUTOINCREMENT,
+                                batch         TEXT,
+                                priority      INTEGER,
+                                func          TEXT,
+                                payload       BLOB,
+                                status        TEXT,
+                                attempts      INTEGER DEFAULT 0,
+                                worker        TEXT,
+                                lease_expires REAL,
+                                error         TEXT,
+                                created       REAL,
+                                finished      REAL,
+                                not_before    REAL DEFAULT 0)""")
+            conn.execute("CREATE INDEX IF NOT EXISTS work_items_status_idx ON work_items (status, batch, priority)")
+
+    def _connect(self):
+        # a connection per operation keeps the queue usable from forked processes and threads
+        conn = sqlite3.connect(self.filename, timeout=120, isolation_level=None)
+        return _Transaction(conn)
+
+    def enqueue(self, items, batch=None):
+        '''
+        Args:
+            items (list): (priority, func_name, args, kwargs) tuples
+            batch (str): name of the batch, a new one by default
+        Returns:
+            name of the batch
+        '''
+        batch = batch or uuid.uuid4().hex
+        now = time.time()
+        with self._connect() as conn:
+            conn.executemany("INSERT INTO work_items (batch, priority, func, payload, status, created) "
+                             "VALUES (?, ?, ?, ?, ?, ?)",
+                             [(batch, priority, func, pickle.dumps((args, kwargs)), PENDING, now)
+                              for priority, func, args, kwargs in items])
+        log.info('Enqueued {} work items in batch {}'.format(len(items), batch))
+        return batch
+
+    def claim(self, worker):
+        '''
+        Returns the next WorkItem leased to the worker, None when nothing can be claimed now
+        '''
+        now = time.time()
+        with self._connect() as conn:
+            # items of dead workers whose retries are exhausted
+            conn.execute("UPDATE work_items SET status = ?, error = 'lease expired', finished = ? "
+                         "WHERE status = ? AND lease_expires < ? AND attempts >= ?",
+                         (FAILED, now, RUNNING, now, self.max_attempts))
+            row = conn.execute("""
+                SELECT item_id, batch, func, payload, attempts
+                FROM work_items w
+                WHERE (status = ? OR (status = ? AND lease_expires < ?))
+                  AND not_before <= ?
+                  AND priority = (SELECT min(priority) FROM work_items s
+                                  WHERE s.batch = w.batch AND s.status IN (?, ?))
+                ORDER BY priority, item_id
+                LIMIT 1""", (PENDING, RUNNING, now, now, PENDING, RUNNING)).fetchone()
+            if row is None:
+                return None
+
+            item_id, batch, func, payload, attempts = row
+            conn.execute("UPDATE work_items SET status = ?, worker = ?, attempts = ?, lease_expires = ? "
+                         "WHERE item_id = ?", (RUNNING, worker, attempts + 1, now + self.lease_seconds, item_id))
+        return WorkItem(item_id, batch, func, payload, attempts + 1)
+
+    def heartbeat(self, item, worker):
+        with self._connect() as conn:
+            conn.execute("UPDATE work_items SET lease_expires = ? WHERE item_id = ? AND worker = ? AND status = ?",
+                         (time.time() + self.lease_seconds, item.item_id, worker, RUNNING))
+
+    def complete(self, item, worker):
+        with self._connect() as conn:
+            conn.execute("UPDATE work_items SET status = ?, finished = ? WHERE item_id = ? AND worker = ?",
+                         (DONE, time.time(), item.item_id, worker))
+
+    def fail(self, item, worker, error):
+        '''
+        Puts the item back in the queue, or marks it as failed once it used all its attempts
+        '''
+        status = FAILED if item.attempts >= self.max_attempts else PENDING
+        with self._connect() as conn:
+            conn.execute("UPDATE work_items SET status = ?, error = ?, finished = ? WHERE item_id = ? AND worker = ?",
+                         (status, str(error), time.time(), item.item_id, worker))
+
+    def defer(self, item, worker, delay):
+        '''
+        Puts the item back in the queue without using one of its attempts, no worker claims it
+        for delay seconds
+        '''
+        with self._connect() as conn:
+            conn.execute("UPDATE work_items SET status = ?, attempts = ?, not_before = ? WHERE item_id = ? AND worker = ?",
+                         (PENDING, item.attempts - 1, time.time() + delay, item.item_id, worker))
+
+    def counts(self, batch=None):
+        query = "SELECT status, count(*) FROM work_items"
+        params = ()
+        if batch is not None:
+            query += " WHERE batch = ?"
+            params = (batch,)
+        with self._connect() as conn:
+            rows = conn.execute(query + " GROUP BY status", params).fetchall()
+        return dict(rows)
+
+    def is_drained(self):
+        counts = self.counts()
+        return not counts.get(PENDING) and not counts.get(RUNNING)
+
+
+class _Transaction():
+    """Runs the statements of a connection in one immediate (write locked) transaction"""
+
+    def __init__(self, conn):
+        self.conn = conn
+
+    def __enter__(self):
+        self.conn.execute("BEGIN IMMEDIATE")
+        return self.conn
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.conn.execute("ROLLBACK" if exc_type else "COMMIT")
+        self.conn.close()
+
+
+def worker_name():
+    return '{}:{}'.format(socket.gethostname(), os.getpid())
+
+
+def work(queue, functions, poll_interval=10, exit_when_drained=True, retry_later=()):
+    '''
+    Claims and runs work items until the queue is drained
+    Args:
+        queue (WorkQueue): queue to take the items from
+        functions (dict): functions that items may call, by name
+        poll_interval (int): seconds to wait when no item can be claimed
+        exit_when_drained (bool): stop when no item is pending or running, otherwise keep polling
+        retry_later (tuple): exceptions meaning the item can not run yet (eg. its matrix is being built
+                             elsewhere), the item is deferred and the worker moves on to other items
+    Returns:
+        number of items run by this worker
+    '''
+    worker = worker_name()
+    n_items = 0
+    log.info('Worker {} started on queue {}'.format(worker, queue.filename))
+    while True:
+        item = queue.claim(worker)
+        if item is None:
+            if exit_when_drained and queue.is_drained():
+                break
+            time.sleep(poll_interval)
+            continue
+
+        log.info('Worker {} running item {} ({}), attempt {}'.format(worker, item.item_id, item.func, item.attempts))
+        stop_heartbeat = threading.Event()
+        heartbeat = threading.Thread(target=_heartbeat, args=(queue, item, worker, stop_heartbeat), daemon=True)
+        heartbeat.start()
+        try:
+            functions[item.func](*item.args, **item.kwargs)
+        except retry_later as e:
+            log.info('Item {} deferred: {!r}'.format(item.item_id, e))
+            queue.defer(item, worker, poll_interval)
+        except Exception as e:
+            log.exception('Item {} failed'.format(item.item_id))
+            queue.fail(item, worker, e)
+        else:
+            queue.complete(item, worker)
+        finally:
+            stop_heartbeat.set()
+            heartbeat.join()
+        n_items += 1
+
+    log.info('Worker {} done after {} items, queue: {}'.format(worker, n_items, queue.counts()))
+    return n_items
+
+
+def _heartbeat(queue, item, worker, stop):
+    while not stop.wait(queue.lease_seconds / 3.):
+        queue.heartbeat(item, worker)
@@ -0,0 +1,95 @@
+import threading
+
+
+class RecordingCursor:
+    def __init__(self, connection):
+        self.connection = connection
+        self.engine = connection.engine
+        self.rowcount = 0
+        self._rows = []
+
+    def execute(self, query, params=None):
+        self.engine.record(self.connection, query, params)
+        self._rows = list(self.engine.rows(query, params) or [])
+        self.rowcount = len(self._rows)
+
+    def fetchone(self):
+        return self._rows.pop(0) if self._rows else None
+
+    def fetchall(self):
+        rows, self._rows = self._rows, []
+        return rows
+
+    def copy_expert(self, query, stream):
+        self.engine.record(self.connection, query, None)
+        if self.engine.fail_copy:
+            raise IOError('connection lost')
+        if 'TO STDOUT' in query:
+            text = self.engine.copy_out(query)
+            # in pieces that do not end on a line
+            for i in range(0, len(text), 7):
+                stream.write(text[i:i + 7])
+        else:
+            self.engine.copied.append(stream.read())
+
+    def close(self):
+        pass
+
+
+class RecordingConnection:
+    def __init__(self, engine):
+        self.engine = engine
+        self.statements = []
+        self.commits = 0
+        self.rollbacks = 0
+
+    def cursor(self):
+        return RecordingCursor(self)
+
+    def commit(self):
+        self.commits += 1
+
+    def rollback(self):
+        self.rollbacks += 1
+
+    def close(self):
+        pass
+
+
+class RecordingEngine:
+    """
+    DB-API engine recording the statements, the COPY FROM STDIN payloads and the transactions of every
+    connection. Query results and COPY TO STDOUT output come from the functions of the test
+    """
+
+    def __init__(self, rows=None, copy_out=None, fail_copy=False):
+        '''
+        Args:
+            rows (callable): rows(query, params) returns the rows of a query, none by default
+            copy_out (callable): copy_out(query) returns the CSV text of a COPY ... TO STDOUT
+            fail_copy (bool): every COPY raises IOError
+        '''
+        self.rows = rows or (lambda query, params: [])
+        self.copy_out = copy_out or (lambda query: '')
+        self.fail_copy = fail_copy
+        self.connections = []
+        self.statements = []
+        self.copied = []
+        self._lock = threading.Lock()
+
+    def raw_connection(self):
+        connection = RecordingConnection(self)
+        with self._lock:
+            self.connections.append(connection)
+        return connection
+
+    def execute(self, query, params=None):
+        self.record(None, query, params)
+        return iter(list(self.rows(query, params) or []))
+
+    def record(self, connection, query, params):
+        statement = (' '.join(query.split()), params)
+        with self._lock:
+            self.statements.append(statement)
+            if connection is not None:
+                connection.statements.append(statement)
@@ -0,0 +1,46 @@
+import os
+import tempfile
+
+import numpy as np
+
+from eis import admission
+
+
+def allocate(n_bytes):
+    return int(np.ones(n_bytes // 8).sum())
+
+
+def worker_pid(item):
+    return os.getpid()
+
+
+class TestRunMeasured:
+    def test_every_task_is_measured_in_a_reused_worker(self):
+        large = admission._run_measured(allocate, 200 * 1024 ** 2, {})
+        small = admission._run_measured(allocate, 1024, {})
+
+        assert large[2] > 150 * 1024 ** 2
+        # a smaller task than the previous one is still measured, not dropped
+        assert small[2] is not None and small[2] < 50 * 1024 ** 2
+        assert large[3] == small[3] == os.getpid()
+
+
+class TestMemoryAdmissionScheduler:
+    def test_results_in_order_and_peaks_recorded(self):
+        profile = admission.ResourceProfile(os.path.join(tempfile.mkdtemp(), 'profile.json'))
+        scheduler = admission.MemoryAdmissionScheduler(2, 8 * admission.GB, profile)
+
+        results = scheduler.run(allocate, [8 * 1024, 16 * 1024, 24 * 1024], 'matrix', [1, 2, 3])
+
+        assert results == [1024, 2048, 3072]
+        assert len(profile.profile['memory']['matrix']) == 3
+        assert all(peak >= admission.DEFAULT_BASE_BYTES for _, peak in profile.profile['memory']['matrix'])
+
+    def test_run_with_fewer_workers(self):
+        profile = admission.ResourceProfile(os.path.join(tempfile.mkdtemp(), 'profile.json'))
+        scheduler = admission.MemoryAdmissionScheduler(4, 8 * admission.GB, profile)
+
+        # eg. train tasks fitting their grid with processes of their own
+        pids = scheduler.run(worker_pid, list(range(6)), 'train', [1] * 6, n_jobs=1)
+
+        assert len(set(pids)) == 1
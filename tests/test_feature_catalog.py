@@ -0,0 +1,71 @@
+import os
+import tempfile
+
+from eis import feature_catalog
+from eis.feature_catalog import FeatureCatalog
+from tests.fakes import RecordingEngine
+
+columns = ['officer_id', 'as_of_date',
+           'ofarrests_officer_id_P1Y_ArrestsCount_sum', 'ofarrests_officer_id_P1Y_ArrestsCount_avg',
+           'ofarrests_officer_id_P5Y_ArrestsCount_sum',
+           'ofarrests_officer_id_P1Y_FelonyCount_sum',
+           'ofarrests_officer_id_all_CareerArrests_sum',
+           'ofarrests_officer_id_YearsOfService_max']
+
+
+def catalog_engine():
+    return RecordingEngine(lambda query, params: [('arrests_aggregation', column) for column in columns])
+
+
+class TestFeatureCatalog:
+    def test_entries(self):
+        catalog = FeatureCatalog('features', {'arrests_aggregation': columns})
+        entries = catalog.entries('arrests_aggregation')
+
+        assert ('ofarrests_officer_id_P1Y_ArrestsCount_avg', 'ArrestsCount', 'P1Y', 'avg') in entries
+        assert ('ofarrests_officer_id_YearsOfService_max', 'YearsOfService', None, 'max') in entries
+        assert len(entries) == 6
+
+    def test_active_block_features(self):
+        catalog = FeatureCatalog('features', {'arrests_aggregation': columns})
+
+        available, missing = catalog.active_block_features(
+            'arrests_aggregation', ['ArrestsCount', 'FelonyCount', 'CareerArrests', 'YearsOfService', 'Missing'],
+            ['P1Y', 'P5Y'])
+
+        assert available == sorted(columns[2:])
+        assert missing == ['FelonyCount', 'Missing']
+
+    def test_catalog_is_read_once_and_shared(self):
+        directory = tempfile.mkdtemp()
+        engine = catalog_engine()
+        feature_catalog.invalidate('features', directory)
+
+        first = feature_catalog.get_catalog(engine, 'features', directory)
+        assert feature_catalog.get_catalog(engine, 'features', directory) is first
+        # another worker picks up the file
+        feature_catalog._catalogs.clear()
+        assert feature_catalog.get_catalog(engine, 'features', directory).tables == first.tables
+        assert len(engine.statements) == 1
+
+        feature_catalog.invalidate('features', directory)
+        feature_catalog.get_catalog(engine, 'features', directory)
+        assert len(engine.statements) == 2
+        feature_catalog.invalidate('features', directory)
+
+    def test_catalog_changed_by_another_process_is_read_again(self):
+        directory = tempfile.mkdtemp()
+        engine = catalog_engine()
+        feature_catalog.invalidate('features', directory)
+        first = feature_catalog.get_catalog(engine, 'features', directory)
+
+        # another worker rebuilt the tables and shared their catalog
+        FeatureCatalog('features', {'arrests_aggregation': columns[:3]}).save(directory)
+        assert feature_catalog.get_catalog(engine, 'features', directory).tables == {
+            'arrests_aggregation': columns[:3]}
+
+        # another worker invalidated it
+        os.remove(feature_catalog.catalog_filename(directory, 'features'))
+        assert feature_catalog.get_catalog(engine, 'features', directory).tables == first.tables
+        assert len(engine.statements) == 2
+        feature_catalog.invalidate('features', directory)
@@ -0,0 +1,142 @@
+import datetime
+import threading
+from unittest import mock
+
+import numpy as np
+import pandas as pd
+
+from eis import feature_loader
+from eis.feature_loader import FeatureLoader
+from tests.fakes import RecordingEngine
+
+
+def table_copy(tables):
+    def copy_out(query):
+        assert query.startswith('COPY (')
+        table_name = [name for name in tables if '"{}"'.format(name) in query or name in query][0]
+        return ''.join(','.join(str(value) for value in row) + '\n' for row in tables[table_name])
+    return copy_out
+
+
+def make_loader(tables, features_in_blocks, labels):
+    loader = FeatureLoader({}, 'features', [], {}, [], 'labels', '1y', '1y', ['1y'],
+                           RecordingEngine(copy_out=table_copy(tables)))
+    loader.features_in_blocks = lambda: features_in_blocks
+    loader.get_master_labels = lambda as_of_dates: labels
+    return loader
+
+
+class TestGetDataset:
+    def test_same_matrix_as_merging_the_tables(self):
+        dates = [datetime.datetime(2015, 1, 1), datetime.datetime(2016, 1, 1)]
+        labels = pd.DataFrame({'officer_id': [1, 2, 3, 1, 2],
+                               'as_of_date': [dates[0], dates[0], dates[0], dates[1], dates[1]],
+                               'outcome': [0, 1, 0, 1, 0]})
+        tables = {'arrests_aggregation': [(1, dates[0], 1.5, 2.0), (2, dates[0], 0.0, 3.0),
+                                          (2, dates[1], 4.0, 1.0), (9, dates[1], 7.0, 7.0)],
+                  'ND_aggregation': [(1, 10.0), (3, 30.0)]}
+        features_in_blocks = {'arrests_aggregation': ['a', 'b'], 'ND_aggregation': ['c']}
+        loader = make_loader(tables, features_in_blocks, labels)
+
+        with mock.patch.object(feature_loader, 'COPY_CHUNK_BYTES', 20):
+            df = loader.get_dataset(['2015-01-01', '2016-01-01'])
+
+        # the result of merging, imputing and reordering the tables with pandas
+        expected = labels.merge(pd.DataFrame(tables['arrests_aggregation'], columns=['officer_id', 'as_of_date',
+                                                                                     'a', 'b']),
+                                on=['officer_id', 'as_of_date'], how='left')
+        expected = expected.merge(pd.DataFrame(tables['ND_aggregation'], columns=['officer_id', 'c']),
+                                  on='officer_id', how='left')
+        expected = expected.sort_values(['officer_id', 'as_of_date']).set_index('officer_id').fillna(0)
+        expected = expected[['as_of_date', 'a', 'b', 'c', 'outcome']]
+
+        assert df.columns.tolist() == expected.columns.tolist()
+        assert (df.index == expected.index).all()
+        assert (df['as_of_date'].values == expected['as_of_date'].values).all()
+        assert np.allclose(df[['a', 'b', 'c']].values, expected[['a', 'b', 'c']].values)
+        assert (df['outcome'].values == expected['outcome'].values).all()
+        assert (df[['a', 'b', 'c']].dtypes == np.float32).all()
+
+    def test_labels_are_typed(self):
+        dates = [datetime.datetime(2015, 1, 1), datetime.datetime(2016, 1, 1)]
+        loader = FeatureLoader({}, 'features', [], {}, [], 'labels', '1y', '1y', ['1y'],
+                               RecordingEngine(copy_out=table_copy({'active': [(1, dates[0], 0), (2, dates[1], 1)]})))
+        loader.get_query_labels = lambda as_of_dates, as_of_dates_table=None: 'WITH labels as (SELECT 1)'
+
+        labels = loader.get_master_labels(['2015-01-01', '2016-01-01'])
+
+        assert labels.columns.tolist() == ['officer_id', 'as_of_date', 'outcome']
+        assert labels['officer_id'].tolist() == [1, 2]
+        assert labels['as_of_date'].tolist() == dates
+        assert labels['outcome'].dtype == np.int64
+
+
+def spine_copy(tables, spine):
+    spine = sorted(spine)
+
+    def copy_out(query):
+        if 'FROM matrix_spine ORDER BY' in query:
+            rows = spine
+        else:
+            # tables joined to the spine, in the order of the query
+            joined = sorted((query.index('"{}"'.format(name)), name) for name in tables if '"{}"'.format(name) in query)
+            rows = []
+            for officer_id, as_of_date, _ in spine:
+                row = []
+                for _, name in joined:
+                    n_keys = 1 if 'ND' in name else 2
+                    match = [table_row[n_keys:] for table_row in tables[name]
+                             if table_row[:n_keys] == (officer_id, as_of_date)[:n_keys]]
+                    row += list(match[0]) if match else [0.0] * (len(tables[name][0]) - n_keys)
+                rows.append(row)
+        return ''.join(','.join(str(value) for value in row) + '\n' for row in rows)
+    return copy_out
+
+
+class TestServerAssembly:
+    def test_same_matrix_as_client_assembly(self):
+        dates = [datetime.datetime(2015, 1, 1), datetime.datetime(2016, 1, 1)]
+        spine = [(2, dates[0], 1), (1, dates[0], 0), (1, dates[1], 1), (3, dates[0], 0)]
+        labels = pd.DataFrame(spine, columns=['officer_id', 'as_of_date', 'outcome'])
+        tables = {'arrests_aggregation': [(1, dates[0], 1.5, 2.0), (2, dates[0], 0.0, 3.0), (1, dates[1], 4.0, 1.0)],
+                  'ND_aggregation': [(1, 10.0), (3, 30.0)]}
+        features_in_blocks = {'arrests_aggregation': ['a', 'b'], 'ND_aggregation': ['c']}
+
+        client = make_loader(tables, features_in_blocks, labels).get_dataset(['2015-01-01', '2016-01-01'])
+        server_loader = FeatureLoader({}, 'features', [], {}, [], 'labels', '1y', '1y', ['1y'],
+                                      RecordingEngine(copy_out=spine_copy(tables, spine)), assembly='server')
+        server_loader.features_in_blocks = lambda: features_in_blocks
+        # one join per table
+        with mock.patch.object(feature_loader, 'SERVER_JOIN_COLUMNS', 2):
+            server = server_loader.get_dataset(['2015-01-01', '2016-01-01'])
+
+        assert server.columns.tolist() == client.columns.tolist()
+        assert (server.index == client.index).all()
+        assert (server['as_of_date'].values == client['as_of_date'].values).all()
+        assert np.allclose(server[['a', 'b', 'c']].values, client[['a', 'b', 'c']].values)
+        assert (server['outcome'].values == client['outcome'].values).all()
+
+
+class TestConcurrentFetch:
+    def test_tables_are_read_while_the_labels_master_runs(self):
+        dates = [datetime.datetime(2015, 1, 1)]
+        tables = {'active': [(1, dates[0], 1), (2, dates[0], 0)],
+                  'arrests_aggregation': [(1, dates[0], 1.0)], 'incidents_aggregation': [(2, dates[0], 2.0)]}
+        # the labels master and the two tables are read at the same time or the barrier breaks
+        all_reading = threading.Barrier(3, timeout=10)
+        copy_table = table_copy(tables)
+
+        def concurrent_copy(query):
+            all_reading.wait()
+            return copy_table(query)
+
+        engine = RecordingEngine(copy_out=concurrent_copy)
+        loader = FeatureLoader({}, 'features', [], {}, [], 'labels', '1y', '1y', ['1y'], engine, fetch_threads=3)
+        loader.get_query_labels = lambda as_of_dates, as_of_dates_table=None: 'WITH labels as (SELECT 1)'
+        loader.features_in_blocks = lambda: {'arrests_aggregation': ['a'], 'incidents_aggregation': ['b']}
+
+        df = loader.get_dataset(['2015-01-01'])
+
+        assert not all_reading.broken
+        assert df['a'].tolist() == [1.0, 0.0]
+        assert df['b'].tolist() == [0.0, 2.0]
@@ -0,0 +1,72 @@
+import os
+import tempfile
+
+import numpy as np
+import pandas as pd
+from sklearn.ensemble import RandomForestClassifier
+
+from eis import grid_fit
+from eis import matrix_store
+from eis.ledger import CheckpointLedger
+
+
+def make_train_df():
+    rng = np.random.RandomState(0)
+    train_df = pd.DataFrame(rng.rand(200, 4).astype(np.float32), columns=['a', 'b', 'c', 'outcome'],
+                            index=pd.Index(range(200), name='officer_id'))
+    train_df['outcome'] = (train_df['outcome'] > 0.7).astype(int)
+    return train_df
+
+
+class TestGridFit:
+    def test_pool_fits_match_serial_fits(self):
+        train_df = make_train_df()
+        matrices_path = tempfile.mkdtemp()
+        directory = grid_fit.shared_train_matrix(train_df, {}, matrices_path, 'uuid')
+        grid_config = {'sklearn.ensemble.RandomForestClassifier': {'n_estimators': [5, 10], 'random_state': [0]},
+                       'sklearn.linear_model.LogisticRegression': {'C': [1.0]}}
+
+        fitted_models = grid_fit.fit_grid(grid_config, directory, 'uuid', 2)
+
+        assert len(fitted_models) == 3
+        serial = RandomForestClassifier(n_estimators=10, random_state=0).fit(train_df.iloc[:, :-1],
+                                                                             train_df.iloc[:, -1])
+        key = CheckpointLedger.model_group_key('sklearn.ensemble.RandomForestClassifier',
+                                               {'n_estimators': 10, 'random_state': 0})
+        assert np.allclose(fitted_models[key].predict_proba(train_df.iloc[:, :-1]),
+                           serial.predict_proba(train_df.iloc[:, :-1]))
+
+    def test_shared_matrix_is_stored_once(self):
+        matrices_path = tempfile.mkdtemp()
+        directory = grid_fit.shared_train_matrix(make_train_df(), {}, matrices_path, 'uuid')
+        data_filename = matrix_store.memmap_filenames(directory, 'uuid')[0]
+        mtime = os.path.getmtime(data_filename)
+
+        assert grid_fit.shared_train_matrix(make_train_df(), {}, matrices_path, 'uuid') == directory
+        assert os.path.getmtime(data_filename) == mtime
+
+        grid_fit.remove_shared_train_matrix(directory, matrices_path, 'uuid')
+        assert not os.path.exists(directory)
+
+    def test_memmap_train_matrix_is_used_as_is(self):
+        matrices_path = tempfile.mkdtemp()
+        train_df = make_train_df()
+        train_df.insert(0, 'as_of_date', pd.Timestamp('2015-01-01'))
+        matrix_store.store_memmap(train_df, {}, matrices_path, 'uuid')
+
+        assert grid_fit.shared_train_matrix(train_df, {}, matrices_path, 'uuid') == matrices_path
+        grid_fit.remove_shared_train_matrix(matrices_path, matrices_path, 'uuid')
+        assert matrix_store.stored_format(matrices_path, 'uuid') == 'memmap'
+        model = grid_fit.fit_model(matrices_path, 'uuid', 'sklearn.ensemble.RandomForestClassifier',
+                                   {'n_estimators': 5, 'random_state': 0})
+        assert model.n_features_ == 3
+
+    def test_memmap_with_other_feature_order_is_copied(self):
+        matrices_path = tempfile.mkdtemp()
+        train_df = make_train_df()
+        train_df.insert(0, 'as_of_date', pd.Timestamp('2015-01-01'))
+        matrix_store.store_memmap(train_df[['as_of_date', 'b', 'a', 'c', 'outcome']], {}, matrices_path, 'uuid')
+
+        directory = grid_fit.shared_train_matrix(train_df, {}, matrices_path, 'uuid')
+        assert directory != matrices_path
+        assert matrix_store.load_memmap(directory, 'uuid').columns.tolist() == train_df.columns.tolist()
@@ -0,0 +1,30 @@
+import tempfile
+
+from eis.ledger import CheckpointLedger
+
+
+grid_config = {'sklearn.ensemble.RandomForestClassifier': {'max_depth': [5, 10], 'n_estimators': [100]}}
+test_dates = ['2015-01-01', '2015-02-01']
+
+
+class TestCheckpointLedger:
+    def test_pending_grid_skips_completed_model_groups(self):
+        ledger = CheckpointLedger(tempfile.mkdtemp(), 'experiment')
+        key = ledger.model_group_key('sklearn.ensemble.RandomForestClassifier',
+                                     {'max_depth': 5, 'n_estimators': 100})
+        for test_date in test_dates:
+            ledger.mark_done('train_uuid', key, test_date, model_id=1)
+
+        pending = ledger.pending_grid('train_uuid', grid_config, test_dates)
+        assert pending == {'sklearn.ensemble.RandomForestClassifier': [{'max_depth': [10], 'n_estimators': [100]}]}
+
+    def test_partially_completed_model_group_is_pending(self):
+        ledger = CheckpointLedger(tempfile.mkdtemp(), 'experiment')
+        key = ledger.model_group_key('sklearn.ensemble.RandomForestClassifier',
+                                     {'max_depth': 5, 'n_estimators': 100})
+        ledger.mark_done('train_uuid', key, test_dates[0], model_id=1)
+
+        pending = ledger.pending_grid('train_uuid', grid_config, test_dates)
+        assert len(pending['sklearn.ensemble.RandomForestClassifier']) == 2
+        assert ledger.is_done('train_uuid', key, test_dates[0])
+        assert not ledger.is_done('train_uuid', key, test_dates[1])
@@ -0,0 +1,164 @@
+import datetime
+import json
+import multiprocessing
+import os
+import socket
+import tempfile
+from decimal import Decimal
+
+import numpy as np
+import pandas as pd
+
+from eis import matrix_store
+
+
+def make_matrix():
+    df = pd.DataFrame({'as_of_date': pd.to_datetime(['2015-01-01', '2015-01-01', '2015-02-01']),
+                       'feature_a': [Decimal('1.5'), Decimal('0'), Decimal('2.25')],
+                       'feature_b': [3, 4, 5],
+                       'outcome': [0, 1, 0]},
+                      index=pd.Index([10, 11, 10], name='officer_id'))
+    return df[['as_of_date', 'feature_a', 'feature_b', 'outcome']]
+
+
+class TestMemmapMatrix:
+    def test_round_trip_keeps_layout(self):
+        directory = tempfile.mkdtemp()
+        matrix_store.store_matrix(make_matrix(), {'end_time': datetime.datetime(2015, 2, 1)},
+                                  directory, 'uuid', matrix_format='memmap')
+
+        assert matrix_store.stored_format(directory, 'uuid') == 'memmap'
+        df = matrix_store.load_memmap(directory, 'uuid')
+        assert df.columns.tolist() == ['as_of_date', 'feature_a', 'feature_b', 'outcome']
+        assert df.index.tolist() == [10, 11, 10]
+        assert df['as_of_date'].tolist() == make_matrix()['as_of_date'].tolist()
+        assert df['feature_a'].dtype == np.float32
+        assert df['feature_a'].tolist() == [1.5, 0, 2.25]
+        assert df.iloc[:, -1].tolist() == [0, 1, 0]
+
+    def test_column_subset(self):
+        directory = tempfile.mkdtemp()
+        matrix_store.store_memmap(make_matrix(), {}, directory, 'uuid')
+
+        df = matrix_store.load_memmap(directory, 'uuid', columns=['feature_b', 'outcome'])
+        assert df.columns.tolist() == ['feature_b', 'outcome']
+        assert df['feature_b'].tolist() == [3, 4, 5]
+
+    def test_not_stored(self):
+        assert matrix_store.stored_format(tempfile.mkdtemp(), 'uuid') is None
+
+
+class TestMatrixCache:
+    def test_full_cache_keeps_the_first_matrices(self):
+        df = make_matrix()
+        size = int(df.memory_usage(index=True, deep=True).sum())
+        cache = matrix_store.MatrixCache(2 * size)
+        cache.put('a', 'matrix a', df)
+        cache.put('b', 'matrix b', df)
+        cache.put('c', 'matrix c', df)
+        assert cache.get('a') == 'matrix a'
+        assert cache.get('b') == 'matrix b'
+        assert cache.get('c') is None
+        assert cache.bytes == 2 * size
+
+    def test_models_reading_more_test_dates_than_fit(self):
+        df = make_matrix()
+        size = int(df.memory_usage(index=True, deep=True).sum())
+        cache = matrix_store.MatrixCache(2 * size)
+        test_dates = ['2016-01-01', '2016-01-02', '2016-01-03']
+        for model in range(3):
+            for test_date in test_dates:
+                if cache.get(test_date) is None:
+                    cache.put(test_date, test_date, df)
+        # the first two dates are decoded once, the third one by every model
+        assert (cache.hits, cache.misses) == (4, 5)
+
+    def test_matrix_larger_than_cache_is_not_kept(self):
+        cache = matrix_store.MatrixCache(1)
+        cache.put('a', 'matrix a', make_matrix())
+        assert cache.get('a') is None
+
+
+class TestFragmentStore:
+    def test_only_missing_dates_are_built(self):
+        directory = tempfile.mkdtemp()
+        queried = []
+
+        def build(as_of_dates):
+            queried.append(as_of_dates)
+            df = make_matrix()
+            return df[df['as_of_date'].isin(pd.to_datetime(as_of_dates))]
+
+        store = matrix_store.FragmentStore(directory, {'blocks': ['a']})
+        first = store.get_dataset(['2015-01-01'], build)
+        assert len(first) == 2
+
+        second = store.get_dataset(['2015-01-01', '2015-02-01', '2015-03-01'], build)
+        assert queried == [['2015-01-01'], ['2015-02-01', '2015-03-01']]
+        assert second.index.tolist() == [10, 11, 10]
+        assert second.columns.tolist() == make_matrix().columns.tolist()
+
+        store.get_dataset(['2015-03-01'], build)
+        assert len(queried) == 2
+
+    def test_definitions_do_not_share_fragments(self):
+        directory = tempfile.mkdtemp()
+        store = matrix_store.FragmentStore(directory, {'blocks': ['a']})
+        store.store(make_matrix(), ['2015-01-01'])
+        assert matrix_store.FragmentStore(directory, {'blocks': ['b']}).missing(['2015-01-01']) == ['2015-01-01']
+
+    def test_only_the_fragments_of_the_rebuilt_tables_are_cleared(self):
+        directory = tempfile.mkdtemp()
+        features = matrix_store.FragmentStore(directory, {'schema_name': 'features', 'labels_table_name': 'labels'})
+        production = matrix_store.FragmentStore(directory, {'schema_name': 'production',
+                                                            'labels_table_name': 'production_labels'})
+        features.store(make_matrix(), ['2015-01-01'])
+        production.store(make_matrix(), ['2015-01-01'])
+
+        matrix_store.clear_fragments(directory, schema_name='production')
+        assert features.missing(['2015-01-01']) == []
+        assert production.missing(['2015-01-01']) == ['2015-01-01']
+
+        matrix_store.clear_fragments(directory, labels_table_name='labels')
+        assert features.missing(['2015-01-01']) == ['2015-01-01']
+
+    def test_vanished_fragment_is_built_again(self):
+        directory = tempfile.mkdtemp()
+        store = matrix_store.FragmentStore(directory, {'blocks': ['a']})
+        store.store(make_matrix(), ['2015-01-01', '2015-02-01'])
+        store.missing = lambda as_of_dates: []
+        os.remove(store._filename('2015-01-01'))
+
+        def build(as_of_dates):
+            df = make_matrix()
+            return df[df['as_of_date'].isin(pd.to_datetime(as_of_dates))]
+
+        dataset = store.get_dataset(['2015-01-01', '2015-02-01'], build)
+        assert pd.to_datetime(dataset['as_of_date']).tolist() == [pd.Timestamp('2015-01-01')] * 2 + \
+            [pd.Timestamp('2015-02-01')]
+
+
+class TestBuildMarker:
+    def test_only_one_builder(self):
+        directory = tempfile.mkdtemp()
+        builder = matrix_store.BuildMarker(directory, 'uuid')
+        assert builder.acquire()
+        assert not matrix_store.BuildMarker(directory, 'uuid').acquire()
+        # a live builder is not stale
+        assert not matrix_store.BuildMarker(directory, 'uuid').break_if_stale()
+
+        builder.release()
+        assert matrix_store.BuildMarker(directory, 'uuid').acquire()
+
+    def test_marker_of_dead_worker_is_stale(self):
+        directory = tempfile.mkdtemp()
+        process = multiprocessing.Process(target=os.getpid)
+        process.start()
+        process.join()
+        marker = matrix_store.BuildMarker(directory, 'uuid')
+        with open(marker.filename, 'w') as f:
+            json.dump({'host': socket.gethostname(), 'pid': process.pid}, f)
+
+        assert marker.break_if_stale()
+        assert marker.acquire()
+        marker.release()
@@ -0,0 +1,118 @@
+import datetime
+
+from eis import officer_spans
+from tests.fakes import RecordingEngine
+
+
+def spans_engine(last_moddate, state=None, n_events=100):
+    state = state or {}
+
+    def rows(query, params):
+        if query.startswith('SELECT max(last_moddate)'):
+            return [(last_moddate, n_events)]
+        if query.startswith('SELECT last_moddate') and params[0] in state:
+            return [state[params[0]]]
+    return RecordingEngine(rows)
+
+
+def activity_inserts(engine):
+    return [(query, params) for query, params in engine.statements
+            if query.startswith('INSERT INTO {}'.format(officer_spans.ACTIVITY_TABLE))]
+
+
+class TestRefresh:
+    def test_first_refresh_builds_every_officer(self):
+        engine = spans_engine(datetime.datetime(2016, 1, 1))
+        officer_spans.refresh(engine, ['1y', '6month', '1y'])
+
+        inserts = activity_inserts(engine)
+        assert len(inserts) == 2
+        assert all('last_moddate >' not in query for query, _ in inserts)
+        assert engine.connections[0].commits == 1
+
+    def test_refresh_rebuilds_the_officers_with_modified_events(self):
+        built_until = datetime.datetime(2016, 1, 1)
+        engine = spans_engine(datetime.datetime(2016, 2, 1), {'1y': (built_until, 90)})
+        officer_spans.refresh(engine, ['1y'])
+
+        (query, params), = activity_inserts(engine)
+        assert 'officer_id IN (SELECT DISTINCT officer_id FROM staging.events_hub WHERE last_moddate > %s)' in query
+        assert params == (built_until,)
+        assert ('INSERT INTO {} (activity_window, last_moddate, n_events, refreshed) VALUES (%s, %s, %s, now())'
+                .format(officer_spans.STATE_TABLE), ('1y', datetime.datetime(2016, 2, 1), 100)) \
+            in engine.statements
+
+    def test_up_to_date_spans_are_kept(self):
+        engine = spans_engine(datetime.datetime(2016, 1, 1), {'1y': (datetime.datetime(2016, 1, 1), 100)})
+        officer_spans.refresh(engine, ['1y'])
+        assert activity_inserts(engine) == []
+
+    def test_added_events_with_the_same_last_moddate_rebuild_every_officer(self):
+        engine = spans_engine(datetime.datetime(2016, 1, 1), {'1y': (datetime.datetime(2016, 1, 1), 90)})
+        officer_spans.refresh(engine, ['1y'])
+        (query, params), = activity_inserts(engine)
+        assert params is None
+
+    def test_deleted_events_rebuild_every_officer(self):
+        engine = spans_engine(datetime.datetime(2016, 2, 1), {'1y': (datetime.datetime(2016, 1, 1), 120)})
+        officer_spans.refresh(engine, ['1y'])
+        (query, params), = activity_inserts(engine)
+        assert params is None
+
+    def test_reloaded_staging_rebuilds_every_officer(self):
+        engine = spans_engine(datetime.datetime(2015, 6, 1), {'1y': (datetime.datetime(2016, 1, 1), 100)})
+        officer_spans.refresh(engine, ['1y'])
+        (query, params), = activity_inserts(engine)
+        assert params is None
+
+    def test_full_refresh_ignores_the_state(self):
+        engine = spans_engine(datetime.datetime(2016, 1, 1), {'1y': (datetime.datetime(2016, 1, 1), 100)})
+        officer_spans.refresh(engine, ['1y'], full=True)
+        (query, params), = activity_inserts(engine)
+        assert params is None
+
+
+def activity_spans(events, window):
+    '''
+    The grouping of query_activity_spans: a new span starts at every event later than the previous
+    event + window, a span is [first event, last event + window)
+    '''
+    spans = []
+    for event in sorted(events):
+        if spans and spans[-1][1] >= event:
+            spans[-1][1] = event + window
+        else:
+            spans.append([event, event + window])
+    return [tuple(span) for span in spans]
+
+
+class TestActivitySpans:
+    def test_spans_hold_the_dates_with_an_event_in_the_window(self):
+        window = datetime.timedelta(days=10)
+        day = datetime.datetime(2016, 1, 1)
+        # 0 and 10 are exactly one window apart, 25 is further from 10
+        events = [day + datetime.timedelta(days=n) for n in [10, 0, 25, 30, 30]]
+
+        spans = activity_spans(events, window)
+        assert spans == [(day, day + datetime.timedelta(days=20)),
+                         (day + datetime.timedelta(days=25), day + datetime.timedelta(days=40))]
+
+        # the definition of an active officer: an event in (as_of_date - window, as_of_date]
+        for n in range(-5, 50):
+            as_of_date = day + datetime.timedelta(days=n)
+            active = any(as_of_date - window < event <= as_of_date for event in events)
+            assert active == any(start <= as_of_date < end for start, end in spans), as_of_date
+
+    def test_query_merges_the_events_closer_than_the_window(self):
+        query = officer_spans.query_activity_spans('1y')
+        assert "+ INTERVAL '1y' >= event_datetime THEN 0 ELSE 1" in query
+        assert "min(event_datetime), max(event_datetime) + INTERVAL '1y'" in query
+
+
+class TestActiveOfficers:
+    def test_range_join_on_the_window(self):
+        query = officer_spans.query_active_officers('1y', 'matrix_as_of_dates')
+        assert "a.activity_window = '1y'" in query
+        assert 'FROM matrix_as_of_dates as d' in query
+        assert 'LATERAL' not in query
+        assert 'JOIN staging.officers_hub' in query
@@ -0,0 +1,56 @@
+from eis import planner
+
+
+class FakeRunModel:
+    """Offline stand-in for RunModels exposing only what the planner reads"""
+    calls = []
+
+    def __init__(self, temporal_set, blocks, features_list):
+        FakeRunModel.calls.append(features_list)
+        self.temporal_split = temporal_set
+        self.blocks = blocks
+        self.features_list = features_list or ['{}_feature'.format(block) for block in blocks]
+
+    def train_metadata(self):
+        return {'feature_as_of_dates': self.temporal_split['train_as_of_dates'],
+                'blocks': sorted(self.blocks)}
+
+    def test_metadata(self, test_date):
+        return {'feature_as_of_dates': [test_date],
+                'blocks': sorted(self.blocks)}
+
+
+def temporal_set(train_dates, test_dates):
+    return {'train_as_of_dates': train_dates,
+            'test_as_of_dates': test_dates}
+
+
+temporal_sets = [temporal_set(['2014-01-01', '2014-02-01'], ['2015-01-01']),
+                 temporal_set(['2014-01-01', '2014-02-01'], ['2015-01-01', '2015-01-02']),
+                 temporal_set(['2014-02-01'], ['2015-01-02'])]
+block_sets = [['A', 'B'], ['A']]
+
+
+def build_plan():
+    FakeRunModel.calls = []
+    return planner.build_plan(temporal_sets, block_sets, FakeRunModel)
+
+
+class TestPlanner:
+    def test_unique_matrices(self):
+        summary = build_plan().summary()
+        assert summary['tasks'] == 6
+        assert summary['train_matrices'] == 4
+        assert summary['test_matrices'] == 4
+        assert summary['matrix_references'] == 6 + 8
+
+    def test_groups_share_train_matrix(self):
+        groups = build_plan().task_groups()
+        assert len(groups) == 4
+        assert [len(group.tasks) for group in groups] == [2, 2, 1, 1]
+        for group in groups:
+            assert all(task.train_uuid == group.train_uuid for task in group.tasks)
+
+    def test_features_list_computed_once_per_block_set(self):
+        build_plan()
+        assert FakeRunModel.calls.count(None) == len(block_sets)
@@ -0,0 +1,91 @@
+import pandas as pd
+from nose.tools import assert_raises
+
+from eis.results_writer import ResultsWriter, evaluation_rows, prediction_rows
+from tests.fakes import RecordingEngine
+
+
+def unit_results(writer, model_id, test_date):
+    writer.add('predictions', prediction_rows(model_id, test_date, [1, 2], [0.2, 0.7], [0, 1], 'uuid'))
+    writer.add('evaluations', evaluation_rows(model_id, test_date, {'auc|roc': 0.5, 'accuracy': 0.75}))
+
+
+class TestEvaluationRows:
+    def test_rows_keep_the_stored_values(self):
+        rows = evaluation_rows(3, '2016-01-01', {'precision@|10_abs': 1 / 3., 'accuracy': 0.5, 'recall@||x': 1})
+        rows = rows.set_index('metric')
+
+        assert rows.loc['precision@', 'parameter'] == '10_abs'
+        assert rows.loc['precision@', 'value'] == round(1 / 3., 10)
+        assert rows.loc['accuracy', 'parameter'] == 'Null'
+        assert rows.loc['recall@', 'parameter'] == 'Null'
+        assert rows.loc['recall@', 'comment'] == 'x'
+        assert rows['comment'].isnull().sum() == 2
+        assert (rows['evaluation_end_time'] == '2016-01-01').all()
+
+
+class TestResultsWriter:
+    def test_flush_replaces_every_table_in_one_transaction(self):
+        engine = RecordingEngine()
+        writer = ResultsWriter(engine)
+        unit_results(writer, 1, '2016-01-01')
+        writer.flush()
+
+        connection, = engine.connections
+        assert [query.split()[0] for query, _ in connection.statements] == ['DELETE', 'COPY', 'DELETE', 'COPY']
+        assert connection.commits == 1
+        assert len(''.join(engine.copied).splitlines()) == 4
+        assert len(writer) == 0 and writer.rows_written == 4
+
+    def test_failed_flush_rolls_back(self):
+        engine = RecordingEngine(fail_copy=True)
+        writer = ResultsWriter(engine)
+        unit_results(writer, 1, '2016-01-01')
+
+        with assert_raises(IOError):
+            writer.flush()
+        assert engine.connections[0].commits == 0
+        assert engine.connections[0].rollbacks == 1
+
+    def test_empty_flush_does_not_connect(self):
+        engine = RecordingEngine()
+        ResultsWriter(engine).flush()
+        assert engine.connections == []
+
+    def test_unknown_table(self):
+        with assert_raises(ValueError):
+            ResultsWriter(None).add('models', pd.DataFrame())
+
+
+class TestWriteBehind:
+    def test_queued_flushes_are_written_in_order_on_close(self):
+        engine = RecordingEngine()
+        writer = ResultsWriter(engine, max_pending=2)
+        written = []
+        for test_date in ['2016-01-01', '2016-01-02', '2016-01-03']:
+            unit_results(writer, 1, test_date)
+            writer.flush(on_written=lambda test_date=test_date: written.append(test_date))
+        writer.close()
+
+        assert written == ['2016-01-01', '2016-01-02', '2016-01-03']
+        assert [connection.commits for connection in engine.connections] == [1, 1, 1]
+        assert writer.rows_written == 12
+
+    def test_failed_write_is_raised_and_later_dates_are_not_marked(self):
+        writer = ResultsWriter(RecordingEngine(fail_copy=True), max_pending=2)
+        written = []
+        # raised by the next flush, or by close when the write fails after it
+        with assert_raises(IOError):
+            for test_date in ['2016-01-01', '2016-01-02']:
+                unit_results(writer, 1, test_date)
+                writer.flush(on_written=lambda test_date=test_date: written.append(test_date))
+            writer.close()
+        writer.close()
+        assert written == []
+
+    def test_close_drops_rows_that_were_not_flushed(self):
+        engine = RecordingEngine()
+        writer = ResultsWriter(engine, max_pending=2)
+        unit_results(writer, 1, '2016-01-01')
+        writer.close()
+        assert engine.connections == []
@@ -0,0 +1,271 @@
+import random
+import tempfile
+from decimal import Decimal
+from unittest import mock
+
+import metta.metta_io
+import numpy as np
+import pandas as pd
+from nose.tools import assert_raises
+
+from eis import run_models
+from eis.results_writer import ResultsWriter, evaluation_rows
+from eis.run_models import RunModels, individual_risk_factors
+from tests.fakes import RecordingEngine
+
+
+temporal_set = {'train_start_date': '2014-01-01',
+                'train_end_date': '2015-01-01',
+                'train_as_of_dates': ['2014-07-01', '2014-01-01', '2015-01-01'],
+                'test_as_of_dates': ['2016-01-01'],
+                'prediction_window': '1y',
+                'train_size': '1y',
+                'features_frequency': '6m',
+                'officer_past_activity_window': '1y'}
+labels_config = {'ForceAllegation': {'include': True}, 'Complaint': {'include': True}}
+
+
+def make_run_model(features_list, **kwargs):
+    return RunModels(labels=[['ForceAllegation', 'Complaint']],
+                     features={},
+                     schema_name='features',
+                     blocks=['OfficerArrests', 'IncidentsReported'],
+                     feature_lookback_duration=['1y', '5y'],
+                     labels_config=labels_config,
+                     labels_table_name='labels',
+                     temporal_split=temporal_set,
+                     grid_config={},
+                     project_path='/tmp/project',
+                     misc_db_parameters={},
+                     features_list=features_list,
+                     **kwargs)
+
+
+class TestMatrixMetadata:
+    def test_uuids_match_the_legacy_sort(self):
+        features_list = ['feature_{}_{}'.format(i, duration) for i in range(300) for duration in ('1y', '5y')]
+        random.Random(0).shuffle(features_list)
+
+        run_model = make_run_model(features_list)
+        legacy = make_run_model(features_list)
+        legacy._sort_hashable_list = legacy._RunModels__sorting_multiple_types
+
+        assert run_model.train_metadata() == legacy.train_metadata()
+        assert run_model.matrix_uuid(run_model.train_metadata()) == \
+            metta.metta_io.generate_uuid(legacy.train_metadata())
+        assert run_model.test_metadata('2016-01-01') == legacy.test_metadata('2016-01-01')
+
+    def test_mixed_lists_keep_the_legacy_order(self):
+        run_model = make_run_model(['a'])
+        for values in (['b', 3, 'a'], [['b', 'a'], ['a']], [{'z': 1, 'a': 2}, 'b']):
+            assert run_model._make_hashable(values) == \
+                run_model._RunModels__sorting_multiple_types(
+                    [str(e) if isinstance(e, (str, int)) else run_model._make_hashable(e)
+                     if isinstance(e, dict) else e for e in values])
+
+    def test_metadata_is_memoized(self):
+        run_model = make_run_model(['a'])
+        assert run_model.test_metadata('2016-01-01') is run_model.test_metadata('2016-01-01')
+
+
+class TestStoredFeatureOrder:
+    def test_stored_matrix_is_reordered_as_features_list(self):
+        from eis import matrix_store
+        run_model = make_run_model(['a', 'b', 'c'])
+        run_model.matrices_path = tempfile.mkdtemp()
+        metadata = run_model.test_metadata('2016-01-01')
+        stored = pd.DataFrame({'as_of_date': pd.Timestamp('2016-01-01'), 'c': [3.], 'a': [1.], 'b': [2.],
+                               'outcome': [1.]}, index=pd.Index([10], name='officer_id'))
+        matrix_store.store_memmap(stored, metadata, run_model.matrices_path, run_model.matrix_uuid(metadata))
+
+        df, uuid = run_model.load_store_matrix(metadata, ['2016-01-01'])
+
+        assert df.columns.tolist() == ['as_of_date', 'a', 'b', 'c', 'outcome']
+        assert df.iloc[0, 1:].tolist() == [1., 2., 3., 1.]
+
+
+def legacy_risk_factors(test_matrix, feature_importances, n_ranks):
+    """individual_feature_ranking before it was vectorized, row by row"""
+    feature_list = test_matrix.columns
+    importance_dict = {}
+    for j, value in enumerate(feature_importances):
+        if value > 0:
+            importance_dict[feature_list[j]] = value
+    importance_dict_filtered = {k: v for k, v in importance_dict.items() if not 'dummy' in k}
+    rftree_feature_list = sorted(importance_dict_filtered, key=importance_dict_filtered.get, reverse=True)
+
+    tmp_test = test_matrix.astype(float)
+    test_matrix_reduced = pd.DataFrame()
+    for feature in rftree_feature_list[:n_ranks]:
+        test_matrix_reduced[feature] = tmp_test[feature]
+
+    test_matrix_rank_distance = pd.DataFrame()
+    for feature in test_matrix_reduced.columns:
+        feature_median = test_matrix_reduced[feature].median()
+        test_matrix_reduced[feature + '_rank'] = test_matrix_reduced[feature].rank()
+        idx = np.nanargmin(np.abs(test_matrix_reduced[feature] - feature_median))
+        median_rank = test_matrix_reduced[feature + '_rank'].iloc[idx]
+        test_matrix_rank_distance[feature] = np.abs(test_matrix_reduced[feature + '_rank'] - median_rank)
+    test_matrix_rank_distance = test_matrix_rank_distance.reset_index(drop=True)
+
+    matrix_transposed = test_matrix_rank_distance.T
+    rows = []
+    for i in matrix_transposed.columns:
+        rows.append(matrix_transposed.nlargest(5, i).index.tolist())
+    return pd.DataFrame(rows, columns=['risk_1', 'risk_2', 'risk_3', 'risk_4', 'risk_5'])
+
+
+class TestIndividualRiskFactors:
+    def test_same_risks_as_row_by_row_ranking(self):
+        rng = np.random.RandomState(0)
+        n_officers, n_features = 300, 40
+        # few distinct values, so ranks and distances are full of ties
+        values = rng.randint(0, 4, size=(n_officers, n_features)).astype(object)
+        values[:, 3] = [Decimal(int(v)) for v in values[:, 3]]
+        columns = ['feature_{}'.format(j) for j in range(n_features - 2)] + ['a_dummy', 'b_dummy']
+        test_matrix = pd.DataFrame(values, columns=columns, index=pd.Index(range(100, 100 + n_officers)))
+        importances = rng.choice([0, 0.01, 0.02, 0.05], size=n_features)
+
+        expected = legacy_risk_factors(test_matrix, importances, n_ranks=20)
+        result = individual_risk_factors(test_matrix, importances, n_ranks=20)
+        assert result.values.tolist() == expected.values.tolist()
+
+
+class FakePredictor:
+    def __init__(self, model):
+        self.model = model
+
+    def load_model(self, model_id):
+        return self.model
+
+
+class TestBatchedPredictions:
+    def test_scores_are_split_back_per_test_date(self):
+        rng = np.random.RandomState(0)
+        test_dates = ['2016-01-01', '2016-01-02', '2016-01-03']
+        matrices = {test_date: pd.DataFrame(rng.rand(20, 4), columns=['a', 'b', 'c', 'outcome'],
+                                            index=pd.Index(range(20), name='officer_id'))
+                    for test_date in test_dates}
+        for test_df in matrices.values():
+            test_df['outcome'] = (test_df['outcome'] > 0.5).astype(int)
+
+        from sklearn.ensemble import RandomForestClassifier
+        model = RandomForestClassifier(n_estimators=5, random_state=0)
+        train_df = matrices[test_dates[0]]
+        model.fit(train_df.iloc[:, :-1], train_df.iloc[:, -1])
+
+        run_model = make_run_model(['a', 'b', 'c'])
+        run_model.results_writer.db_engine = RecordingEngine()
+        run_model.load_test_matrix = lambda test_date: (None, matrices[test_date], 'uuid_' + test_date)
+        evaluated = {}
+        run_model.evaluations = lambda proba, binary, labels, model_id, test_date: evaluated.update(
+            {test_date: (proba, binary)})
+        run_model.individual_feature_ranking = lambda **kwargs: None
+
+        run_model._test_model_batched(FakePredictor(model), 1, test_dates, 'train_uuid', None, None)
+
+        for test_date in test_dates:
+            features = matrices[test_date].iloc[:, :-1]
+            assert np.allclose(evaluated[test_date][0], model.predict_proba(features)[:, 1])
+            assert (evaluated[test_date][1] == model.predict(features)).all()
+        # the three dates fit in one batch, written with one COPY
+        assert len(run_model.results_writer.db_engine.copied) == 1
+        rows = ''.join(run_model.results_writer.db_engine.copied).splitlines()
+        assert len(rows) == 60
+        assert sorted(set(row.split(',')[-1] for row in rows)) == ['uuid_' + test_date for test_date in test_dates]
+
+
+class TestUnbatchedPredictions:
+    def test_predictions_are_written_by_the_results_writer(self):
+        rng = np.random.RandomState(0)
+        test_df = pd.DataFrame(rng.rand(20, 3), columns=['a', 'b', 'outcome'],
+                               index=pd.Index(range(20), name='officer_id'))
+        test_df['outcome'] = (test_df['outcome'] > 0.5).astype(int)
+
+        from sklearn.ensemble import RandomForestClassifier
+        model = RandomForestClassifier(n_estimators=5, random_state=0)
+        model.fit(test_df.iloc[:, :-1], test_df.iloc[:, -1])
+
+        run_model = make_run_model(['a', 'b'])
+        run_model.results_writer.db_engine = RecordingEngine()
+        run_model.load_test_matrix = lambda test_date: (None, test_df, 'uuid_' + test_date)
+        run_model.evaluations = lambda proba, binary, labels, model_id, test_date: None
+        run_model.individual_feature_ranking = lambda **kwargs: None
+
+        run_model._test_model(FakePredictor(model), 1, ['2016-01-01', '2016-01-02'], 'train_uuid', None, None)
+
+        # one COPY of the predictions per test date
+        copied = run_model.results_writer.db_engine.copied
+        assert [len(rows.splitlines()) for rows in copied] == [20, 20]
+        assert copied[1].splitlines()[0].split(',')[-1] == 'uuid_2016-01-02'
+
+
+class TestResultsWriterClose:
+    def test_failed_write_does_not_replace_the_error_of_the_loop(self):
+        run_model = make_run_model(['a'])
+        run_model.results_writer = ResultsWriter(RecordingEngine(fail_copy=True), max_pending=2)
+        run_model.results_writer.add('evaluations', evaluation_rows(1, '2016-01-01', {'accuracy': 0.5}))
+        run_model.results_writer.flush()
+
+        def model_ids():
+            yield 1
+            raise KeyError('model 2')
+
+        run_model.ledger = None
+        run_model._test_model_batched = lambda *args: None
+        with mock.patch.object(run_models, 'Predictor'), assert_raises(KeyError):
+            run_model.train_test_models('train_uuid', model_ids(), None)
+
+
+class FakeModelStorage:
+    def __init__(self):
+        self.models = {}
+
+    def get_store(self, model_hash):
+        storage = self
+
+        class Store:
+            def write(self, model):
+                storage.models[model_hash] = model
+        return Store()
+
+
+class TestReuseTrainedModels:
+    def test_only_missing_models_are_left_to_train(self):
+        from eis.model_store import ModelArtifactStore
+        artifacts = ModelArtifactStore(tempfile.mkdtemp())
+        artifacts.save(7, 'train_uuid', {'fitted': 'rf'}, model_id=3)
+
+        run_model = make_run_model(['a'])
+        run_model.model_artifacts = artifacts
+        # model 2 was retrained as model 3, model 4 has no stored artifact
+        run_model.db_engine = RecordingEngine(lambda query, params: [
+            (2, 7, 'hash_2', 'sklearn.ensemble.RandomForestClassifier', {'n_estimators': 10}),
+            (3, 7, 'hash_3', 'sklearn.ensemble.RandomForestClassifier', {'n_estimators': 10}),
+            (4, 8, 'hash_4', 'sklearn.ensemble.RandomForestClassifier', {'n_estimators': 20})])
+        grid_config = {'sklearn.ensemble.RandomForestClassifier': {'n_estimators': [10, 20, 30], 'n_jobs': [4]}}
+        model_storage = FakeModelStorage()
+
+        pending, reused = run_model.reuse_trained_models('train_uuid', grid_config, model_storage)
+
+        assert reused == [3]
+        assert model_storage.models == {'hash_3': {'fitted': 'rf'}}
+        assert pending == {'sklearn.ensemble.RandomForestClassifier': [{'n_estimators': [20], 'n_jobs': [4]},
+                                                                       {'n_estimators': [30], 'n_jobs': [4]}]}
+
+
+class TestModelArtifactSchemas:
+    def test_production_does_not_pick_up_experiment_models(self):
+        from eis.model_store import ModelArtifactStore
+        project_path = tempfile.mkdtemp()
+        ModelArtifactStore(project_path, schema='results').save(7, 'train_uuid', {'fitted': 'rf'}, model_id=3,
+                                                                train_end_date='2016-01-01')
+
+        assert ModelArtifactStore(project_path, schema='production').find_fresh(7, '2016-01-15', '1m') is None
+        artifact = ModelArtifactStore(project_path, schema='results').find_fresh(7, '2016-01-15', '1m')
+        assert artifact['model_id'] == 3 and artifact['schema'] == 'results'
+
+    def test_results_schema_is_not_read_from_the_engine(self):
+        # the pinned SQLAlchemy engines have no get_execution_options
+        run_model = make_run_model(['a'], db_engine=RecordingEngine(), results_schema='production')
+        assert run_model.results_writer.schema == 'production'
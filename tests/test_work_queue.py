@@ -0,0 +1,82 @@
+import multiprocessing
+import os
+import tempfile
+
+from eis.work_queue import WorkQueue, work, DONE, FAILED
+
+
+def record(path, name):
+    with open(os.path.join(path, name), 'a') as f:
+        f.write('{}\n'.format(os.getpid()))
+
+
+def record_after(path, name, before):
+    # a later stage must only start once the earlier one is finished
+    assert len(os.listdir(path)) >= before
+    record(path, name)
+
+
+def always_fails():
+    raise ValueError('boom')
+
+
+functions = {'record': record, 'record_after': record_after, 'always_fails': always_fails}
+
+
+def run_worker(filename):
+    work(WorkQueue(filename), functions, poll_interval=0.05)
+
+
+class TestWorkQueue:
+    def test_several_workers_run_every_item_once(self):
+        path = tempfile.mkdtemp()
+        out = tempfile.mkdtemp()
+        queue = WorkQueue(os.path.join(path, 'queue.sqlite'))
+        items = [(0, 'record', (out, 'matrix_{}'.format(i)), {}) for i in range(10)]
+        items += [(1, 'record_after', (out, 'train_{}'.format(i), 10), {}) for i in range(5)]
+        batch = queue.enqueue(items)
+
+        workers = [multiprocessing.Process(target=run_worker, args=(queue.filename,)) for _ in range(3)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+
+        assert queue.counts(batch) == {DONE: 15}
+        for name in os.listdir(out):
+            with open(os.path.join(out, name)) as f:
+                assert len(f.readlines()) == 1
+
+    def test_expired_lease_is_claimed_again(self):
+        queue = WorkQueue(os.path.join(tempfile.mkdtemp(), 'queue.sqlite'), lease_seconds=-1)
+        queue.enqueue([(0, 'record', (), {})])
+
+        first = queue.claim('dead worker')
+        second = queue.claim('other worker')
+        assert second.item_id == first.item_id
+        assert second.attempts == 2
+
+    def test_failing_item_is_retried_then_failed(self):
+        queue = WorkQueue(os.path.join(tempfile.mkdtemp(), 'queue.sqlite'), max_attempts=2)
+        batch = queue.enqueue([(0, 'always_fails', (), {})])
+
+        assert work(queue, functions, poll_interval=0.05) == 2
+        assert queue.counts(batch) == {FAILED: 1}
+
+    def test_deferred_item_waits(self):
+        queue = WorkQueue(os.path.join(tempfile.mkdtemp(), 'queue.sqlite'))
+        batch = queue.enqueue([(0, 'record', (), {})])
+
+        queue.defer(queue.claim('worker'), 'worker', 60)
+        assert queue.claim('other worker') is None
+        assert queue.counts(batch) == {'pending': 1}
+
+    def test_deferred_item_keeps_its_attempts(self):
+        queue = WorkQueue(os.path.join(tempfile.mkdtemp(), 'queue.sqlite'), max_attempts=1)
+        batch = queue.enqueue([(0, 'always_fails', (), {})])
+        queue.defer(queue.claim('worker'), 'worker', 0)
+
+        item = queue.claim('worker')
+        assert item.attempts == 1
+        queue.fail(item, 'worker', 'boom')
+        assert queue.counts(batch) == {FAILED: 1}